@@ -0,0 +1,127 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+from db_wrappers.flat_file_manager import FlatFileManager
+
+
+class AsyncFlatFileManager:
+    """
+    asyncio front end for FlatFileManager.
+
+    All file I/O and JSON work runs on a bounded thread pool, so the event loop
+    never blocks on disk. Concurrent reads of the same conversation (and the same
+    page of it) share a single disk read.
+    """
+
+    def __init__(self, storage_dir="data", max_workers=8, **options):
+        """
+        Initializes the AsyncFlatFileManager. Opening the storage directory and
+        loading its index happens synchronously, so create it during startup.
+
+        Args:
+            storage_dir (str): Directory holding the conversation files
+            max_workers (int): Maximum number of threads doing file I/O at once
+            **options: Passed through to FlatFileManager
+        """
+        self.manager = FlatFileManager(storage_dir=storage_dir, **options)
+        self.coalesced_reads = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flat-file-io")
+        self._inflight = {}  # Key: (conversation_id, read arguments) => Value: Future
+
+    async def get_conversation(self, conversation_id: str, offset: Optional[int] = None,
+                               limit: Optional[int] = None) -> List[Dict]:
+        """
+        Awaitable FlatFileManager.get_conversation().
+        """
+        return await self._coalesced_read(conversation_id, ("get", offset, limit),
+                                          self.manager.get_conversation, conversation_id, offset, limit)
+
+    async def tail(self, conversation_id: str, n: int) -> List[Dict]:
+        """
+        Awaitable FlatFileManager.tail().
+        """
+        return await self._coalesced_read(conversation_id, ("tail", n), self.manager.tail, conversation_id, n)
+
+    async def get_context_window(self, conversation_id: str, max_tokens: int) -> List[Dict]:
+        """
+        Awaitable FlatFileManager.get_context_window().
+        """
+        return await self._coalesced_read(conversation_id, ("context", max_tokens),
+                                          self.manager.get_context_window, conversation_id, max_tokens)
+
+    async def save_conversation(self, conversation_id: str, relative_filepath: str, messages: List[Dict]) -> None:
+        """
+        Awaitable FlatFileManager.save_conversation().
+        """
+        await self._write(conversation_id, self.manager.save_conversation,
+                          conversation_id, relative_filepath, list(messages))
+
+    async def append_message(self, conversation_id: str, message: Dict,
+                             relative_filepath: Optional[str] = None) -> None:
+        """
+        Awaitable FlatFileManager.append_message().
+        """
+        await self._write(conversation_id, self.manager.append_message, conversation_id, message, relative_filepath)
+
+    async def append_messages(self, conversation_id: str, messages: List[Dict],
+                              relative_filepath: Optional[str] = None) -> None:
+        """
+        Awaitable FlatFileManager.append_messages().
+        """
+        await self._write(conversation_id, self.manager.append_messages,
+                          conversation_id, list(messages), relative_filepath)
+
+    async def close(self) -> None:
+        """
+        Waits for outstanding file operations and releases the thread pool.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._shutdown)
+
+    async def __aenter__(self) -> "AsyncFlatFileManager":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    def _shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.manager.close()
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def _coalesced_read(self, conversation_id: str, arguments: tuple, fn, *args) -> List[Dict]:
+        """
+        Runs a read on the thread pool unless an identical read is already in
+        flight, in which case its result is shared. Every caller gets its own
+        copy of the list.
+        """
+        key = (conversation_id, arguments)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(fn, *args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced_reads += 1
+        # Shielded so one caller being cancelled does not cancel the shared read
+        return list(await asyncio.shield(future))
+
+    async def _write(self, conversation_id: str, fn, *args) -> None:
+        """
+        Runs a write on the thread pool. Reads of the conversation that were in
+        flight may predate the write, so callers arriving after it completes start
+        a fresh read instead of joining them.
+        """
+        try:
+            await self._run(fn, *args)
+        finally:
+            for key in [key for key in self._inflight if key[0] == conversation_id]:
+                del self._inflight[key]
+
+    def _forget(self, key: tuple, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
@@ -0,0 +1,287 @@
+import asyncio
+from datetime import datetime, UTC
+from typing import List, Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    AsyncMongoClient = None
+
+from db_wrappers.mongodb_manager import (ARCHIVED_FIELD, BACKFILL_MESSAGE_COUNT, CONVERSATION_INDEXES,
+                                         SCHEMA_COLLECTION, SCHEMA_VERSION, _SLICE_ALL, _append_update, _bucketed,
+                                         _check_archived, _conversation_document, _token_fields, _verified_schemas,
+                                         _window_pipeline)
+from db_wrappers.tokens import context_window, estimate_tokens
+
+
+class AsyncMongoDBManager:
+    """
+    asyncio sibling of MongoDBManager, built on pymongo's native async client
+    (pymongo 4.13 or newer), so database calls do not tie up a thread each.
+
+    Stores conversations in the same single-document layout as MongoDBManager,
+    so both classes can share a database. Conversations a bucketed
+    MongoDBManager keeps in message_buckets can be read but not written.
+    Indexes are created on first use.
+    """
+
+    def __init__(self, connection_string: str = "mongodb://localhost:27017/", database_name: str = "chai_db",
+                 max_pool_size: int = 100, min_pool_size: int = 0, max_idle_time_ms: Optional[int] = None):
+        """
+        Initializes the AsyncMongoDBManager. No connection is made until the
+        first operation.
+
+        Args:
+            connection_string (str): MongoDB connection string
+            database_name (str): Name of the database to use
+            max_pool_size (int): Most connections open to each server at once; further
+                operations wait for a free connection
+            min_pool_size (int): Connections kept open to each server even when idle
+            max_idle_time_ms (int): How long an unused connection may stay open, or
+                None to keep idle connections indefinitely
+        """
+        if AsyncMongoClient is None:
+            raise ImportError("AsyncMongoDBManager requires pymongo 4.13 or newer: pip install -U pymongo")
+        self.client = AsyncMongoClient(connection_string, maxPoolSize=max_pool_size, minPoolSize=min_pool_size,
+                                       maxIdleTimeMS=max_idle_time_ms)
+        self.db = self.client[database_name]
+        self._connection_string = connection_string
+        self.conversations = self.db["conversations"]
+        self.buckets = self.db["message_buckets"]
+        self._indexed = False
+        self._index_lock = asyncio.Lock()
+
+    async def _ensure_indexes(self) -> None:
+        """
+        Creates the same indexes as MongoDBManager, sharing its per-process and
+        chai_schema marker checks so they are only built once.
+        """
+        if self._indexed:
+            return
+        async with self._index_lock:
+            if self._indexed:
+                return
+            key = (self._connection_string, self.db.name, "conversations")
+            if key not in _verified_schemas:
+                schema = self.db[SCHEMA_COLLECTION]
+                marker = await schema.find_one({"_id": "conversations", "version": {"$gte": SCHEMA_VERSION}})
+                if marker is None:
+                    for keys, options in CONVERSATION_INDEXES:
+                        await self.conversations.create_index(keys, **options)
+                    await self.conversations.update_many(
+                        {"message_count": {"$exists": False}, "messages": {"$type": "array"}}, BACKFILL_MESSAGE_COUNT)
+                    await schema.update_one({"_id": "conversations"}, {"$max": {"version": SCHEMA_VERSION}},
+                                            upsert=True)
+                _verified_schemas.add(key)
+            self._indexed = True
+
+    async def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                               limit: Optional[int] = None) -> List[Dict]:
+        """
+        Awaitable MongoDBManager.get_conversation().
+        """
+        await self._ensure_indexes()
+        if limit is not None and limit <= 0:
+            return []
+        projection = None
+        if offset or limit is not None:
+            projection = {"messages": {"$slice": [offset or 0, _SLICE_ALL if limit is None else limit]},
+                          "user_id": True, "thread_name": True, ARCHIVED_FIELD: True,
+                          "message_count": True, "bucket_size": True}
+        document = await self.conversations.find_one({"_id": f"{user_id}_{thread_name}"}, projection)
+        _check_archived(document)
+        if _bucketed(document):
+            return await self._read_buckets(document, offset, limit)
+        if not document or "messages" not in document:
+            return []
+        return document["messages"]
+
+    async def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]:
+        """
+        Awaitable MongoDBManager.tail().
+        """
+        if n <= 0:
+            return []
+        return await self.get_conversation(user_id, thread_name, offset=-n)
+
+    async def _read_buckets(self, summary: Dict, offset: Optional[int], limit: Optional[int]) -> List[Dict]:
+        """
+        Returns a window of a conversation stored in buckets, fetching only the
+        buckets that overlap it.
+        """
+        count = summary["message_count"]
+        bucket_size = summary["bucket_size"]
+        start = offset or 0
+        if start < 0:
+            start = max(count + start, 0)
+        stop = count if limit is None else min(start + limit, count)
+        if start >= stop:
+            return []
+        cursor = self.buckets.find({"user_id": summary["user_id"], "thread_name": summary["thread_name"],
+                                    "bucket_no": {"$gte": start // bucket_size, "$lte": (stop - 1) // bucket_size}},
+                                   {"messages": True, "_id": False}).sort("bucket_no", 1)
+        return [item["message"] async for bucket in cursor
+                for item in bucket["messages"] if start <= item["seq"] < stop]
+
+    async def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        """
+        Awaitable MongoDBManager.get_context_window().
+        """
+        await self._ensure_indexes()
+        if max_tokens <= 0:
+            return []
+        conversation_id = f"{user_id}_{thread_name}"
+        cursor = await self.conversations.aggregate(_window_pipeline(conversation_id, max_tokens))
+        for document in await cursor.to_list(None):
+            _check_archived(document)
+            if _bucketed(document):
+                return await self._bucket_window(user_id, thread_name, max_tokens)
+            if document["indexed"]:
+                return document["messages"]
+            messages = await self.get_conversation(user_id, thread_name)
+            await self.conversations.update_one({"_id": conversation_id, "messages": {"$size": len(messages)}},
+                                                {"$set": _token_fields(messages)})
+            return context_window(messages, max_tokens)
+        return []
+
+    async def _bucket_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        """
+        Awaitable MongoDBManager._bucket_window(), for a conversation known to be
+        stored in buckets.
+        """
+        cursor = (self.buckets.find({"user_id": user_id, "thread_name": thread_name}, {"messages": True, "_id": False})
+                  .sort("bucket_no", -1).batch_size(2))
+        window = []
+        used = 0
+        try:
+            async for bucket in cursor:
+                for item in reversed(bucket["messages"]):
+                    tokens = item.get("tokens")
+                    if tokens is None:
+                        tokens = estimate_tokens(item["message"])
+                    if used + tokens > max_tokens:
+                        return window[::-1]
+                    used += tokens
+                    window.append(item["message"])
+        finally:
+            await cursor.close()
+        return window[::-1]
+
+    async def message_count(self, user_id: str, thread_name: str) -> int:
+        """
+        Awaitable MongoDBManager.message_count().
+        """
+        await self._ensure_indexes()
+        summary = await self.conversations.find_one({"_id": f"{user_id}_{thread_name}"}, {"message_count": True})
+        if summary is None:
+            return 0
+        if "message_count" in summary:
+            return summary["message_count"]
+        cursor = await self.conversations.aggregate([
+            {"$match": {"_id": f"{user_id}_{thread_name}"}},
+            {"$project": {"count": {"$size": {"$ifNull": ["$messages", []]}}}},
+        ])
+        result = await cursor.to_list(None)
+        return result[0]["count"] if result else 0
+
+    async def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        Awaitable MongoDBManager.save_conversation().
+        """
+        await self._ensure_indexes()
+        document = _conversation_document(user_id, thread_name, list(messages), datetime.now(UTC).isoformat())
+        previous = await self.conversations.find_one_and_update(
+            {"_id": document["_id"]}, {"$set": document, "$unset": {ARCHIVED_FIELD: "", "bucket_size": ""}},
+            projection={"bucket_size": True}, upsert=True)
+        if _bucketed(previous):
+            # Buckets left by a bucketed MongoDBManager would shadow the new messages
+            await self.buckets.delete_many({"user_id": user_id, "thread_name": thread_name})
+
+    async def append_message(self, user_id: str, thread_name: str, message: Dict) -> None:
+        """
+        Awaitable MongoDBManager.append_message().
+        """
+        await self.append_messages(user_id, thread_name, [message])
+
+    async def append_messages(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        Awaitable MongoDBManager.append_messages(). Raises ValueError for a
+        conversation stored in buckets, which only a bucketed MongoDBManager can
+        append to.
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        await self._ensure_indexes()
+        timestamp = datetime.now(UTC).isoformat()
+        update = _append_update(user_id, thread_name, messages, timestamp)
+        conversation_id = f"{user_id}_{thread_name}"
+        while True:
+            try:
+                await self.conversations.update_one({"_id": conversation_id, ARCHIVED_FIELD: {"$exists": False},
+                                                     "bucket_size": {"$exists": False}}, update, upsert=True)
+                return
+            except DuplicateKeyError:
+                # The conversation is archived or bucketed, or a concurrent upsert created it first
+                document = await self.conversations.find_one({"_id": conversation_id})
+                _check_archived(document)
+                if _bucketed(document):
+                    raise ValueError(f"Conversation {conversation_id} is stored in buckets; "
+                                     f"append to it with a bucketed MongoDBManager")
+
+    async def list_user_threads(self, user_id: str) -> List[str]:
+        """
+        Awaitable MongoDBManager.list_user_threads().
+        """
+        await self._ensure_indexes()
+        cursor = (self.conversations.find({"user_id": user_id}, {"thread_name": True, "_id": False})
+                  .sort([("updated_at", -1), ("thread_name", 1)]).hint("user_catalog"))
+        return [record["thread_name"] async for record in cursor]
+
+    async def list_threads(self, user_id: str, limit: int = 50, before: Optional[Dict] = None) -> List[Dict]:
+        """
+        Awaitable MongoDBManager.list_threads().
+        """
+        await self._ensure_indexes()
+        query = {"user_id": user_id}
+        if before is not None:
+            query["$or"] = [
+                {"updated_at": {"$lt": before["updated_at"]}},
+                {"updated_at": before["updated_at"], "thread_name": {"$gt": before["thread_name"]}},
+            ]
+        projection = {"thread_name": True, "updated_at": True, "message_count": True, "_id": False}
+        cursor = (self.conversations.find(query, projection)
+                  .sort([("updated_at", -1), ("thread_name", 1)]).hint("user_catalog").limit(limit))
+        return await cursor.to_list(None)
+
+    async def delete_conversation(self, user_id: str, thread_name: str) -> bool:
+        """
+        Awaitable MongoDBManager.delete_conversation().
+        """
+        await self._ensure_indexes()
+        deleted = await self.conversations.find_one_and_delete({"_id": f"{user_id}_{thread_name}"},
+                                                               projection={"bucket_size": True})
+        if _bucketed(deleted):
+            await self.buckets.delete_many({"user_id": user_id, "thread_name": thread_name})
+        return deleted is not None
+
+    async def close(self) -> None:
+        """
+        Closes the connection pool.
+        """
+        await self.client.close()
+
+    async def __aenter__(self) -> "AsyncMongoDBManager":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    async def _wipe_database(self) -> None:
+        """
+        **DANGEROUS**: Deletes all conversations. Only for testing!
+        """
+        await self.conversations.delete_many({})
+        await self.buckets.delete_many({})
@@ -0,0 +1,255 @@
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Protocol, Tuple, runtime_checkable
+from urllib.parse import quote, unquote, urlparse
+
+from db_wrappers.flat_file_manager import FlatFileManager
+from db_wrappers.sqlite_manager import SQLiteManager
+
+
+@runtime_checkable
+class StorageBackend(Protocol):
+    """
+    The interface shared by every conversation store. Conversations are
+    addressed by user_id and thread_name.
+
+    MongoDBManager and SQLiteManager implement it directly; FlatFileBackend adapts
+    FlatFileManager to it. Open one with open_backend() to stay independent of
+    the engine.
+    """
+
+    def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Dict]: ...
+
+    def get_conversations(self, user_id: str, thread_names: Iterable[str]) -> Iterator[Tuple[str, List[Dict]]]: ...
+
+    def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]: ...
+
+    def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]: ...
+
+    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None: ...
+
+    def append_message(self, user_id: str, thread_name: str, message: Dict) -> None: ...
+
+    def append_messages(self, user_id: str, thread_name: str, messages: List[Dict]) -> None: ...
+
+    def list_user_threads(self, user_id: str) -> List[str]: ...
+
+    def delete_conversation(self, user_id: str, thread_name: str) -> bool: ...
+
+    def close(self) -> None: ...
+
+
+class FlatFileBackend:
+    """
+    StorageBackend over a FlatFileManager. A thread is stored as the
+    conversation f"{user_id}_{thread_name}", like MongoDBManager's document IDs
+    and the migration tool's conversation IDs, in the file
+    f"{user_id}/{thread_name}.json".
+
+    The conversation ID alone does not say whose thread it is, as "bob_smith_work"
+    may be bob's "smith_work" or bob_smith's "work". list_user_threads() goes by
+    the directory in the file's path instead. Files named after the conversation
+    ID, as written before, are taken to belong to the user ID up to the first
+    underscore, as in migration.split_conversation_id().
+    """
+
+    def __init__(self, manager: FlatFileManager):
+        self.manager = manager
+
+    def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Dict]:
+        return self.manager.get_conversation(_conversation_id(user_id, thread_name), offset, limit)
+
+    def get_conversations(self, user_id: str, thread_names: Iterable[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        thread_names = {_conversation_id(user_id, thread_name): thread_name for thread_name in thread_names}
+        for conversation_id, messages in self.manager.get_conversations(thread_names):
+            yield thread_names[conversation_id], messages
+
+    def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]:
+        return self.manager.tail(_conversation_id(user_id, thread_name), n)
+
+    def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        return self.manager.get_context_window(_conversation_id(user_id, thread_name), max_tokens)
+
+    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        self.manager.save_conversation(_conversation_id(user_id, thread_name), _thread_filepath(user_id, thread_name),
+                                       messages)
+
+    def append_message(self, user_id: str, thread_name: str, message: Dict) -> None:
+        self.append_messages(user_id, thread_name, [message])
+
+    def append_messages(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        self.manager.append_messages(_conversation_id(user_id, thread_name), messages,
+                                     _thread_filepath(user_id, thread_name))
+
+    def list_user_threads(self, user_id: str) -> List[str]:
+        prefix = _conversation_id(user_id, "")
+        thread_names = []
+        for conversation_id in self.manager.list_conversations(prefix):
+            thread_name = conversation_id[len(prefix):]
+            if _owns(self.manager.conversations_index.get(conversation_id, ""), user_id, thread_name):
+                thread_names.append(thread_name)
+        return thread_names
+
+    def delete_conversation(self, user_id: str, thread_name: str) -> bool:
+        return self.manager.delete_conversation(_conversation_id(user_id, thread_name))
+
+    def close(self) -> None:
+        self.manager.close()
+
+
+def _conversation_id(user_id: str, thread_name: str) -> str:
+    return f"{user_id}_{thread_name}"
+
+
+def _thread_filepath(user_id: str, thread_name: str) -> str:
+    return f"{_path_part(user_id)}/{_path_part(thread_name)}.json"
+
+
+def _thread_from_filepath(conversation_id: str, relative_filepath: str) -> Optional[Tuple[str, str]]:
+    """
+    Recovers (user_id, thread_name) from a file written under _thread_filepath(),
+    or returns None for files named some other way, such as legacy
+    "<conversation_id>.json" files.
+    """
+    parts = relative_filepath.split("/")
+    if len(parts) < 2 or not parts[-1].endswith(".json"):
+        return None
+    user_id, thread_name = unquote(parts[-2]), unquote(parts[-1][:-len(".json")])
+    if not user_id or not thread_name or _conversation_id(user_id, thread_name) != conversation_id:
+        return None
+    return user_id, thread_name
+
+
+def _path_part(name: str) -> str:
+    """
+    Encodes a user_id or thread_name as a single path component. Separators, NUL
+    and other special characters are percent-encoded, as are the dots of "." and
+    "..", so a name typed in by a user cannot point outside the storage directory.
+    """
+    if not name:
+        raise ValueError("User IDs and thread names must not be empty")
+    part = quote(name, safe="")
+    if not part.strip("."):
+        part = part.replace(".", "%2E")
+    return part
+
+
+def _owns(relative_filepath: str, user_id: str, thread_name: str) -> bool:
+    """
+    Checks that a conversation file is user_id's thread_name rather than another
+    user's thread with the same conversation ID. See FlatFileBackend.
+    """
+    filepath = _thread_filepath(user_id, thread_name)
+    if relative_filepath == filepath or relative_filepath.endswith("/" + filepath):
+        return True
+    legacy = os.path.basename(relative_filepath) == f"{_conversation_id(user_id, thread_name)}.json"
+    return legacy and "_" not in user_id
+
+
+def _url_path(url: str) -> str:
+    # scheme:///abs/path is absolute; scheme://relative/path is relative to the working directory
+    parsed = urlparse(url)
+    return parsed.netloc + parsed.path
+
+
+def _open_file(url: str, **options) -> StorageBackend:
+    return FlatFileBackend(FlatFileManager(storage_dir=_url_path(url) or "data", **options))
+
+
+def _open_sqlite(url: str, **options) -> StorageBackend:
+    return SQLiteManager(database_path=_url_path(url) or "chai.db", **options)
+
+
+def _open_mongodb(url: str, **options) -> StorageBackend:
+    # Imported here so that flat-file users do not need pymongo
+    from db_wrappers.mongodb_manager import MongoDBManager
+
+    database_name = options.pop("database_name", None) or urlparse(url).path.lstrip("/") or "chai_db"
+    return MongoDBManager(connection_string=url, database_name=database_name, **options)
+
+
+# Key: URL scheme => Value: function opening a backend from a URL and keyword options
+BACKENDS: Dict[str, Callable[..., StorageBackend]] = {
+    "file": _open_file,
+    "sqlite": _open_sqlite,
+    "mongodb": _open_mongodb,
+    "mongodb+srv": _open_mongodb,
+}
+
+
+def register_backend(scheme: str, factory: Callable[..., StorageBackend]) -> None:
+    """
+    Makes open_backend() handle URLs with the given scheme.
+
+    Args:
+        scheme (str): URL scheme, such as "postgresql"
+        factory (Callable): Called as factory(url, **options) to open the backend
+    """
+    BACKENDS[scheme] = factory
+
+
+def open_backend(url: str, **options) -> StorageBackend:
+    """
+    Opens the conversation store a URL points to.
+
+    Examples:
+        file:///var/lib/chai, file://data             FlatFileManager storage directory
+        sqlite:///var/lib/chai.db, sqlite://chai.db   SQLiteManager database file
+        mongodb://localhost:27017/chai_db             MongoDBManager; the path names the
+                                                      database, defaulting to chai_db
+
+    Args:
+        url (str): Location of the store
+        **options: Passed to the backend's manager, e.g. storage_mode="bucketed"
+    """
+    scheme = urlparse(url).scheme
+    if scheme not in BACKENDS:
+        raise ValueError(f"No storage backend for {url!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[scheme](url, **options)
+
+
+def default_backend_url() -> str:
+    """
+    Returns the store named by the CHAI_STORAGE_URL environment variable, or a
+    local MongoDB.
+    """
+    return os.getenv("CHAI_STORAGE_URL", "mongodb://localhost:27017/chai_db")
+
+
+if __name__ == "__main__":
+    import shutil
+
+    print("Testing FlatFileBackend.list_user_threads()")
+    backend = open_backend("file://data_backends_test")
+    backend.save_conversation("bob", "work", [{"role": "user", "content": "bob's work"}])
+    backend.append_message("bob", "home", {"role": "user", "content": "bob's home"})
+    backend.save_conversation("bob_smith", "work", [{"role": "user", "content": "bob_smith's work"}])
+    backend.append_message("bob_smith", "notes", {"role": "user", "content": "bob_smith's notes"})
+    bob = sorted(backend.list_user_threads("bob"))
+    bob_smith = sorted(backend.list_user_threads("bob_smith"))
+    if bob == ["home", "work"] and bob_smith == ["notes", "work"]:
+        print("Successfully listed each user's own threads!")
+    else:
+        print(f"Failed! bob sees {bob}, bob_smith sees {bob_smith}")
+
+    if (backend.get_conversation("bob", "work")[0]["content"] == "bob's work"
+            and backend.get_conversation("bob_smith", "work")[0]["content"] == "bob_smith's work"):
+        print("Successfully read each user's threads!")
+    else:
+        print("Failed! Threads of different users were mixed up")
+
+    print("\nTesting FlatFileBackend with unsafe thread names")
+    for thread_name in ("../../outside", "a/b", ".."):
+        backend.save_conversation("..", thread_name, [{"role": "user", "content": thread_name}])
+    storage_dir = os.path.abspath("data_backends_test")
+    escaped = [path for path in backend.manager.conversations_index.values()
+               if not os.path.abspath(os.path.join(storage_dir, path)).startswith(storage_dir + os.sep)
+               or path.count("/") != 1]
+    if not escaped and sorted(backend.list_user_threads("..")) == ["..", "../../outside", "a/b"]:
+        print("Successfully kept every thread inside its user's directory!")
+    else:
+        print(f"Failed! Files were written to {escaped}")
+
+    backend.close()
+    shutil.rmtree("data_backends_test")
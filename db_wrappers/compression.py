@@ -0,0 +1,70 @@
+import zlib
+from typing import List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def compress(data: bytes, method: str = "zlib", level: Optional[int] = None) -> bytes:
+    """
+    Compresses a conversation file with zlib (standard library) or zstd (requires
+    the optional zstandard package).
+    """
+    if method == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    if method == "zstd":
+        _require_zstd()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError(f"Unknown compression method {method!r}, expected one of {available_methods()}")
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Returns the decompressed contents of a file, or the data unchanged if it is
+    not compressed.
+    """
+    if data[:4] == ZSTD_MAGIC:
+        _require_zstd()
+        return zstandard.ZstdDecompressor().decompress(data)
+    if _is_zlib(data):
+        return zlib.decompress(data)
+    return data
+
+
+def is_compressed(data: bytes) -> bool:
+    """
+    Tells compressed files apart from plain ones by their first bytes. Neither
+    header can start a JSON or MessagePack conversation file.
+    """
+    return data[:4] == ZSTD_MAGIC or _is_zlib(data)
+
+
+def available_methods() -> List[str]:
+    """
+    Returns the compression methods whose dependencies are installed.
+    """
+    return ["zlib", "zstd"] if zstandard is not None else ["zlib"]
+
+
+def check_method(method: str) -> None:
+    """
+    Raises if a compression method is unknown or its package is missing.
+    """
+    if method not in ("zlib", "zstd"):
+        raise ValueError(f"Unknown compression method {method!r}, expected one of {available_methods()}")
+    if method == "zstd":
+        _require_zstd()
+
+
+def _is_zlib(data: bytes) -> bool:
+    # A zlib stream starts with a deflate method byte and a checksummed flag byte
+    return len(data) >= 2 and data[0] == 0x78 and (data[0] << 8 | data[1]) % 31 == 0
+
+
+def _require_zstd() -> None:
+    if zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package: pip install zstandard")
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Hashable
+
+
+class ConversationCache:
+    """
+    A thread-safe LRU cache of parsed conversations, bounded by approximate size
+    in bytes rather than by number of entries.
+
+    Every entry is stored with a version supplied by the caller, such as the
+    mtime and size of the files it was read from. A lookup only hits if the
+    caller's current version matches, so entries go stale as soon as the data on
+    disk changes, whoever changed it.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): Total approximate size of cached conversations
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # Key => (version, messages, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version: Hashable) -> Optional[List[Dict]]:
+        """
+        Returns a copy of the cached messages for key, or None if they are missing
+        or were cached under a different version.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key: str, version: Hashable, messages: List[Dict], size: int) -> None:
+        """
+        Caches a copy of messages, evicting the least recently used entries until
+        the cache fits in max_bytes. Conversations larger than the whole budget
+        are not cached.
+
+        Args:
+            size (int): What the entry is charged against max_bytes, such as the
+                length of the decoded data the messages were parsed from
+        """
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (version, list(messages), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns hit and miss counters along with the current size of the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
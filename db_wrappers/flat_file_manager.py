@@ -1,7 +1,23 @@
 import os
-import json
+import hashlib
+import mmap
 import shutil
-from typing import List
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+
+from db_wrappers import compression as compression_methods
+from db_wrappers.conversation_cache import ConversationCache
+from db_wrappers.file_lock import FileLock
+from db_wrappers.group_commit import GroupCommitter
+from db_wrappers.search_index import SearchHit, SearchIndex
+from db_wrappers.serialization import JsonLinesCodec, get_codec, json_codec, detect_codec
+from db_wrappers.tokens import context_window, newest_fitting, token_offsets
 
 
 class FlatFileManager:
@@ -9,17 +25,88 @@ class FlatFileManager:
     Manages storing and retrieving chat conversations in flat JSON files.
     """
 
-    def __init__(self, storage_dir="data"):
+    def __init__(self, storage_dir="data", log_compact_bytes=1 << 20, durable=False,
+                 commit_interval=0.005, commit_batch_size=256, index_checkpoint_every=10000,
+                 cache_bytes=None, shard_levels=0, shard_width=2, codec="json",
+                 compression=None, compress_min_bytes=64 * 1024, lock_stripes=1024, search=False,
+                 read_workers=None, parallel_read_min=64):
         """
         Initializes the FlatFileManager for a specific user.
 
         Args:
             storage_dir (str): The unique identifier for the user.
+            log_compact_bytes (int): Size at which a conversation's append log is
+                folded back into its JSON file. None disables automatic compaction.
+            durable (bool): If True, every write is fsynced before it returns.
+                Fsyncs from concurrent writers are grouped into shared commits.
+            commit_interval (float): Longest time in seconds a durable write waits
+                for other writes to join its group commit.
+            commit_batch_size (int): Number of waiting durable writes that triggers
+                a group commit without waiting for commit_interval.
+            index_checkpoint_every (int): Number of index journal entries after which
+                conversations.json is rewritten and the journal is cleared.
+            cache_bytes (int): If set, parsed conversations are kept in an LRU cache
+                of about this many bytes, each charged the size of its decoded,
+                uncompressed data. Entries are invalidated when the files change
+                on disk, including changes made by other processes.
+            shard_levels (int): Number of nested directories new conversation files
+                are spread across, named by hex prefixes of a hash of the
+                conversation ID. 0 keeps every file directly in storage_dir.
+            shard_width (int): Hex digits per directory level, so each level fans
+                out to 16 ** shard_width directories.
+            codec (str | Codec): Format for conversation files: "json" (compact,
+                standard library), "orjson" or "msgpack". Files are recognized by
+                their contents when read, so existing data of any format keeps
+                loading. Append logs and the index are always JSON.
+            compression (str): "zlib" or "zstd" to compress conversation files of at
+                least compress_min_bytes when they are written. None writes every
+                file uncompressed. Compressed files are read transparently either way.
+            compress_min_bytes (int): Size from which written files are compressed.
+            lock_stripes (int): Number of lock files that writes to individual
+                conversations are spread across. Writers in any process that hit
+                the same conversation take turns; other conversations proceed in
+                parallel unless they happen to share a stripe.
+            search (bool): If True, messages are added to a full-text SearchIndex in
+                storage_dir/search.db on every save and append, for search().
+                Build it for existing conversations with rebuild_search_index().
+            read_workers (int): Threads in the pool get_conversations() reads large
+                batches on, by default one per CPU up to 8. The pool is started on
+                first use and kept until close(). With a single worker every batch
+                is read in the calling thread.
+            parallel_read_min (int): Smallest batch get_conversations() spreads over
+                the pool. Smaller batches are read in the calling thread, where they
+                finish before a pool's hand-offs would pay for themselves.
         """
         self.storage_dir = storage_dir
+        self.log_compact_bytes = log_compact_bytes
+        self.index_checkpoint_every = index_checkpoint_every
+        self._journal_entries = 0
+        self._committer = GroupCommitter(commit_interval, commit_batch_size) if durable else None
+        self.cache = ConversationCache(cache_bytes) if cache_bytes else None
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        self._known_dirs = set()
+        self.codec = get_codec(codec)
+        self._json = self.codec if isinstance(self.codec, JsonLinesCodec) else json_codec()
+        if compression is not None:
+            compression_methods.check_method(compression)
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self.lock_stripes = lock_stripes
+        self._locks = {}
         self._ensure_storage_exists()
+        os.makedirs(os.path.join(self.storage_dir, ".locks"), exist_ok=True)
+        self._index_lock = FileLock(os.path.join(self.storage_dir, "conversations.lock"))
+        self._checkpoint_stamp = None
+        self._journal_ino = None
+        self._journal_offset = 0
         self.conversations_index = {}  # Key: conversation_id => Value: Filepath
         self._init_index()
+        self.search_index = SearchIndex(os.path.join(self.storage_dir, "search.db")) if search else None
+        self.read_workers = read_workers or min(8, os.cpu_count() or 1)
+        self.parallel_read_min = parallel_read_min
+        self._read_pool = None
+        self._read_pool_lock = threading.Lock()
 
     def _ensure_storage_exists(self) -> None:
         """
@@ -36,15 +123,69 @@ class FlatFileManager:
         1 - Check for the existence of self.storage_dir/conversations.json
         2 - If DNE, the create and save to disk using self.save_index()
         3 - Load the contents of conversations.json into self.conversations_index dictionary
+
+        conversations.json is only a checkpoint. Entries added since then are
+        replayed from the index journal on top of it.
+        """
+        index_file = os.path.join(self.storage_dir, "conversations.json")
+
+        with self._index_lock:
+            if not os.path.exists(index_file):
+                self.conversations_index = {}
+                self.save_index()
+            else:
+                self._load_index()
+
+    def _load_index(self) -> None:
+        """
+        Loads the index from the checkpoint and the whole journal. Callers hold the
+        index lock, so no other process can checkpoint in between.
         """
         index_file = os.path.join(self.storage_dir, "conversations.json")
+        with open(index_file, 'rb') as f:
+            self._checkpoint_stamp = self._stamp(os.fstat(f.fileno()))
+            self.conversations_index = self._json.loads(f.read())
+        self._journal_ino = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._replay_journal()
 
-        if not os.path.exists(index_file):
-            self.conversations_index = {}
-            self.save_index()
-        else:
-            with open(index_file, 'r') as f:
-                self.conversations_index = json.load(f)
+    def _refresh_index(self) -> None:
+        """
+        Picks up index entries written by other processes since this one last
+        looked. Usually that means replaying only the new end of the journal; if
+        another process has checkpointed meanwhile, the index is reloaded.
+
+        Index files are only changed under the index lock, so if they look exactly
+        as they did when this process last read them, nothing has been written
+        since and the lock is not needed.
+        """
+        checkpoint_stamp, journal = self._index_files()
+        if (checkpoint_stamp == self._checkpoint_stamp and
+                (journal is None or (journal.st_ino == self._journal_ino and journal.st_size == self._journal_offset))):
+            return
+
+        with self._index_lock:
+            checkpoint_stamp, journal = self._index_files()
+            if checkpoint_stamp == self._checkpoint_stamp:
+                if journal is None:
+                    return
+                if self._journal_ino in (None, journal.st_ino) and journal.st_size >= self._journal_offset:
+                    self._replay_journal()
+                    return
+            self._load_index()
+
+    def _index_files(self) -> Tuple[Optional[List[int]], Optional[os.stat_result]]:
+        """
+        Returns the stamp of conversations.json and the status of the journal, or
+        None for a journal that does not exist.
+        """
+        checkpoint_stamp = self._base_stamp(os.path.join(self.storage_dir, "conversations.json"))
+        try:
+            journal = os.stat(self._journal_path())
+        except FileNotFoundError:
+            journal = None
+        return checkpoint_stamp, journal
 
     def save_index(self) -> None:
         """
@@ -53,12 +194,93 @@ class FlatFileManager:
         to the conversations.json file in the storage directory.
         Ensure the JSON is human-readable by using proper formatting.
         Hint: Use json.dump() with the 'indent' parameter for readable formatting.
+
+        This is a checkpoint: once conversations.json holds the whole index, the
+        journal of individual changes is no longer needed and is removed. Entries
+        journaled by other processes are merged in first.
         """
         index_file = os.path.join(self.storage_dir, "conversations.json")
-        with open(index_file, 'w') as f:
-            json.dump(self.conversations_index, f, indent=2)
+        with self._index_lock:
+            if os.path.exists(index_file):
+                local_index = self.conversations_index
+                self._refresh_index()
+                if self.conversations_index is not local_index:
+                    # Reloaded after another process's checkpoint; keep entries
+                    # that so far only exist in this process
+                    for conversation_id, relative_filepath in local_index.items():
+                        self.conversations_index.setdefault(conversation_id, relative_filepath)
+
+            self._write_file(index_file, self._json.dumps(self.conversations_index))
+            try:
+                os.remove(self._journal_path())
+            except FileNotFoundError:
+                pass
+            self._checkpoint_stamp = self._stamp(os.stat(index_file))
+            self._journal_ino = None
+            self._journal_offset = 0
+            self._journal_entries = 0
+
+    def _journal_path(self) -> str:
+        return os.path.join(self.storage_dir, "conversations.journal")
+
+    def _set_index_entry(self, conversation_id: str, relative_filepath: Optional[str]) -> None:
+        """
+        Records a conversation's filepath in the index, or removes the conversation
+        from it when relative_filepath is None.
+
+        Only the changed entry is appended to the index journal, so the cost does
+        not grow with the number of conversations. Every index_checkpoint_every
+        entries the journal is folded into conversations.json by save_index().
+        Entries journaled by other processes are picked up first, so an entry is
+        only skipped if it already holds relative_filepath for every process.
+        """
+        record = self._json.dumps({"id": conversation_id, "path": relative_filepath}) + b"\n"
+        with self._index_lock:
+            self._refresh_index()
+            if self.conversations_index.get(conversation_id) == relative_filepath:
+                return
+            if relative_filepath is None:
+                self.conversations_index.pop(conversation_id, None)
+            else:
+                self.conversations_index[conversation_id] = relative_filepath
+            # Everything before the record was just replayed, so it is skipped too
+            self._journal_offset = self._append_lines(self._journal_path(), record)
+            self._journal_entries += 1
+            if self._journal_entries >= self.index_checkpoint_every:
+                self.save_index()
+
+    def _replay_journal(self) -> None:
+        """
+        Applies index journal entries past the point already read to the index.
+        Replaying is idempotent, so a journal that survived a crash during a
+        checkpoint is harmless. A final line that is torn, or still being
+        written by another process, is left for the next replay.
+        """
+        try:
+            with open(self._journal_path(), 'rb') as f:
+                self._journal_ino = os.fstat(f.fileno()).st_ino
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        complete = data.rfind(b"\n") + 1
+        self._journal_offset += complete
+        for line in data[:complete].split(b"\n"):
+            if not line:
+                continue
+            try:
+                record = self._json.loads(line)
+            except ValueError:
+                continue
+            if record["path"] is None:
+                self.conversations_index.pop(record["id"], None)
+            else:
+                self.conversations_index[record["id"]] = record["path"]
+            self._journal_entries += 1
 
-    def get_conversation(self, conversation_id: str) -> List[any]:
+    def get_conversation(self, conversation_id: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[any]:
         """
         --- TODO 4: Retrieve a user's conversation ---
         1 - Find the filepath in the conversations index
@@ -67,18 +289,228 @@ class FlatFileManager:
             - If the file exists, load the JSON data and return it.
             - If the file does not exist it should return an empty list `[]` without raising an error.
             Hint: Use a try-except block to handle error case.
+
+        Args:
+            conversation_id (str): The conversation to read
+            offset (int): Index of the first message to return
+            limit (int): Maximum number of messages to return
+
+        When offset or limit is given, only the requested messages are parsed,
+        using the conversation's offset index to locate them in the file.
         """
-        if conversation_id not in self.conversations_index:
+        filepath = self._filepath(conversation_id)
+        if filepath is None:
             return []
 
-        filepath = os.path.join(self.storage_dir, self.conversations_index[conversation_id])
+        start = offset or 0
+        stop = None if limit is None else start + limit
+        return self._read(conversation_id, filepath, start, stop)
+
+    def get_conversations(self, conversation_ids: Iterable[str],
+                          max_workers: Optional[int] = None) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        Reads several conversations, yielding each (conversation_id, messages)
+        pair. Batches of at least parallel_read_min conversations are read in
+        parallel on the manager's thread pool and yielded as soon as each file has
+        been read, so results arrive in completion order rather than request
+        order; smaller batches are read one after another in the calling thread.
+        Unknown conversations yield an empty list.
+
+        Args:
+            conversation_ids (Iterable[str]): The conversations to read
+            max_workers (int): Maximum number of files read at once, up to
+                read_workers, which is also the default
+        """
+        conversation_ids = list(dict.fromkeys(conversation_ids))
+        max_workers = min(max_workers or self.read_workers, self.read_workers)
+        if len(conversation_ids) < self.parallel_read_min or max_workers < 2:
+            for conversation_id in conversation_ids:
+                yield conversation_id, self.get_conversation(conversation_id)
+            return
+
+        with self._read_pool_lock:
+            if self._read_pool is None:
+                self._read_pool = ThreadPoolExecutor(max_workers=self.read_workers,
+                                                     thread_name_prefix="flat-file-read")
+        # Each worker reads a share of the batch rather than one file per task,
+        # so results cost a queue hand-off instead of a future apiece
+        results = SimpleQueue()
+        abandoned = threading.Event()
+
+        def read_share(share: List[str]) -> None:
+            for conversation_id in share:
+                if abandoned.is_set():
+                    return
+                try:
+                    results.put((conversation_id, self.get_conversation(conversation_id), None))
+                except Exception as e:
+                    results.put((conversation_id, None, e))
+                    return
 
+        for worker in range(max_workers):
+            self._read_pool.submit(read_share, conversation_ids[worker::max_workers])
         try:
-            with open(filepath, 'r') as f:
-                messages = json.load(f)
-            return messages
-        except FileNotFoundError:
+            for _ in conversation_ids:
+                conversation_id, messages, error = results.get()
+                if error is not None:
+                    raise error
+                yield conversation_id, messages
+        finally:
+            # Stops the remaining reads if the caller abandons the results early
+            abandoned.set()
+
+    def tail(self, conversation_id: str, n: int) -> List[Dict]:
+        """
+        Returns the last n messages of a conversation, parsing only those messages.
+        """
+        filepath = self._filepath(conversation_id) if n > 0 else None
+        if filepath is None:
+            return []
+        return self._read(conversation_id, filepath, -n, None)
+
+    def get_context_window(self, conversation_id: str, max_tokens: int) -> List[Dict]:
+        """
+        Returns the newest messages of a conversation whose estimated tokens add
+        up to at most max_tokens, oldest first; what an LLM is sent each turn.
+
+        Every JSON file is written with a token index holding the running token
+        count of its messages, so the first message of the window is found by a
+        binary search and only the messages in the window are parsed, along with
+        the append log. See tokens.estimate_tokens() for the estimate.
+        """
+        filepath = self._filepath(conversation_id) if max_tokens > 0 else None
+        if filepath is None:
             return []
+        if self.cache is not None:
+            messages = self.cache.get(conversation_id, self._cache_version(filepath))
+            if messages is not None:
+                return context_window(messages, max_tokens)
+        return self._read_window(filepath, None, None, max_tokens)
+
+    def list_conversations(self, prefix: str = "") -> List[str]:
+        """
+        Returns the IDs of all conversations starting with prefix, including ones
+        created by other processes.
+        """
+        self._refresh_index()
+        return [conversation_id for conversation_id in list(self.conversations_index)
+                if conversation_id.startswith(prefix)]
+
+    def last_modified(self, conversation_id: str) -> Optional[float]:
+        """
+        Returns when a conversation was last written to, as a Unix timestamp, or
+        None if it does not exist.
+        """
+        filepath = self._filepath(conversation_id)
+        if filepath is None:
+            return None
+        times = []
+        for path in (filepath, self._log_path(filepath)):
+            try:
+                times.append(os.path.getmtime(path))
+            except FileNotFoundError:
+                continue
+        return max(times, default=None)
+
+    def _is_indexed(self, conversation_id: str) -> bool:
+        """
+        Checks the index for a conversation, looking for entries added by other
+        processes before concluding that it does not exist.
+        """
+        if conversation_id not in self.conversations_index:
+            self._refresh_index()
+        return conversation_id in self.conversations_index
+
+    def _filepath(self, conversation_id: str) -> Optional[str]:
+        """
+        Returns the path of a conversation's JSON file for reading, or None if the
+        conversation does not exist. If neither the file nor its append log is
+        where this process's index says, another process may have deleted the
+        conversation or saved it under a new path, so the index is refreshed and
+        the path looked up again.
+        """
+        if not self._is_indexed(conversation_id):
+            return None
+        filepath = os.path.join(self.storage_dir, self.conversations_index[conversation_id])
+        if os.path.exists(filepath) or os.path.exists(self._log_path(filepath)):
+            return filepath
+        self._refresh_index()
+        relative_filepath = self.conversations_index.get(conversation_id)
+        return None if relative_filepath is None else os.path.join(self.storage_dir, relative_filepath)
+
+    def _current_entry(self, conversation_id: str) -> Optional[str]:
+        """
+        Returns a conversation's relative filepath as last recorded by any
+        process, or None if it does not exist. Writers call it while holding the
+        conversation lock, so no other process can move or delete the
+        conversation until they are done.
+        """
+        self._refresh_index()
+        return self.conversations_index.get(conversation_id)
+
+    def conversation_lock(self, conversation_id: str) -> FileLock:
+        """
+        Returns the lock that serializes writes to a conversation across threads
+        and processes. Every write method takes it internally; callers hold it to
+        make a read-modify-write cycle atomic:
+
+            with manager.conversation_lock(conversation_id):
+                messages = manager.get_conversation(conversation_id)
+                ...
+                manager.save_conversation(conversation_id, filepath, messages)
+
+        The lock is reentrant within a thread.
+        """
+        digest = hashlib.sha1(conversation_id.encode()).hexdigest()
+        stripe = int(digest[:8], 16) % self.lock_stripes
+        lock = self._locks.get(stripe)
+        if lock is None:
+            path = os.path.join(self.storage_dir, ".locks", f"{stripe:04x}.lock")
+            lock = self._locks.setdefault(stripe, FileLock(path))
+        return lock
+
+    def _read(self, conversation_id: str, filepath: str, start: int, stop: Optional[int]) -> List[Dict]:
+        """
+        Returns messages[start:stop] of the conversation stored at filepath, from
+        the cache if it holds the current version. Full reads populate the cache;
+        paged reads that miss it go to disk without parsing the whole conversation.
+        """
+        whole = start == 0 and stop is None
+
+        if self.cache is not None:
+            version = self._cache_version(filepath)
+            messages = self.cache.get(conversation_id, version)
+            if messages is not None:
+                return messages if whole else messages[start:stop]
+
+        if not whole:
+            return self._read_window(filepath, start, stop)
+
+        messages, stamp, size = self._read_base(filepath)
+        log_lines = self._read_log_lines(filepath, stamp)
+        messages.extend(self._json.loads(line) for line in log_lines)
+
+        if self.cache is not None:
+            # Charged by the decoded data rather than the files, which may be
+            # compressed or msgpack and so far smaller than the parsed messages
+            size += sum(len(line) for line in log_lines)
+            self.cache.put(conversation_id, version, messages, size)
+        return messages
+
+    def _cache_version(self, filepath: str) -> tuple:
+        """
+        Returns the identity of a conversation's JSON file and append log as they
+        are on disk now.
+        """
+        version = []
+        for path in (filepath, self._log_path(filepath)):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                version.append(None)
+                continue
+            version.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        return tuple(version)
 
     def save_conversation(self, conversation_id: str, relative_filepath: str, messages: List[any]) -> None:
         """
@@ -91,16 +523,556 @@ class FlatFileManager:
             - Use JSON formatting to make the file human-readable (e.g., indentation).
             Hint: Use `json.dump()` with the `indent` parameter.
         """
-        # Add to index
-        self.conversations_index[conversation_id] = relative_filepath
+        with self.conversation_lock(conversation_id):
+            relative_filepath = self._shard_path(conversation_id, relative_filepath)
+            previous_filepath = self._current_entry(conversation_id)
+
+            # Save conversation to disk
+            filepath = os.path.join(self.storage_dir, relative_filepath)
+            self._ensure_parent_exists(filepath)
+            self._write_base(filepath, messages)
+
+            # Add to index and journal the change to disk
+            self._set_index_entry(conversation_id, relative_filepath)
+            if previous_filepath is not None and previous_filepath != relative_filepath:
+                self._remove_files(os.path.join(self.storage_dir, previous_filepath))
+            if self.cache is not None:
+                self.cache.invalidate(conversation_id)
+            if self.search_index is not None:
+                self.search_index.replace_conversation(conversation_id, messages)
+
+    def append_message(self, conversation_id: str, message: Dict, relative_filepath: Optional[str] = None) -> None:
+        """
+        Appends a single message to a conversation. See append_messages().
+        """
+        self.append_messages(conversation_id, [message], relative_filepath)
+
+    def append_messages(self, conversation_id: str, messages: List[Dict],
+                        relative_filepath: Optional[str] = None) -> None:
+        """
+        Appends messages to a conversation without rewriting it.
+
+        New messages go to an append-only JSON Lines log next to the conversation
+        file, so the cost of a turn does not depend on the length of the thread.
+        The log is folded back into the JSON file by compact_conversation(), which
+        runs automatically once the log grows past log_compact_bytes.
+
+        Args:
+            conversation_id (str): The conversation to append to
+            messages (List[Dict]): Messages to append, in order
+            relative_filepath (str): Filepath to use if the conversation is new.
+                Defaults to "<conversation_id>.json".
+        """
+        lines = b"".join(self._json.dumps(message) + b"\n" for message in messages)
+        with self.conversation_lock(conversation_id):
+            current_filepath = self._current_entry(conversation_id)
+            if current_filepath is None:
+                current_filepath = self._shard_path(conversation_id,
+                                                    relative_filepath or f"{conversation_id}.json")
+                self._ensure_parent_exists(os.path.join(self.storage_dir, current_filepath))
+                self._set_index_entry(conversation_id, current_filepath)
+
+            if not messages:
+                return
+
+            filepath = os.path.join(self.storage_dir, current_filepath)
+            # A fresh log records which version of the JSON file it extends
+            header = self._json.dumps({"base": self._base_stamp(filepath)}) + b"\n"
+            log_size = self._append_lines(self._log_path(filepath), lines, header)
+            if self.cache is not None:
+                self.cache.invalidate(conversation_id)
+            if self.search_index is not None:
+                self.search_index.append_messages(conversation_id, messages)
+
+            if self.log_compact_bytes is not None and log_size >= self.log_compact_bytes:
+                self.compact_conversation(conversation_id)
+
+    def delete_conversation(self, conversation_id: str) -> bool:
+        """
+        Deletes a conversation's files and removes it from the index.
+
+        Returns:
+            bool: True if the conversation existed
+        """
+        with self.conversation_lock(conversation_id):
+            relative_filepath = self._current_entry(conversation_id)
+            if relative_filepath is None:
+                return False
+            filepath = os.path.join(self.storage_dir, relative_filepath)
+            self._set_index_entry(conversation_id, None)
+            self._remove_files(filepath)
+            if self.cache is not None:
+                self.cache.invalidate(conversation_id)
+            if self.search_index is not None:
+                self.search_index.remove_conversation(conversation_id)
+            return True
+
+    def search(self, query: str, limit: int = 20, conversation_prefix: Optional[str] = None) -> List[SearchHit]:
+        """
+        Searches every conversation for messages containing the query's terms and
+        "quoted phrases", best matches first. Requires search=True.
+
+        Args:
+            query (str): Terms and phrases, e.g. 'refund "order number"'
+            limit (int): Maximum number of hits to return
+            conversation_prefix (str): Only search conversations whose ID starts with this
+
+        Returns:
+            List[SearchHit]: (conversation_id, message_index, score, snippet) of each match
+        """
+        if self.search_index is None:
+            raise RuntimeError("Search is not enabled; create the FlatFileManager with search=True")
+        return self.search_index.search(query, limit, conversation_prefix)
+
+    def rebuild_search_index(self, workers: int = 8) -> int:
+        """
+        Re-indexes every conversation from scratch. See SearchIndex.rebuild().
+
+        Returns:
+            int: Number of messages indexed
+        """
+        if self.search_index is None:
+            raise RuntimeError("Search is not enabled; create the FlatFileManager with search=True")
+        return self.search_index.rebuild(self, workers)
+
+    def compact_conversation(self, conversation_id: str) -> None:
+        """
+        Folds a conversation's append log into its JSON file and removes the log.
+
+        The JSON file is rewritten before the log is deleted. If the process dies
+        in between, the leftover log no longer matches the JSON file it was started
+        against and is ignored by readers, so messages are never duplicated.
+        """
+        with self.conversation_lock(conversation_id):
+            relative_filepath = self._current_entry(conversation_id)
+            if relative_filepath is None:
+                return
+            filepath = os.path.join(self.storage_dir, relative_filepath)
+            log_path = self._log_path(filepath)
+            if not os.path.exists(log_path):
+                return
+
+            self._write_base(filepath, self.get_conversation(conversation_id))
+            if self.cache is not None:
+                self.cache.invalidate(conversation_id)
+
+    def compact(self) -> None:
+        """
+        Compacts every conversation that has a pending append log.
+        """
+        self._refresh_index()
+        for conversation_id in list(self.conversations_index):
+            self.compact_conversation(conversation_id)
+
+    def migrate_to_sharded(self) -> int:
+        """
+        Moves existing conversation files into the sharded layout and returns the
+        number of conversations moved. Requires shard_levels > 0.
+
+        Each conversation is compacted, hard-linked (or rewritten, where links are
+        unsupported) at its sharded path, repointed in the index, and only then
+        removed from its old path. The index refers to a complete file at every
+        step, so the migration can be interrupted and simply run again.
+        """
+        if self.shard_levels <= 0:
+            raise ValueError("migrate_to_sharded() requires shard_levels > 0")
+
+        moved = 0
+        self._refresh_index()
+        for conversation_id in list(self.conversations_index):
+            prefix = self._shard_prefix(conversation_id)
+            with self.conversation_lock(conversation_id):
+                # Another process may have moved or deleted it since the listing
+                relative_filepath = self._current_entry(conversation_id)
+                if relative_filepath is None or relative_filepath.startswith(prefix):
+                    continue
+
+                self.compact_conversation(conversation_id)
+                old_filepath = os.path.join(self.storage_dir, relative_filepath)
+                new_relative_filepath = prefix + relative_filepath
+                new_filepath = os.path.join(self.storage_dir, new_relative_filepath)
+                self._ensure_parent_exists(new_filepath)
+
+                # Leftovers from an interrupted run are not referenced by the index
+                self._remove_files(new_filepath)
+                try:
+                    if os.path.exists(old_filepath):
+                        os.link(old_filepath, new_filepath)
+                        for index_path in (self._offsets_path, self._tokens_path):
+                            if os.path.exists(index_path(old_filepath)):
+                                os.link(index_path(old_filepath), index_path(new_filepath))
+                except OSError:
+                    self._write_base(new_filepath, self.get_conversation(conversation_id))
+
+                self._set_index_entry(conversation_id, new_relative_filepath)
+                self._remove_files(old_filepath)
+                if self.cache is not None:
+                    self.cache.invalidate(conversation_id)
+                moved += 1
 
-        # Save index to disk
         self.save_index()
+        return moved
+
+    def compress_cold_files(self, idle_days: Optional[float] = None, min_bytes: Optional[int] = None,
+                            method: Optional[str] = None) -> int:
+        """
+        Compresses every uncompressed conversation file that is at least min_bytes
+        in size or has not been written for idle_days, and returns how many were
+        compressed. Pending append logs are folded in first. Reads keep working
+        unchanged; the next compaction of a file that has gone hot again writes
+        it back according to the normal compress_min_bytes policy.
+
+        Args:
+            idle_days (float): Compress files untouched for this many days
+            min_bytes (int): Compress files at least this large. Defaults to
+                compress_min_bytes.
+            method (str): "zlib" or "zstd". Defaults to the manager's compression,
+                or to zstd if it is installed and zlib otherwise.
+        """
+        method = method or self.compression or compression_methods.available_methods()[-1]
+        compression_methods.check_method(method)
+        min_bytes = self.compress_min_bytes if min_bytes is None else min_bytes
+        idle_before = None if idle_days is None else time.time() - idle_days * 86400
+
+        compressed = 0
+        self._refresh_index()
+        for conversation_id in list(self.conversations_index):
+            with self.conversation_lock(conversation_id):
+                relative_filepath = self._current_entry(conversation_id)
+                if relative_filepath is None:
+                    continue
+                filepath = os.path.join(self.storage_dir, relative_filepath)
+                try:
+                    with open(filepath, 'rb') as f:
+                        if compression_methods.is_compressed(f.read(4)):
+                            continue
+                    size = os.path.getsize(filepath)
+                    last_write = max(os.path.getmtime(path) for path in (filepath, self._log_path(filepath))
+                                     if os.path.exists(path))
+                except FileNotFoundError:
+                    continue
+
+                if size < min_bytes and (idle_before is None or last_write > idle_before):
+                    continue
+
+                self._write_base(filepath, self.get_conversation(conversation_id), compress=method)
+                if self.cache is not None:
+                    self.cache.invalidate(conversation_id)
+                compressed += 1
+        return compressed
+
+    def _shard_prefix(self, conversation_id: str) -> str:
+        """
+        Returns the shard directories for a conversation, e.g. "3f/a9/", or "" when
+        sharding is off.
+        """
+        if self.shard_levels <= 0:
+            return ""
+        digest = hashlib.sha1(conversation_id.encode()).hexdigest()
+        width = self.shard_width
+        return "".join(digest[level * width:(level + 1) * width] + "/" for level in range(self.shard_levels))
+
+    def _shard_path(self, conversation_id: str, relative_filepath: str) -> str:
+        prefix = self._shard_prefix(conversation_id)
+        if relative_filepath.startswith(prefix):
+            return relative_filepath
+        return prefix + relative_filepath
+
+    def _ensure_parent_exists(self, filepath: str) -> None:
+        directory = os.path.dirname(filepath)
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+
+    def _remove_files(self, filepath: str) -> None:
+        """
+        Removes a conversation's JSON file together with its append log, offset
+        index and token index, ignoring any that do not exist.
+        """
+        for path in (filepath, self._log_path(filepath), self._offsets_path(filepath), self._tokens_path(filepath)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _log_path(filepath: str) -> str:
+        return filepath + ".log"
+
+    @staticmethod
+    def _offsets_path(filepath: str) -> str:
+        return filepath + ".idx"
+
+    @staticmethod
+    def _tokens_path(filepath: str) -> str:
+        return filepath + ".tok"
+
+    @staticmethod
+    def _base_stamp(filepath: str) -> Optional[List[int]]:
+        """
+        Identifies the current version of a conversation's JSON file. Every rewrite
+        produces a new stamp, which is how stale append logs are detected.
+        """
+        try:
+            return FlatFileManager._stamp(os.stat(filepath))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _stamp(st: os.stat_result) -> List[int]:
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _append_lines(self, path: str, lines: bytes, header: bytes = b"") -> int:
+        """
+        Appends newline-terminated records to a log file and returns its new size.
+        The header is written first if the file is new. In durable mode this
+        returns once the records are on disk.
+
+        A record torn by an earlier crash is cut off first, so every complete line
+        in a log is a valid record and only an unterminated last line can be torn.
+        """
+        data = lines
+        with open(path, 'ab+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = _last_line_end(f, size)
+            if end != size:
+                f.truncate(end)
+            if end == 0:
+                data = header + data
+            f.write(data)
+            size = f.tell()
 
-        # Save conversation to disk
-        filepath = os.path.join(self.storage_dir, relative_filepath)
-        with open(filepath, 'w') as f:
-            json.dump(messages, f, indent=2)
+        if self._committer is not None:
+            self._committer.commit(path)
+        return size
+
+    def _write_base(self, filepath: str, messages: List[Dict], compress: Optional[str] = None) -> None:
+        """
+        Writes the full message list to the conversation's JSON file and drops any
+        append log, whose contents are now either included or superseded.
+
+        The file is written with the manager's codec, which places every message in
+        its own byte range. Those offsets are saved to an offset index next to the
+        file, stamped with the version of the file they describe, so paged reads
+        can find messages without parsing.
+
+        Files of at least compress_min_bytes are compressed if compression is
+        enabled, or always if a method is passed in compress. Compressed files have
+        no offset index, so paged reads of them decompress the whole file.
+
+        A token index, holding the running token count of the messages, is saved
+        the same way for every file; get_context_window() uses it to find where
+        the newest max_tokens begin.
+        """
+        data, offsets = self.codec.encode_messages(messages)
+        if compress is None and len(data) >= self.compress_min_bytes:
+            compress = self.compression
+        if compress is not None:
+            data = compression_methods.compress(data, compress)
+        self._write_file(filepath, data)
+        try:
+            os.remove(self._log_path(filepath))
+        except FileNotFoundError:
+            pass
+
+        # Indexes are written after the rename so they can carry the new file's
+        # stamp. If one is lost in a crash, readers fall back to parsing the file.
+        stamp = array('Q', self._base_stamp(filepath))
+        with open(self._tokens_path(filepath), 'wb') as f:
+            stamp.tofile(f)
+            array('Q', token_offsets(messages)).tofile(f)
+
+        if compress is not None:
+            try:
+                os.remove(self._offsets_path(filepath))
+            except FileNotFoundError:
+                pass
+            return
+
+        with open(self._offsets_path(filepath), 'wb') as f:
+            stamp.tofile(f)
+            offsets.tofile(f)
+
+    def _read_offsets(self, filepath: str, base_stamp: Optional[List[int]]) -> Optional[array]:
+        """
+        Loads the offset index of a conversation's JSON file. Entry i is where
+        message i starts; see Codec for the exact layout. Returns None if the index
+        is missing or does not describe the version of the file with base_stamp.
+        """
+        return self._read_stamped_index(self._offsets_path(filepath), base_stamp)
+
+    def _read_token_offsets(self, filepath: str, base_stamp: Optional[List[int]]) -> Optional[array]:
+        """
+        Loads the token index of a conversation's JSON file. Entry i is the number
+        of tokens before message i, and the last entry the total; see
+        tokens.token_offsets(). Returns None like _read_offsets().
+        """
+        return self._read_stamped_index(self._tokens_path(filepath), base_stamp)
+
+    @staticmethod
+    def _read_stamped_index(path: str, base_stamp: Optional[List[int]]) -> Optional[array]:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) % 8 or len(data) < 32:
+            return None
+
+        entries = array('Q')
+        entries.frombytes(data)
+        stamp, offsets = entries[:3], entries[3:]
+        if stamp.tolist() != base_stamp:
+            return None
+        return offsets
+
+    def _read_base(self, filepath: str) -> Tuple[List[Dict], Optional[List[int]], int]:
+        """
+        Reads every message in a conversation's JSON file, whatever codec wrote it
+        and whether or not it is compressed. Also returns the stamp of the version
+        that was read, so the matching append log can be found even if the file
+        is replaced concurrently, and the size of the data once decompressed.
+        """
+        try:
+            with open(filepath, 'rb') as f:
+                stamp = self._stamp(os.fstat(f.fileno()))
+                data = f.read()
+        except FileNotFoundError:
+            return [], None, 0
+        data = compression_methods.decompress(data)
+        return detect_codec(data).decode_messages(data), stamp, len(data)
+
+    def _read_window(self, filepath: str, start: Optional[int], stop: Optional[int],
+                     max_tokens: Optional[int] = None) -> List[Dict]:
+        """
+        Returns messages[start:stop] of a conversation, parsing only those
+        messages. Messages in the JSON file are sliced out of a memory map using
+        the offset index; files without a valid index are parsed in full.
+
+        With max_tokens, the window is instead the newest messages that fit in
+        max_tokens, located with the token index. The version of the file read is
+        the same for both indexes and the messages, even if it is being replaced.
+        """
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:
+            log_lines = self._read_log_lines(filepath, None)
+            if max_tokens is None:
+                return [self._json.loads(line) for line in log_lines[start:stop]]
+            return context_window([self._json.loads(line) for line in log_lines], max_tokens)
+
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            stamp = self._stamp(os.fstat(f.fileno()))
+            log_lines = self._read_log_lines(filepath, stamp)
+            offsets = self._read_offsets(filepath, stamp)
+
+            if compression_methods.is_compressed(mm[:4]):
+                data = compression_methods.decompress(mm[:])
+                codec = detect_codec(data)
+                offsets = None
+            else:
+                data = mm
+                codec = detect_codec(mm[:1])
+
+            if offsets is not None and offsets[-1] + codec.trailer_size == len(mm):
+                base = None
+                base_count = len(offsets) - 1
+            else:
+                # Compressed file, or a missing, out of date or torn offset index
+                base = codec.decode_messages(data[:])
+                base_count = len(base)
+
+            log_messages = None
+            if max_tokens is not None:
+                log_messages = [self._json.loads(line) for line in log_lines]
+                in_log, used = newest_fitting(log_messages, max_tokens)
+                if in_log < len(log_messages):
+                    start = base_count + len(log_messages) - in_log
+                else:
+                    tokens = self._read_token_offsets(filepath, stamp)
+                    if tokens is not None and len(tokens) == base_count + 1:
+                        # The first message with at most max_tokens from its start to the end
+                        start = bisect_left(tokens, tokens[-1] - (max_tokens - used), 0, base_count)
+                    else:
+                        if base is None:
+                            base = codec.decode_messages(data[:])
+                        in_base, _ = newest_fitting(base, max_tokens - used)
+                        start = base_count - in_base
+                stop = None
+
+            start, stop, _ = slice(start, stop).indices(base_count + len(log_lines))
+            base_stop = min(stop, base_count)
+            if base is not None:
+                messages = base[start:base_stop]
+            else:
+                gap = codec.item_gap
+                messages = [codec.decode_item(mm[offsets[i]:offsets[i + 1] - gap]) for i in range(start, base_stop)]
+
+        if log_messages is not None:
+            messages.extend(log_messages[max(start - base_count, 0):max(stop - base_count, 0)])
+            return messages
+        for line in log_lines[max(start - base_count, 0):max(stop - base_count, 0)]:
+            messages.append(self._json.loads(line))
+        return messages
+
+    def _write_file(self, filepath: str, data: bytes) -> None:
+        """
+        Atomically replaces filepath with data.
+
+        The new contents are written to a uniquely named temporary file and renamed
+        over the target, so a crash leaves either the old or the new file but never
+        a truncated one, and every rewrite gets a fresh stamp. In durable mode the
+        rename happens in a group commit once the data is on disk.
+        """
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'xb') as f:
+                f.write(data)
+            if self._committer is not None:
+                self._committer.commit(tmp_path, replace_to=filepath)
+            else:
+                os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def close(self) -> None:
+        """
+        Waits for outstanding durable writes, stops the group commit thread and
+        the read pool, and closes the search index.
+        """
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
+        if self._read_pool is not None:
+            self._read_pool.shutdown(wait=True, cancel_futures=True)
+            self._read_pool = None
+        if self.search_index is not None:
+            self.search_index.close()
+
+    def _read_log_lines(self, filepath: str, base_stamp: Optional[List[int]]) -> List[bytes]:
+        """
+        Returns the unparsed records appended to the version of a conversation's
+        JSON file with base_stamp. Returns [] if there is no log or it extends a
+        different version of the file. A final line torn by a crash, or still
+        being written, is skipped.
+        """
+        try:
+            with open(self._log_path(filepath), 'rb') as f:
+                lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            return []
+
+        try:
+            header = self._json.loads(lines[0])
+        except ValueError:
+            return []
+        if header.get("base") != base_stamp:
+            return []
+
+        # Everything after the last newline is either empty or a torn record
+        return lines[1:-1]
 
     def run_tests(self):
         print("Testing FlatFileManager._ensure_storage_exists()")
@@ -128,6 +1100,39 @@ class FlatFileManager:
             return
         print("Successfully retrieved conversation!")
 
+        print("Testing FlatFileManager.append_messages()")
+        self.append_messages(conversation_id, [{"role": "assistant", "content": "hi"}])
+        if len(self.get_conversation(conversation_id)) != 2:
+            print("Failed to append messages!")
+            return
+        self.compact_conversation(conversation_id)
+        if len(self.get_conversation(conversation_id)) != 2:
+            print("Failed to compact conversation!")
+            return
+        print("Successfully appended messages!")
+
+        print("Testing FlatFileManager.tail()")
+        if self.tail(conversation_id, 1) != [{"role": "assistant", "content": "hi"}]:
+            print("Failed to read the tail of the conversation!")
+            return
+        print("Successfully read the tail of the conversation!")
+
+        print("Testing FlatFileManager.get_context_window()")
+        if (self.get_context_window(conversation_id, 6) != [{"role": "assistant", "content": "hi"}]
+                or len(self.get_context_window(conversation_id, 12)) != 2):
+            print("Failed to read the context window!")
+            return
+        print("Successfully read the context window!")
+
+        if self.search_index is not None:
+            print("Testing FlatFileManager.search()")
+            hits = self.search('"hello world"')
+            if [(hit.conversation_id, hit.message_index) for hit in hits] != [(conversation_id, 0)]:
+                print("Failed to search conversations!")
+                return
+            print("Successfully searched conversations!")
+            self.close()
+
         try:
             shutil.rmtree(self.storage_dir)
             print("Deleted storage directory")
@@ -137,7 +1142,25 @@ class FlatFileManager:
         print("All tests passed!")
 
 
+def _last_line_end(f, size: int) -> int:
+    """
+    Returns the position just after the last newline in a binary file, or 0 if
+    it has none, reading backwards from size.
+    """
+    position = size
+    while position > 0:
+        start = max(0, position - 4096)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b"\n")
+        if newline != -1:
+            return start + newline + 1
+        position = start
+    return 0
+
+
 if __name__ == "__main__":
+    # Run from the repository root as a module, so db_wrappers is importable:
+    #     python -m db_wrappers.flat_file_manager
     print("Testing FlatFileManager")
-    manager = FlatFileManager(storage_dir="data_test")
+    manager = FlatFileManager(storage_dir="data_test", search=True)
     manager.run_tests()
\ No newline at end of file
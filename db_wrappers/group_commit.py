@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from typing import Optional
+
+
+class _Commit:
+    """
+    A single file waiting to be made durable, optionally renamed into place.
+    """
+
+    def __init__(self, path: str, replace_to: Optional[str]):
+        self.path = path
+        self.replace_to = replace_to
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitter:
+    """
+    Batches fsyncs from many writers into group commits.
+
+    Writers hand over a file they have finished writing and block until it is
+    durable. A background thread collects requests until either max_delay seconds
+    have passed since the oldest one arrived or max_batch requests are waiting,
+    then syncs them together: each distinct file is fsynced once, temporary files
+    are renamed over their targets in arrival order, and every directory touched
+    by a rename is fsynced once for the whole batch.
+    """
+
+    def __init__(self, max_delay: float = 0.005, max_batch: int = 256):
+        """
+        Args:
+            max_delay (float): Longest time in seconds a write waits for its group
+            max_batch (int): Number of waiting writes that triggers an early flush
+        """
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.commits = 0
+        self._pending = []
+        self._oldest = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def commit(self, path: str, replace_to: Optional[str] = None) -> None:
+        """
+        Blocks until the contents of path are on stable storage.
+
+        Args:
+            path (str): A file whose writes have been flushed to the OS
+            replace_to (str): If given, path is a temporary file that is atomically
+                renamed to replace_to once it is durable
+        """
+        entry = _Commit(path, replace_to)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("GroupCommitter is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append(entry)
+            self._cond.notify()
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def close(self) -> None:
+        """
+        Flushes any waiting writes and stops the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                if self._pending:
+                    self._oldest = time.monotonic()
+            self._sync(batch)
+
+    def _sync(self, batch) -> None:
+        synced = set()
+        directories = {}
+        for entry in batch:
+            try:
+                if entry.path not in synced:
+                    _fsync_path(entry.path)
+                    synced.add(entry.path)
+                if entry.replace_to is not None:
+                    os.replace(entry.path, entry.replace_to)
+                    directories.setdefault(_directory_of(entry.replace_to), []).append(entry)
+            except OSError as e:
+                entry.error = e
+
+        for directory, entries in directories.items():
+            try:
+                _fsync_directory(directory)
+            except OSError as e:
+                for entry in entries:
+                    entry.error = e
+
+        self.batches += 1
+        self.commits += len(batch)
+        for entry in batch:
+            entry.done.set()
+
+
+def _directory_of(path: str) -> str:
+    return os.path.dirname(os.path.abspath(path))
+
+
+def _fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(directory: str) -> None:
+    # Directory entries cannot be opened or synced on Windows; renames there are
+    # made durable by the filesystem journal instead.
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,366 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import ReplaceOne
+
+from db_wrappers.backends import _thread_filepath, _thread_from_filepath
+from db_wrappers.flat_file_manager import FlatFileManager
+from db_wrappers.mongodb_manager import (ARCHIVED_FIELD, ArchivedConversationError, MongoDBManager,
+                                         _conversation_document)
+
+
+def split_conversation_id(conversation_id: str) -> Tuple[str, str]:
+    """
+    Maps a flat-file conversation ID to a MongoDB (user_id, thread_name) pair,
+    the inverse of MongoDBManager's f"{user_id}_{thread_name}" document IDs. IDs
+    without an underscore become the "default" thread of a user of that name.
+    """
+    user_id, separator, thread_name = conversation_id.partition("_")
+    if not separator:
+        return conversation_id, "default"
+    return user_id, thread_name
+
+
+class MigrationProgress:
+    """
+    Counts migrated conversations and messages, and archived conversations
+    skipped, prints throughput every report_every seconds, and records how far the migration got in a checkpoint
+    file so that an interrupted run can resume.
+    """
+
+    def __init__(self, direction: str, checkpoint_path: Optional[str] = None, report_every: float = 5.0,
+                 report: Callable[[str], None] = print):
+        """
+        Args:
+            direction (str): Which way the data is moving, stored in the checkpoint
+            checkpoint_path (str): JSON file to resume from and save progress to, or
+                None to always start from the beginning
+            report_every (float): Seconds between progress reports
+            report (Callable): Receives each progress line
+        """
+        self.direction = direction
+        self.checkpoint_path = checkpoint_path
+        self.report_every = report_every
+        self.conversations = 0
+        self.messages = 0
+        self.skipped = 0
+        self.after = None
+        self._report = report
+        self._started = time.perf_counter()
+        self._last_report = self._started
+
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("direction") != direction:
+                raise ValueError(f"Checkpoint {checkpoint_path} belongs to a {checkpoint.get('direction')} migration")
+            self.after = checkpoint["after"]
+            self.conversations = checkpoint["conversations"]
+            self.messages = checkpoint["messages"]
+            self.skipped = checkpoint.get("skipped", 0)
+        self._resumed_from = (self.conversations, self.messages)
+
+    def advance(self, last_key: str, conversations: int, messages: int, skipped: int = 0) -> None:
+        """
+        Records a batch that has been fully written, up to and including last_key.
+        """
+        self.after = last_key
+        self.conversations += conversations
+        self.messages += messages
+        self.skipped += skipped
+        if self.checkpoint_path is not None:
+            checkpoint = {
+                "direction": self.direction,
+                "after": self.after,
+                "conversations": self.conversations,
+                "messages": self.messages,
+                "skipped": self.skipped,
+            }
+            tmp_path = f"{self.checkpoint_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, self.checkpoint_path)
+
+        now = time.perf_counter()
+        if now - self._last_report >= self.report_every:
+            self._last_report = now
+            self._report(self.summary())
+
+    def summary(self) -> str:
+        # Rates cover this run only, not batches completed before a resume
+        elapsed = max(time.perf_counter() - self._started, 1e-9)
+        conversation_rate = (self.conversations - self._resumed_from[0]) / elapsed
+        message_rate = (self.messages - self._resumed_from[1]) / elapsed
+        skipped = f", {self.skipped} archived skipped" if self.skipped else ""
+        return (f"{self.direction}: {self.conversations} conversations, {self.messages} messages{skipped} "
+                f"({conversation_rate:,.0f} conversations/s, {message_rate:,.0f} messages/s)")
+
+    def finish(self) -> None:
+        """
+        Reports final totals and removes the checkpoint of the completed run.
+        """
+        self._report(self.summary())
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def migrate_flat_to_mongo(flat: FlatFileManager, mongo: MongoDBManager, checkpoint_path: Optional[str] = None,
+                          batch_size: int = 100, readers: int = 8,
+                          split_id: Optional[Callable[[str], Tuple[str, str]]] = None,
+                          report_every: float = 5.0) -> MigrationProgress:
+    """
+    Copies every conversation in a flat-file store into MongoDB.
+
+    Conversations are taken in ID order, batch_size at a time, so memory use is
+    bounded by one batch. Each batch is read by a pool of reader threads and
+    written as one unordered bulk_write of upserting replaces, which makes
+    re-writing a batch after an interruption harmless. Bucketed MongoDB stores
+    are written conversation by conversation instead. The documents are the
+    ones save_conversation() writes, recording the time each conversation file
+    was last written as created_at and updated_at.
+
+    Args:
+        flat (FlatFileManager): The source store
+        mongo (MongoDBManager): The destination store
+        checkpoint_path (str): JSON file recording progress; an existing one resumes
+            the migration after the last completed batch
+        batch_size (int): Conversations read and written together
+        readers (int): Threads reading and parsing conversation files
+        split_id (Callable): Maps a flat conversation ID to (user_id, thread_name).
+            By default both are taken from the path of files that FlatFileBackend
+            or migrate_mongo_to_flat() wrote, and other files are split with
+            split_conversation_id().
+        report_every (float): Seconds between throughput reports
+
+    Returns:
+        MigrationProgress: Totals for the whole migration, including resumed runs
+    """
+    progress = MigrationProgress("flat_to_mongo", checkpoint_path, report_every)
+    mongo.flush()
+
+    def split_from_path(conversation_id: str) -> Tuple[str, str]:
+        relative_filepath = flat.conversations_index.get(conversation_id, "")
+        return _thread_from_filepath(conversation_id, relative_filepath) or split_conversation_id(conversation_id)
+
+    split_id = split_id or split_from_path
+    conversation_ids = sorted(conversation_id for conversation_id in flat.conversations_index
+                              if progress.after is None or conversation_id > progress.after)
+
+    def read(conversation_id: str) -> Tuple[List[Dict], str]:
+        # Messages, and the time the conversation was last written as created_at and updated_at
+        modified = flat.last_modified(conversation_id)
+        timestamp = datetime.now(UTC) if modified is None else datetime.fromtimestamp(modified, UTC)
+        return flat.get_conversation(conversation_id), timestamp.isoformat()
+
+    def save(conversation_id: str, conversation: Tuple[List[Dict], str]) -> None:
+        messages, timestamp = conversation
+        mongo.save_conversation(*split_id(conversation_id), messages, timestamp=timestamp)
+
+    with ThreadPoolExecutor(max_workers=readers, thread_name_prefix="migration-read") as pool:
+        for start in range(0, len(conversation_ids), batch_size):
+            batch = conversation_ids[start:start + batch_size]
+            conversations = list(pool.map(read, batch))
+
+            if mongo.storage_mode == "bucketed":
+                list(pool.map(save, batch, conversations))
+            else:
+                operations = []
+                threads = []
+                for conversation_id, (messages, timestamp) in zip(batch, conversations):
+                    user_id, thread_name = split_id(conversation_id)
+                    document = _conversation_document(user_id, thread_name, messages, timestamp)
+                    operations.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+                    threads.append({"user_id": user_id, "thread_name": thread_name})
+                mongo.conversations.bulk_write(operations, ordered=False)
+                # As in save_conversation(), buckets left by a bucketed manager
+                # would shadow the replaced messages
+                mongo.buckets.delete_many({"$or": threads})
+
+            progress.advance(batch[-1], len(batch), sum(len(messages) for messages, _ in conversations))
+
+    progress.finish()
+    return progress
+
+
+def migrate_mongo_to_flat(mongo: MongoDBManager, flat: FlatFileManager, checkpoint_path: Optional[str] = None,
+                          batch_size: int = 100, workers: int = 8, report_every: float = 5.0,
+                          archive: Optional[FlatFileManager] = None) -> MigrationProgress:
+    """
+    Copies every conversation in MongoDB into a flat-file store, under the
+    conversation ID f"{user_id}_{thread_name}" and in the file FlatFileBackend
+    would use for it.
+
+    Conversations are streamed in _id order through a cursor fetching batch_size
+    documents at a time. Single-document conversations arrive with their
+    messages; bucketed ones are read by the worker pool. The pool also writes
+    the conversation files. Saving replaces a file outright, so repeating a batch
+    after an interruption is harmless.
+
+    Conversations archived by a TieredStore are left as tombstones in MongoDB.
+    Given the store's archive they are copied from there; otherwise they are
+    skipped and counted in MigrationProgress.skipped.
+
+    Args:
+        mongo (MongoDBManager): The source store
+        flat (FlatFileManager): The destination store
+        checkpoint_path (str): JSON file recording progress; an existing one resumes
+            the migration after the last completed batch
+        batch_size (int): Conversations read and written together
+        workers (int): Threads reading buckets and writing files
+        report_every (float): Seconds between throughput reports
+        archive (FlatFileManager): The TieredStore archive holding the messages of
+            archived conversations
+
+    Returns:
+        MigrationProgress: Totals for the whole migration, including resumed runs
+    """
+    progress = MigrationProgress("mongo_to_flat", checkpoint_path, report_every)
+    mongo.flush()
+
+    def save(conversation: Tuple[Dict, List[Dict]]) -> None:
+        document, messages = conversation
+        flat.save_conversation(document["_id"], _thread_filepath(document["user_id"], document["thread_name"]),
+                               messages)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="migration-write") as pool:
+        for batch in _mongo_batches(mongo, archive, progress.after, batch_size, pool):
+            conversations = [conversation for conversation in batch if conversation[1] is not None]
+            list(pool.map(save, conversations))
+            progress.advance(batch[-1][0]["_id"], len(conversations),
+                             sum(len(messages) for _, messages in conversations), len(batch) - len(conversations))
+
+    progress.finish()
+    return progress
+
+
+def _mongo_batches(mongo: MongoDBManager, archive: Optional[FlatFileManager], after: Optional[str],
+                   batch_size: int, pool: ThreadPoolExecutor) -> Iterator[List[Tuple[Dict, Optional[List[Dict]]]]]:
+    """
+    Yields lists of (document, messages) in _id order, starting after the given
+    _id, where document holds the _id, user_id and thread_name. messages is None
+    for archived conversations that are skipped.
+    """
+    query = {} if after is None else {"_id": {"$gt": after}}
+    bucketed = mongo.storage_mode == "bucketed"
+    projection = {"user_id": True, "thread_name": True, "messages": True, ARCHIVED_FIELD: True}
+    cursor = mongo.conversations.find(query, projection).sort("_id", 1).batch_size(batch_size)
+
+    def load(document: Dict) -> Optional[List[Dict]]:
+        if ARCHIVED_FIELD not in document:
+            if not bucketed:
+                return document.get("messages", [])
+            try:
+                return mongo.get_conversation(document["user_id"], document["thread_name"])
+            except ArchivedConversationError:
+                pass  # Archived since the cursor read it
+        if archive is None:
+            return None
+        messages = archive.get_conversation(document["_id"])
+        if messages or document["_id"] in archive.conversations_index:
+            return messages
+        # Promoted back into MongoDB since the tombstone was read
+        return mongo.get_conversation(document["user_id"], document["thread_name"])
+
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield list(zip(batch, pool.map(load, batch)))
+            batch = []
+    if batch:
+        yield list(zip(batch, pool.map(load, batch)))
+
+
+def run_tests(connection_string: str = "mongodb://localhost:27017/") -> None:
+    """
+    Migrates a database holding an archived conversation to flat files and back,
+    in both MongoDB storage modes, using the chai_test_db database and the
+    data_test and archive_test directories.
+    """
+    import shutil
+
+    from db_wrappers.tiering import TieredStore
+
+    for storage_mode in ("document", "bucketed"):
+        print(f"Testing migrate_mongo_to_flat() of archived conversations, {storage_mode} storage")
+        mongo = MongoDBManager(connection_string=connection_string, database_name="chai_test_db",
+                               storage_mode=storage_mode, bucket_size=2)
+        mongo._wipe_database()
+        store = TieredStore(mongo, FlatFileManager(storage_dir="archive_test", compression="zlib",
+                                                   compress_min_bytes=0))
+        idle = [{"role": "user", "content": str(i)} for i in range(5)]
+        active = [{"role": "user", "content": "hello world"}]
+        store.save_conversation("test_user", "idle", idle)
+        store.demote_idle(idle_days=0)
+        store.save_conversation("test_user", "active", active)
+
+        flat = FlatFileManager(storage_dir="data_test")
+        progress = migrate_mongo_to_flat(mongo, flat, report_every=float("inf"))
+        if progress.skipped == 1 and flat.list_conversations() == ["test_user_active"]:
+            print("Successfully skipped the archived conversation!")
+        else:
+            print(f"Failed! Skipped {progress.skipped}, migrated {flat.list_conversations()}")
+
+        progress = migrate_mongo_to_flat(mongo, flat, report_every=float("inf"), archive=store.archive)
+        if (progress.skipped == 0 and flat.get_conversation("test_user_idle") == idle
+                and flat.get_conversation("test_user_active") == active):
+            print("Successfully migrated the archived conversation from the archive!")
+        else:
+            print(f"Failed! Skipped {progress.skipped}, messages: {flat.get_conversation('test_user_idle')}")
+
+        print(f"Testing a round trip of a user ID containing an underscore, {storage_mode} storage")
+        mongo.save_conversation("test_user_2", "notes", active)
+        migrate_mongo_to_flat(mongo, flat, report_every=float("inf"))
+        mongo._wipe_database()
+        migrate_flat_to_mongo(flat, mongo, report_every=float("inf"))
+        if (mongo.list_user_threads("test_user_2") == ["notes"]
+                and sorted(mongo.list_user_threads("test_user")) == ["active", "idle"]):
+            print("Successfully kept each thread with its user!")
+        else:
+            print(f"Failed! test_user has {mongo.list_user_threads('test_user')}, "
+                  f"test_user_2 has {mongo.list_user_threads('test_user_2')}")
+
+        mongo._wipe_database()
+        store.close()
+        flat.close()
+        shutil.rmtree("archive_test")
+        shutil.rmtree("data_test")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Copy conversations between a flat-file store and MongoDB.")
+    parser.add_argument("direction", choices=["flat-to-mongo", "mongo-to-flat", "test"],
+                        help="Which way to copy, or test to run the self-test against chai_test_db")
+    parser.add_argument("--storage-dir", default="data", help="Flat-file storage directory")
+    parser.add_argument("--connection-string", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="chai_db")
+    parser.add_argument("--storage-mode", default="document", choices=["document", "bucketed"])
+    parser.add_argument("--archive-dir", help="TieredStore archive to copy archived conversations from")
+    parser.add_argument("--checkpoint", default="migration.checkpoint.json",
+                        help="Progress file; rerun with the same file to resume")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.direction == "test":
+        run_tests(args.connection_string)
+    else:
+        flat_manager = FlatFileManager(storage_dir=args.storage_dir)
+        mongo_manager = MongoDBManager(connection_string=args.connection_string, database_name=args.database,
+                                       storage_mode=args.storage_mode)
+        if args.direction == "flat-to-mongo":
+            migrate_flat_to_mongo(flat_manager, mongo_manager, args.checkpoint, args.batch_size, args.threads)
+        else:
+            archive_manager = FlatFileManager(storage_dir=args.archive_dir) if args.archive_dir else None
+            migrate_mongo_to_flat(mongo_manager, flat_manager, args.checkpoint, args.batch_size, args.threads,
+                                  archive=archive_manager)
+            if archive_manager is not None:
+                archive_manager.close()
+        mongo_manager.close()
+        flat_manager.close()
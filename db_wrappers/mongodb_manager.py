@@ -1,24 +1,136 @@
 import os
+import threading
+from concurrent.futures import Future
 from datetime import datetime, UTC
-from typing import List, Dict, Optional
-from pymongo import MongoClient
+from itertools import groupby
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+from pymongo import MongoClient, ReplaceOne, ReturnDocument, UpdateOne
 from pymongo.collection import Collection
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from db_wrappers.tokens import context_window, estimate_tokens
+from db_wrappers.write_behind import WriteBehindBuffer
+
+# $slice needs an explicit count; this stands for "the rest of the array"
+_SLICE_ALL = 2 ** 31 - 1
+
+# Bump when the indexes created by _ensure_indexes change
+SCHEMA_VERSION = 2
+# Collection holding one marker document per collection whose indexes are in place
+SCHEMA_COLLECTION = "chai_schema"
+# (connection_string, database_name, collection) combinations verified by this process
+_verified_schemas = set()
+
+# Indexes on the conversations collection, as (keys, options) pairs
+CONVERSATION_INDEXES = [
+    # Compound index on user_id and thread_name for fast lookups
+    ([("user_id", 1), ("thread_name", 1)], {"unique": True}),
+    # Index on user_id for listing all threads for a user
+    ([("user_id", 1)], {}),
+    # Thread catalog: answers list_user_threads and list_threads from the index
+    # alone, newest first, without reading conversation documents
+    ([("user_id", 1), ("updated_at", -1), ("thread_name", 1), ("message_count", 1)], {"name": "user_catalog"}),
+]
+# Fills in message_count on conversations written before it was maintained
+BACKFILL_MESSAGE_COUNT = [{"$set": {"message_count": {"$size": "$messages"}}}]
+
+# Write concerns for the durability levels of save_conversation and append_message
+DURABILITY_LEVELS = {
+    # Acknowledged by the primary once applied in memory; may be lost in a crash
+    "fast": WriteConcern(w=1, j=False),
+    # Acknowledged once written to the primary's on-disk journal
+    "safe": WriteConcern(w=1, j=True),
+    # Acknowledged once journaled on a majority of the replica set
+    "replicated": WriteConcern(w="majority", j=True),
+}
+# Strength of each level, including None for the client's default write concern
+_DURABILITY_RANK = {"fast": 0, None: 1, "safe": 2, "replicated": 3}
+
+# Set on the tombstone left in place of a conversation whose messages were moved
+# to an archive (see tiering.TieredStore); holds where the messages went
+ARCHIVED_FIELD = "archived"
+# Error code of a write that would create a second document with the same _id
+_DUPLICATE_KEY = 11000
+
+
+class ArchivedConversationError(LookupError):
+    """
+    Raised when reading or appending to a conversation whose messages have been
+    archived. The tombstone document still carries its catalog fields and
+    message_count; TieredStore catches this error and restores the messages.
+    """
+
+    def __init__(self, document: Dict):
+        self.user_id = document["user_id"]
+        self.thread_name = document["thread_name"]
+        self.archived = document[ARCHIVED_FIELD]
+        super().__init__(f"Conversation {self.user_id}_{self.thread_name} is archived: {self.archived}")
 
 
 class MongoDBManager:
     """
     Manages storing and retrieving chat conversations in MongoDB.
     Each conversation is stored as a single document with an array of messages.
+
+    With storage_mode="bucketed", messages live instead in fixed-size bucket
+    documents in the message_buckets collection, keyed by (user_id, thread_name,
+    bucket_no). The conversation document becomes a summary holding the
+    message_count, which appends increment to reserve sequence numbers. Appends
+    then only touch one small bucket, and no thread can outgrow the 16 MB
+    document limit. migrate_to_buckets() converts existing conversations, and
+    bucketed appends convert any conversation still in the old layout.
+
+    Writes use the client's default write concern unless a durability level is
+    given, either for the whole manager or per call: "fast", "safe" or
+    "replicated" (see DURABILITY_LEVELS).
+
+    With write_behind enabled, append_message() and append_messages() queue the
+    messages and return a Future instead of waiting for their own round trip. Queued appends from all
+    conversations are flushed together as one ordered bulk_write, so messages
+    reach each conversation in the order they were appended. Reads, saves and
+    deletes flush the queue first, so they always see earlier appends.
+
+    Alongside its messages, a conversation document keeps message_tokens, the
+    estimated tokens of each message, and token_count, the total; bucket
+    entries record each message's tokens. get_context_window() uses them to read
+    only the newest messages that fit in a token budget.
+
+    A conversation archived by TieredStore is left behind as a tombstone: it stays
+    in the thread catalog with its message_count, but reading or appending to it
+    raises ArchivedConversationError, and saving over it replaces it. Buffered
+    appends to it fail with the same error through their futures.
     """
 
-    def __init__(self, connection_string: str = "mongodb://localhost:27017/", database_name: str = "chai_db"):
+    def __init__(self, connection_string: str = "mongodb://localhost:27017/", database_name: str = "chai_db",
+                 write_behind: bool = False, flush_interval: float = 0.005, flush_batch_size: int = 500,
+                 storage_mode: str = "document", bucket_size: int = 200, prewarm: bool = False,
+                 durability: Optional[str] = None):
         """
         Initializes the MongoDBManager.
 
         Args:
             connection_string (str): MongoDB connection string
             database_name (str): Name of the database to use
+            write_behind (bool): Buffer appends and write them in batches
+            flush_interval (float): Longest time in seconds a buffered append waits
+            flush_batch_size (int): Number of buffered appends that triggers an early flush
+            storage_mode (str): "document" for one document per conversation, or
+                "bucketed" for messages split across bucket documents
+            bucket_size (int): Messages per bucket for newly created bucketed conversations
+            prewarm (bool): Connect and verify indexes on a background thread right
+                away instead of on the first operation
+            durability (str): Default durability level of writes, or None for the
+                client's default write concern
         """
+        if storage_mode not in ("document", "bucketed"):
+            raise ValueError(f"Unknown storage mode {storage_mode!r}, expected 'document' or 'bucketed'")
+        _check_durability(durability)
+        self.durability = durability
+        self._durable_collections = {}  # Key: durability level => Value: (conversations, buckets)
+        self.storage_mode = storage_mode
+        self.bucket_size = bucket_size
+
         # --- TODO 1: Initialize MongoDB Connection ---
         # 1. Create a MongoClient using the connection_string
         # 2. Get the database using database_name
@@ -26,23 +138,94 @@ class MongoDBManager:
         # Store these as instance variables: self.client, self.db, self.conversations
         # Hint: self.client[database_name] gets a database
         # Hint: db[collection_name] gets a collection - use "conversations" as the collection_name
-        self.client = MongoClient(connection_string)
-        self.db = None #fixme!
-        self.conversations = None #fixme!
+        # The client connects on first use, and the conversations property creates
+        # indexes on first use, so constructing a manager costs no round trips.
+        self.client = MongoClient(connection_string, connect=False)
+        self.db = self.client[database_name]
+        self._connection_string = connection_string
+        self._conversations = self.db["conversations"]
+        self._buckets = self.db["message_buckets"]
+        self._indexes_ready = False
+        self._index_lock = threading.Lock()
+        self._write_buffer = None
+        if write_behind:
+            self._write_buffer = WriteBehindBuffer(self._write_appends, flush_interval, flush_batch_size)
+        self._prewarm_thread = None
+        if prewarm:
+            self._prewarm_thread = threading.Thread(target=self._prewarm, name="mongodb-prewarm", daemon=True)
+            self._prewarm_thread.start()
+
+    @property
+    def conversations(self) -> Collection:
+        """
+        The conversations collection, with its indexes verified.
+        """
+        if not self._indexes_ready:
+            self._ensure_indexes()
+        return self._conversations
+
+    @property
+    def buckets(self) -> Collection:
+        """
+        The message_buckets collection, with its indexes verified.
+        """
+        if not self._indexes_ready:
+            self._ensure_indexes()
+        return self._buckets
+
+    @property
+    def write_behind(self) -> bool:
+        """
+        Whether appends are buffered and written in batches.
+        """
+        return self._write_buffer is not None
 
-        self._ensure_indexes()
+    def _prewarm(self) -> None:
+        try:
+            self.client.admin.command("ping")
+            self._ensure_indexes()
+        except PyMongoError:
+            # The first operation retries and reports the error to its caller
+            pass
 
     def _ensure_indexes(self) -> None:
         """
         Creates indexes on the conversations collection for efficient querying.
         This is already implemented for you.
+
+        Runs on first use. Indexes are skipped for collections this process has
+        already verified, or whose marker document in the chai_schema collection
+        shows they were created at the current SCHEMA_VERSION.
         """
-        # Create a compound index on user_id and thread_name for fast lookups
-        self.conversations.create_index([("user_id", 1), ("thread_name", 1)], unique=True)
-        # Create an index on user_id for listing all threads for a user
-        self.conversations.create_index("user_id")
+        with self._index_lock:
+            if self._indexes_ready:
+                return
+            names = ["conversations", "message_buckets"] if self.storage_mode == "bucketed" else ["conversations"]
+            pending = [name for name in names
+                       if (self._connection_string, self.db.name, name) not in _verified_schemas]
+            if pending:
+                schema = self.db[SCHEMA_COLLECTION]
+                current = {marker["_id"] for marker in schema.find(
+                    {"_id": {"$in": pending}, "version": {"$gte": SCHEMA_VERSION}}, {"_id": True})}
+                for name in pending:
+                    if name not in current:
+                        self._create_indexes(name)
+                        schema.update_one({"_id": name}, {"$max": {"version": SCHEMA_VERSION}}, upsert=True)
+                    _verified_schemas.add((self._connection_string, self.db.name, name))
+            self._indexes_ready = True
+
+    def _create_indexes(self, name: str) -> None:
+        if name == "conversations":
+            for keys, options in CONVERSATION_INDEXES:
+                self._conversations.create_index(keys, **options)
+            self._conversations.update_many({"message_count": {"$exists": False}, "messages": {"$type": "array"}},
+                                            BACKFILL_MESSAGE_COUNT)
+        elif name == "message_buckets":
+            # Serves both bucket lookups and reading a thread's buckets in order
+            self._buckets.create_index([("user_id", 1), ("thread_name", 1), ("bucket_no", 1)], unique=True)
 
-    def get_conversation(self, user_id: str, thread_name: str) -> List[Dict]:
+    def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Dict]:
         """
         --- TODO 2: Retrieve a conversation from MongoDB ---
         Retrieves the messages for a specific conversation.
@@ -50,6 +233,9 @@ class MongoDBManager:
         Args:
             user_id (str): The user's ID
             thread_name (str): The name of the conversation thread
+            offset (int): Index of the first message to return; negative values
+                count back from the end
+            limit (int): Maximum number of messages to return
 
         Returns:
             List[Dict]: List of message dictionaries, or empty list if not found
@@ -60,13 +246,159 @@ class MongoDBManager:
         3. If document doesn't exist, return an empty list []
 
         Hint: find_one({"user_id": user_id, "thread_name": thread_name})
+
+        When offset or limit is given, a $slice projection makes the server send
+        only the requested messages.
+        """
+        self.flush()
+        if self.storage_mode == "bucketed":
+            return self._read_buckets(user_id, thread_name, offset, limit)
+        if offset or limit is not None:
+            return self._read_slice(f"{user_id}_{thread_name}", offset, limit)
+        document = self.conversations.find_one({"user_id": user_id, "thread_name": thread_name})
+        _check_archived(document)
+        if not document or "messages" not in document:
+            return []
+        return document["messages"]
+
+    def get_conversations(self, user_id: str, thread_names: Iterable[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        Fetches several of a user's conversations with a single $in query,
+        yielding each (thread_name, messages) pair as the cursor delivers it.
+        Threads that do not exist come last, with an empty list.
+
+        Args:
+            user_id (str): The user's ID
+            thread_names (Iterable[str]): The names of the conversation threads
+        """
+        self.flush()
+        remaining = dict.fromkeys(thread_names)
+        if self.storage_mode == "bucketed":
+            # Buckets arrive grouped by thread and in order within each thread
+            buckets = self.buckets.find({"user_id": user_id, "thread_name": {"$in": list(remaining)}},
+                                        {"thread_name": True, "messages": True, "_id": False})
+            buckets = buckets.sort([("thread_name", 1), ("bucket_no", 1)])
+            for thread_name, group in groupby(buckets, key=lambda bucket: bucket["thread_name"]):
+                remaining.pop(thread_name, None)
+                yield thread_name, [item["message"] for bucket in group for item in bucket["messages"]]
+            # Whatever is left is empty or has not been migrated to buckets yet
+            query = {"user_id": user_id, "thread_name": {"$in": list(remaining)}, "messages": {"$exists": True}}
+        else:
+            query = {"user_id": user_id, "thread_name": {"$in": list(remaining)}}
+
+        if remaining:
+            for document in self.conversations.find(query, {"thread_name": True, "messages": True, "_id": False}):
+                remaining.pop(document["thread_name"], None)
+                yield document["thread_name"], document.get("messages", [])
+        for thread_name in remaining:
+            yield thread_name, []
+
+    def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]:
+        """
+        Returns the last n messages of a conversation, fetching only those messages.
+        """
+        if n <= 0:
+            return []
+        return self.get_conversation(user_id, thread_name, offset=-n)
+
+    def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        """
+        Returns the newest messages of a conversation whose estimated tokens add
+        up to at most max_tokens, oldest first; what an LLM is sent each turn.
+
+        For a single-document conversation, one aggregation sums message_tokens
+        to find the first message within max_tokens of the total and slices from
+        there to the end, so only the window leaves the server. Bucketed conversations are read
+        newest bucket first, a couple of buckets per batch, until the budget is
+        spent. Conversations written before token counts were kept are read in
+        full once and have them filled in.
+
+        Args:
+            user_id (str): The user's ID
+            thread_name (str): The name of the conversation thread
+            max_tokens (int): Token budget of the window
+
+        Returns:
+            List[Dict]: The newest messages that fit, possibly none
+        """
+        self.flush()
+        if max_tokens <= 0:
+            return []
+        if self.storage_mode == "bucketed":
+            window = self._bucket_window(user_id, thread_name, max_tokens)
+            if window is not None:
+                return window
+        conversation_id = f"{user_id}_{thread_name}"
+        for document in self.conversations.aggregate(_window_pipeline(conversation_id, max_tokens)):
+            _check_archived(document)
+            if document["indexed"]:
+                return document["messages"]
+            messages = self.get_conversation(user_id, thread_name)
+            # Skipped if the conversation changed since it was read
+            self.conversations.update_one({"_id": conversation_id, "messages": {"$size": len(messages)}},
+                                          {"$set": _token_fields(messages)})
+            return context_window(messages, max_tokens)
+        return []
+
+    def _bucket_window(self, user_id: str, thread_name: str, max_tokens: int) -> Optional[List[Dict]]:
+        """
+        Collects the newest messages that fit in max_tokens from a conversation's
+        buckets. Returns None if it has none, as its messages, if any, are still
+        in its conversation document.
+        """
+        cursor = (self.buckets.find({"user_id": user_id, "thread_name": thread_name}, {"messages": True, "_id": False})
+                  .sort("bucket_no", -1).batch_size(2))
+        window = None
+        used = 0
+        try:
+            for bucket in cursor:
+                window = window or []
+                for item in reversed(bucket["messages"]):
+                    tokens = item.get("tokens")
+                    if tokens is None:
+                        tokens = estimate_tokens(item["message"])
+                    if used + tokens > max_tokens:
+                        return window[::-1]
+                    used += tokens
+                    window.append(item["message"])
+        finally:
+            cursor.close()
+        return None if window is None else window[::-1]
+
+    def message_count(self, user_id: str, thread_name: str) -> int:
+        """
+        Returns the number of messages in a conversation without fetching them.
         """
-        # document = self.conversations. fixme!
+        self.flush()
+        conversation_id = f"{user_id}_{thread_name}"
+        summary = self.conversations.find_one({"_id": conversation_id}, {"message_count": True})
+        if summary is None:
+            return 0
+        if "message_count" in summary:
+            return summary["message_count"]
+        result = list(self.conversations.aggregate([
+            {"$match": {"_id": conversation_id}},
+            {"$project": {"count": {"$size": {"$ifNull": ["$messages", []]}}}},
+        ]))
+        return result[0]["count"] if result else 0
+
+    def _read_slice(self, conversation_id: str, offset: Optional[int], limit: Optional[int]) -> List[Dict]:
+        """
+        Returns a window of a single-document conversation's messages.
+        """
+        if limit is not None and limit <= 0:
+            return []
+        window = [offset or 0, _SLICE_ALL if limit is None else limit]
+        document = self.conversations.find_one({"_id": conversation_id}, {"messages": {"$slice": window},
+                                                                          "user_id": True, "thread_name": True,
+                                                                          ARCHIVED_FIELD: True})
+        _check_archived(document)
         if not document or "messages" not in document:
             return []
         return document["messages"]
 
-    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict],
+                          durability: Optional[str] = None, timestamp: Optional[str] = None) -> None:
         """
         --- TODO 3: Save a conversation to MongoDB ---
         Saves the entire conversation, replacing the existing one if it exists.
@@ -75,6 +407,9 @@ class MongoDBManager:
             user_id (str): The user's ID
             thread_name (str): The name of the conversation thread
             messages (List[Dict]): List of message dictionaries
+            durability (str): Durability level of this write, overriding the manager's
+            timestamp (str): ISO time to record the conversation as written at,
+                instead of now; for importing conversations from elsewhere
 
         Steps:
         1. Create a conversation_id by combining user_id and thread_name (e.g., f"{user_id}_{thread_name}")
@@ -92,48 +427,391 @@ class MongoDBManager:
 
         Hint: self.conversations.update_one({filter goes here}, {update goes here}, upsert=True)
         """
-        conversation_id = f"{}_{}" # fixme!
-        # fixme! add fields to document
-        document = {
-        }
-        # fixme! self.conversations.
+        self.flush()
+        _check_durability(durability)
+        timestamp = timestamp or datetime.now(UTC).isoformat()
+        if self.storage_mode == "bucketed":
+            self._write_buckets(user_id, thread_name, messages, timestamp, durability)
+            return
+        document = _conversation_document(user_id, thread_name, messages, timestamp)
+        conversations, buckets = self._collections(durability)
+        previous = conversations.find_one_and_update(
+            {"_id": document["_id"]},
+            {"$set": document, "$unset": {ARCHIVED_FIELD: "", "bucket_size": ""}},
+            projection={"bucket_size": True},
+            upsert=True
+        )
+        if _bucketed(previous):
+            # Left over from a bucketed manager, and would be read in preference
+            # to the new messages
+            buckets.delete_many({"user_id": user_id, "thread_name": thread_name})
+
+    def append_message(self, user_id: str, thread_name: str, message: Dict,
+                       durability: Optional[str] = None) -> Optional[Future]:
+        """
+        Appends a single message to a conversation. See append_messages().
+        """
+        return self.append_messages(user_id, thread_name, [message], durability)
 
-    def append_message(self, user_id: str, thread_name: str, message: Dict) -> None:
+    def append_messages(self, user_id: str, thread_name: str, messages: List[Dict],
+                        durability: Optional[str] = None) -> Optional[Future]:
         """
-        --- TODO 4: Append a single message to a conversation ---
-        This is a more efficient operation than rewriting the entire conversation.
+        Appends messages to a conversation in a single round trip, sending only
+        the new messages rather than the whole conversation, and cheaper than one
+        append_message() call per message.
+
+        Uses update_one() with {"$push": {"messages": {"$each": messages}}},
+        pushing the messages' token estimates onto message_tokens the same way
+        and adding them to token_count with $inc, so the server only adds to the
+        arrays instead of rewriting the conversation. upsert=True and
+        $setOnInsert fill in user_id, thread_name and created_at when the
+        conversation does not exist yet.
 
         Args:
             user_id (str): The user's ID
             thread_name (str): The name of the conversation thread
-            message (Dict): A single message dictionary to append
+            messages (List[Dict]): Message dictionaries to append, in order
+            durability (str): Durability level of this write, overriding the manager's.
+                With write_behind, a batch is written at the strongest level of its appends
 
-        Steps:
-        1. Create conversation_id like in save_conversation
-        2. Use update_one() with $push to append the message to the messages array
-           - Filter: {"_id": conversation_id}
-           - Update: {"$push": {"messages": message}, "$set": {"updated_at": current_timestamp}}
-           - upsert=True to create the document if it doesn't exist
-        3. If upsert creates a new document, you should also set user_id, thread_name, and created_at
-           - Use $setOnInsert for fields that should only be set during creation
+        Returns:
+            Future: With write_behind enabled, resolves once the messages are written;
+                otherwise None, as the write has already completed
+        """
+        _check_durability(durability)
+        messages = list(messages)
+        timestamp = datetime.now(UTC).isoformat()
+        if self._write_buffer is not None:
+            return self._write_buffer.submit((user_id, thread_name, messages, timestamp,
+                                              durability or self.durability))
+        if not messages:
+            return None
+        conversations, buckets = self._collections(durability)
+        if self.storage_mode == "bucketed":
+            first, operations = self._bucket_appends(user_id, thread_name, messages, timestamp, durability)
+            errors = self._write_bucket_appends(buckets, [(user_id, thread_name, messages, first, operations)])
+            for error in errors.values():
+                raise error
+            return None
+        conversation_id = f"{user_id}_{thread_name}"
+        update = _append_update(user_id, thread_name, messages, timestamp)
+
+        while True:
+            try:
+                conversations.update_one(
+                    {"_id": conversation_id, ARCHIVED_FIELD: {"$exists": False}},
+                    update,
+                    upsert=True
+                )
+                return None
+            except DuplicateKeyError:
+                # Either the conversation is archived, or a concurrent upsert created it first
+                _check_archived(self.conversations.find_one({"_id": conversation_id}))
+
+    def _collections(self, durability: Optional[str] = None) -> Tuple[Collection, Collection]:
+        """
+        Returns the conversations and message_buckets collections writing at the
+        given durability level, falling back to the manager's default level.
+        """
+        level = durability or self.durability
+        if level is None:
+            return self.conversations, self.buckets
+        collections = self._durable_collections.get(level)
+        if collections is None:
+            write_concern = DURABILITY_LEVELS[level]
+            collections = (self.conversations.with_options(write_concern=write_concern),
+                           self.buckets.with_options(write_concern=write_concern))
+            self._durable_collections[level] = collections
+        return collections
 
-        Hint: $push adds to an array, $setOnInsert sets values only on insert
-        Hint: update_one(filter, {"$push": {...}, "$set": {...}, "$setOnInsert": {...}}, upsert=True)
+    def flush(self) -> None:
+        """
+        Waits until every buffered append has been written. Does nothing unless
+        write_behind is enabled. Failed appends raise through their futures.
         """
-        conversation_id = "" #fixme!
-        # fixme! fill out update
+        if self._write_buffer is not None and self._write_buffer.pending():
+            self._write_buffer.flush()
+
+    def _write_appends(self, appends: List[tuple]) -> List[Optional[Exception]]:
+        """
+        Writes a batch of buffered appends as one ordered bulk_write, with a single
+        update per conversation carrying its messages in the order they arrived.
+        The batch is written at the strongest durability level any append asked for.
+
+        Appends to archived conversations are not written; their futures fail with
+        ArchivedConversationError while the rest of the batch goes through. If the
+        write fails partway, appends written before the failed update succeed and
+        the rest fail with the write's error.
+        """
+        durability = max((append[4] for append in appends), key=_DURABILITY_RANK.get)
+        conversations, buckets = self._collections(durability)
+        errors = {}  # Key: (user_id, thread_name) => Value: exception the conversation's appends failed with
+        if self.storage_mode == "bucketed":
+            reserved = []
+            try:
+                for (user_id, thread_name), group in groupby(sorted(appends, key=lambda append: append[:2]),
+                                                             key=lambda append: append[:2]):
+                    group = list(group)
+                    messages = [message for append in group for message in append[2]]
+                    if not messages:
+                        continue
+                    try:
+                        first, operations = self._bucket_appends(user_id, thread_name, messages, group[-1][3],
+                                                                 durability)
+                    except ArchivedConversationError as e:
+                        errors[user_id, thread_name] = e
+                        continue
+                    reserved.append((user_id, thread_name, messages, first, operations))
+            except PyMongoError:
+                self._release_sequences(reserved)
+                raise
+            errors.update(self._write_bucket_appends(buckets, reserved))
+            return [errors.get(append[:2]) for append in appends]
+
+        batches = {}  # Key: (user_id, thread_name) => Value: (messages, timestamp of the last append)
+        for user_id, thread_name, messages, timestamp, _ in appends:
+            if not messages:
+                continue
+            batch, _ = batches.get((user_id, thread_name), ([], None))
+            batch.extend(messages)
+            batches[user_id, thread_name] = (batch, timestamp)
+
+        keys = list(batches)
+        operations = [UpdateOne({"_id": f"{user_id}_{thread_name}", ARCHIVED_FIELD: {"$exists": False}},
+                                _append_update(user_id, thread_name, messages, timestamp), upsert=True)
+                      for (user_id, thread_name), (messages, timestamp) in batches.items()]
+        start = 0
+        while start < len(operations):
+            try:
+                conversations.bulk_write(operations[start:], ordered=True)
+                break
+            except BulkWriteError as e:
+                # An ordered bulk_write stops at its first error, so everything
+                # before it was written and nothing after it was
+                if not e.details.get("writeErrors"):
+                    raise
+                error = e.details["writeErrors"][0]
+                start += error["index"]
+                if error["code"] != _DUPLICATE_KEY:
+                    for key in keys[start:]:
+                        errors[key] = e
+                    break
+                user_id, thread_name = keys[start]
+                try:
+                    # Either the conversation is archived, or a concurrent upsert created it first
+                    _check_archived(self.conversations.find_one({"_id": f"{user_id}_{thread_name}"}))
+                except ArchivedConversationError as archived_error:
+                    errors[user_id, thread_name] = archived_error
+                    start += 1
+        return [errors.get(append[:2]) for append in appends]
+
+    def migrate_to_buckets(self) -> int:
+        """
+        Moves every conversation still stored as a single document into buckets.
+        Safe to re-run after an interruption. Appends made in document mode while
+        a conversation is being moved can be lost, so stop document-mode writers
+        first; bucketed managers convert old conversations on their own.
+
+        Returns:
+            int: Number of conversations migrated
+        """
+        self.flush()
+        migrated = 0
+        for document in self.conversations.find({"messages": {"$exists": True}}):
+            self._migrate_conversation(document)
+            migrated += 1
+        return migrated
+
+    def _migrate_conversation(self, document: Dict) -> None:
+        self._write_buckets(document["user_id"], document["thread_name"], document["messages"],
+                            document.get("updated_at", datetime.now(UTC).isoformat()))
+
+    def _read_buckets(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                      limit: Optional[int] = None) -> List[Dict]:
+        """
+        Returns a window of a bucketed conversation's messages, or of a
+        conversation that has not been migrated yet. Windowed reads look up the
+        message count first and then fetch only the buckets that overlap.
+        """
+        conversation_id = f"{user_id}_{thread_name}"
+        if not offset and limit is None:
+            buckets = self.buckets.find({"user_id": user_id, "thread_name": thread_name},
+                                        {"messages": True, "_id": False}).sort("bucket_no", 1)
+            messages = [item["message"] for bucket in buckets for item in bucket["messages"]]
+            if messages:
+                return messages
+            return self._read_slice(conversation_id, None, None)
+
+        summary = self.conversations.find_one({"_id": conversation_id}, {"message_count": True, "bucket_size": True,
+                                                                          "user_id": True, "thread_name": True,
+                                                                          ARCHIVED_FIELD: True})
+        _check_archived(summary)
+        if summary is None:
+            return []
+        if "message_count" not in summary:
+            return self._read_slice(conversation_id, offset, limit)
+        count = summary["message_count"]
+        bucket_size = summary.get("bucket_size", self.bucket_size)
+        start = offset or 0
+        if start < 0:
+            start = max(count + start, 0)
+        stop = count if limit is None else min(start + limit, count)
+        if start >= stop:
+            return []
+        buckets = self.buckets.find({"user_id": user_id, "thread_name": thread_name,
+                                     "bucket_no": {"$gte": start // bucket_size, "$lte": (stop - 1) // bucket_size}},
+                                    {"messages": True, "_id": False}).sort("bucket_no", 1)
+        return [item["message"] for bucket in buckets for item in bucket["messages"] if start <= item["seq"] < stop]
+
+    def _write_buckets(self, user_id: str, thread_name: str, messages: List[Dict], timestamp: str,
+                       durability: Optional[str] = None) -> None:
+        """
+        Replaces a conversation's buckets with the given messages, then points its
+        summary document at them, dropping any messages array it still holds.
+        """
+        conversations, buckets = self._collections(durability)
+        conversation_id = f"{user_id}_{thread_name}"
+        bucket_count = (len(messages) + self.bucket_size - 1) // self.bucket_size
+        operations = []
+        for bucket_no in range(bucket_count):
+            start = bucket_no * self.bucket_size
+            bucket = {
+                "user_id": user_id,
+                "thread_name": thread_name,
+                "bucket_no": bucket_no,
+                "messages": [{"seq": seq, "message": message, "tokens": estimate_tokens(message)}
+                             for seq, message in enumerate(messages[start:start + self.bucket_size], start)],
+            }
+            operations.append(ReplaceOne({"user_id": user_id, "thread_name": thread_name, "bucket_no": bucket_no},
+                                         bucket, upsert=True))
+        if operations:
+            buckets.bulk_write(operations, ordered=True)
+        buckets.delete_many({"user_id": user_id, "thread_name": thread_name, "bucket_no": {"$gte": bucket_count}})
+        conversations.update_one(
+            {"_id": conversation_id},
+            {
+                "$set": {"message_count": len(messages), "token_count": sum(map(estimate_tokens, messages)),
+                         "bucket_size": self.bucket_size, "updated_at": timestamp},
+                "$unset": {"messages": "", "message_tokens": "", ARCHIVED_FIELD: ""},
+                "$setOnInsert": {"user_id": user_id, "thread_name": thread_name, "created_at": timestamp},
+            },
+            upsert=True
+        )
+
+    def _reserve_sequence(self, user_id: str, thread_name: str, count: int, timestamp: str,
+                          durability: Optional[str] = None, tokens: int = 0) -> Tuple[int, int]:
+        """
+        Claims the next count sequence numbers of a bucketed conversation, adding
+        the tokens of the messages they are for to its token_count.
+
+        Returns:
+            Tuple[int, int]: The first claimed sequence number and the bucket size
+                the conversation was created with
+        """
+        conversation_id = f"{user_id}_{thread_name}"
         update = {
-            "$push": {},
-            "$set": {},
+            "$inc": {"message_count": count, "token_count": tokens},
+            "$set": {"updated_at": timestamp},
             "$setOnInsert": {
+                "user_id": user_id,
+                "thread_name": thread_name,
+                "created_at": timestamp,
+                "bucket_size": self.bucket_size,
             }
         }
+        conversations, _ = self._collections(durability)
+        try:
+            summary = conversations.find_one_and_update(
+                {"_id": conversation_id, "messages": {"$exists": False}, ARCHIVED_FIELD: {"$exists": False}},
+                update,
+                projection={"message_count": True, "bucket_size": True},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The conversation exists but is archived or still holds its messages in one document
+            document = self.conversations.find_one({"_id": conversation_id})
+            _check_archived(document)
+            if document is not None and "messages" in document:
+                self._migrate_conversation(document)
+            return self._reserve_sequence(user_id, thread_name, count, timestamp, durability, tokens)
+        return summary["message_count"] - count, summary.get("bucket_size", self.bucket_size)
 
-        self.conversations.update_one(
-            {"_id": conversation_id},
-            update,
-            upsert=True
-        )
+    def _bucket_appends(self, user_id: str, thread_name: str, messages: List[Dict], timestamp: str,
+                        durability: Optional[str] = None) -> Tuple[int, List[UpdateOne]]:
+        """
+        Reserves sequence numbers for messages and returns the first of them with
+        the bucket updates that store the messages. Concurrent appenders may reach
+        a bucket out of order, so each $push keeps the bucket sorted by sequence
+        number. Write the updates with _write_bucket_appends().
+        """
+        tokens = [estimate_tokens(message) for message in messages]
+        first, bucket_size = self._reserve_sequence(user_id, thread_name, len(messages), timestamp, durability,
+                                                    sum(tokens))
+        operations = []
+        for bucket_no, items in groupby(enumerate(zip(messages, tokens), first),
+                                        key=lambda item: item[0] // bucket_size):
+            operations.append(UpdateOne(
+                {"user_id": user_id, "thread_name": thread_name, "bucket_no": bucket_no},
+                {"$push": {"messages": {"$each": [{"seq": seq, "message": message, "tokens": message_tokens}
+                                                  for seq, (message, message_tokens) in items],
+                                        "$sort": {"seq": 1}}}},
+                upsert=True
+            ))
+        return first, operations
+
+    def _write_bucket_appends(self, buckets: Collection, reserved: List[tuple]) -> Dict[tuple, Exception]:
+        """
+        Writes the bucket updates of appends, given as (user_id, thread_name,
+        messages, first sequence number, updates), in one ordered bulk_write.
+        When a write error names the failed update, the appends before it were
+        written and the rest are returned with the error, keyed by (user_id,
+        thread_name). Any other failure is raised. Either way the sequence
+        numbers of the appends that failed are released first.
+        """
+        operations = [operation for *_, append_operations in reserved for operation in append_operations]
+        if not operations:
+            return {}
+        try:
+            buckets.bulk_write(operations, ordered=True)
+        except BulkWriteError as e:
+            if not e.details.get("writeErrors"):
+                self._release_sequences(reserved)
+                raise
+            failed = e.details["writeErrors"][0]["index"]
+            position = 0
+            while failed >= len(reserved[position][4]):
+                failed -= len(reserved[position][4])
+                position += 1
+            self._release_sequences(reserved[position:])
+            return {(user_id, thread_name): e for user_id, thread_name, *_ in reserved[position:]}
+        except PyMongoError:
+            self._release_sequences(reserved)
+            raise
+        return {}
+
+    def _release_sequences(self, reserved: List[tuple]) -> None:
+        """
+        Hands back the sequence numbers reserved for appends that could not be
+        written, lowering message_count and token_count again, so that windowed
+        and tail reads do not count messages that were never stored. That is only
+        possible for an append none of whose messages reached a bucket, and while
+        no later append has reserved the numbers after it; otherwise the gap stays.
+        """
+        for user_id, thread_name, messages, first, _ in reserved:
+            stop = first + len(messages)
+            try:
+                if self.buckets.count_documents({"user_id": user_id, "thread_name": thread_name,
+                                                 "messages": {"$elemMatch": {"seq": {"$gte": first, "$lt": stop}}}},
+                                                limit=1):
+                    continue
+                self.conversations.update_one(
+                    {"_id": f"{user_id}_{thread_name}", "message_count": stop},
+                    {"$inc": {"message_count": -len(messages),
+                              "token_count": -sum(estimate_tokens(message) for message in messages)}})
+            except PyMongoError:
+                # The original error is the one worth reporting
+                continue
 
     def list_user_threads(self, user_id: str) -> List[str]:
         """
@@ -150,13 +828,44 @@ class MongoDBManager:
         2. Use projection to only return the thread_name field: {"thread_name": True, "_id": False}
 
         Hint: list(self.conversations.find({"user_id": user_id}, {"thread_name": True, "_id": False}))
+
+        The query is covered by the user_catalog index, so no conversation
+        documents are read. Threads come back most recently updated first.
         """
-        matches = list(self.conversations.find({}, {})) # fixme!
+        self.flush()
+        matches = list(self.conversations.find({"user_id": user_id}, {"thread_name": True, "_id": False})
+                       .sort([("updated_at", -1), ("thread_name", 1)]).hint("user_catalog"))
         thread_names = []
         for record in matches:
             thread_names.append(record["thread_name"])
         return thread_names
 
+    def list_threads(self, user_id: str, limit: int = 50, before: Optional[Dict] = None) -> List[Dict]:
+        """
+        Returns one page of a user's thread catalog, most recently updated first.
+        Served from the user_catalog index alone, so the cost depends on the page
+        size, not on how many threads the user has or how long they are.
+
+        Args:
+            user_id (str): The user's ID
+            limit (int): Maximum number of threads to return
+            before (Dict): The last entry of the previous page, to continue after it
+
+        Returns:
+            List[Dict]: The thread_name, updated_at and message_count of each thread
+        """
+        self.flush()
+        query = {"user_id": user_id}
+        if before is not None:
+            query["$or"] = [
+                {"updated_at": {"$lt": before["updated_at"]}},
+                {"updated_at": before["updated_at"], "thread_name": {"$gt": before["thread_name"]}},
+            ]
+        projection = {"thread_name": True, "updated_at": True, "message_count": True, "_id": False}
+        cursor = (self.conversations.find(query, projection)
+                  .sort([("updated_at", -1), ("thread_name", 1)]).hint("user_catalog").limit(limit))
+        return list(cursor)
+
     def delete_conversation(self, user_id: str, thread_name: str) -> bool:
         """
         Deletes a conversation. Already implemented for you.
@@ -168,14 +877,25 @@ class MongoDBManager:
         Returns:
             bool: True if a conversation was deleted, False otherwise
         """
+        self.flush()
         conversation_id = f"{user_id}_{thread_name}"
-        result = self.conversations.delete_one({"_id": conversation_id})
-        return result.deleted_count > 0
+        deleted = self.conversations.find_one_and_delete({"_id": conversation_id}, projection={"bucket_size": True})
+        # A bucketed manager may be migrating the conversation, in which case its
+        # buckets exist before its summary says so
+        if self.storage_mode == "bucketed" or _bucketed(deleted):
+            self.buckets.delete_many({"user_id": user_id, "thread_name": thread_name})
+        return deleted is not None
 
     def close(self) -> None:
         """
         Closes the MongoDB connection. Already implemented for you.
         """
+        if self._prewarm_thread is not None:
+            self._prewarm_thread.join()
+            self._prewarm_thread = None
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+            self._write_buffer = None
         if self.client:
             self.client.close()
 
@@ -184,7 +904,111 @@ class MongoDBManager:
         **DANGEROUS**: Deletes all conversations. Only for testing!
         Already implemented for you.
         """
+        self.flush()
         self.conversations.delete_many({})
+        self.buckets.delete_many({})
+
+
+def _bucketed(document: Optional[Dict]) -> bool:
+    """
+    Checks whether a conversation document is the summary of a bucketed
+    conversation, which is always written with its bucket_size.
+    """
+    return document is not None and "bucket_size" in document
+
+
+def _check_archived(document: Optional[Dict]) -> None:
+    if document is not None and ARCHIVED_FIELD in document:
+        raise ArchivedConversationError(document)
+
+
+def _conversation_document(user_id: str, thread_name: str, messages: List[Dict], timestamp: str) -> Dict:
+    """
+    Returns the document a conversation is stored as in document mode, created
+    and last updated at timestamp. save_conversation() writes it; bulk writers
+    such as the migration tool build theirs with it too.
+    """
+    return {
+        "_id": f"{user_id}_{thread_name}",
+        "user_id": user_id,
+        "thread_name": thread_name,
+        "messages": messages,
+        "message_count": len(messages),
+        **_token_fields(messages),
+        "created_at": timestamp,
+        "updated_at": timestamp,
+    }
+
+
+def _token_fields(messages: List[Dict]) -> Dict:
+    """
+    Returns the message_tokens and token_count fields of a conversation document.
+    """
+    tokens = [estimate_tokens(message) for message in messages]
+    return {"message_tokens": tokens, "token_count": sum(tokens)}
+
+
+def _append_update(user_id: str, thread_name: str, messages: List[Dict], timestamp: str) -> Dict:
+    """
+    Returns the update appending messages to a conversation document. $push
+    with $each adds the messages and their token estimates to the end of the
+    stored arrays, so the cost of an append does not grow with the conversation.
+    """
+    tokens = [estimate_tokens(message) for message in messages]
+    return {
+        "$push": {"messages": {"$each": messages}, "message_tokens": {"$each": tokens}},
+        "$inc": {"message_count": len(messages), "token_count": sum(tokens)},
+        "$set": {"updated_at": timestamp},
+        "$setOnInsert": {
+            "user_id": user_id,
+            "thread_name": thread_name,
+            "created_at": timestamp,
+        }
+    }
+
+
+def _window_pipeline(conversation_id: str, max_tokens: int) -> List[Dict]:
+    """
+    Returns the aggregation reading the newest messages of a conversation
+    document that fit in max_tokens. Message i fits, together with everything
+    after it, if the tokens before it add up to at least token_count -
+    max_tokens; $reduce runs that prefix sum over message_tokens on the server
+    and counts the messages that pass. indexed is false for documents whose
+    message_tokens do not cover every message. bucket_size is passed through
+    so readers can tell a bucketed conversation, which has no messages here.
+    """
+    messages = {"$ifNull": ["$messages", []]}
+    tokens = {"$ifNull": ["$message_tokens", []]}
+    threshold = {"$subtract": [{"$ifNull": ["$token_count", 0]}, max_tokens]}
+    prefix_sums = {"$reduce": {
+        "input": tokens,
+        "initialValue": {"before": 0, "fitting": 0},
+        "in": {
+            "before": {"$add": ["$$value.before", "$$this"]},
+            "fitting": {"$add": ["$$value.fitting", {"$cond": [{"$gte": ["$$value.before", threshold]}, 1, 0]}]},
+        },
+    }}
+    return [
+        {"$match": {"_id": conversation_id}},
+        {"$project": {
+            "user_id": True,
+            "thread_name": True,
+            ARCHIVED_FIELD: True,
+            "bucket_size": True,
+            "indexed": {"$eq": [{"$size": tokens}, {"$size": messages}]},
+            "messages": {"$let": {
+                "vars": {"sums": prefix_sums},
+                # $slice needs a positive count; an empty window starts past the end
+                "in": {"$slice": [messages, {"$subtract": [{"$size": messages}, "$$sums.fitting"]},
+                                  {"$max": ["$$sums.fitting", 1]}]},
+            }},
+        }},
+    ]
+
+
+def _check_durability(durability: Optional[str]) -> None:
+    if durability is not None and durability not in DURABILITY_LEVELS:
+        raise ValueError(f"Unknown durability level {durability!r}, expected one of {sorted(DURABILITY_LEVELS)}")
 
 
 # Test code
@@ -198,7 +1022,7 @@ if __name__ == "__main__":
     manager = MongoDBManager(connection_string=connection_string, database_name="chai_test_db")
 
     print("Testing MongoDBManager._ensure_indexes()")
-    # Indexes are created automatically in __init__
+    # Indexes are created automatically on first use
     indexes = list(manager.conversations.list_indexes())
     print(f"Created {len(indexes)} indexes")
 
@@ -236,4 +1060,36 @@ if __name__ == "__main__":
     print("\nCleaning up test data...")
     manager._wipe_database()
     manager.close()
+
+    print("\nTesting MongoDBManager write-behind appends")
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_test_db", write_behind=True)
+    futures = [manager.append_message("test_user", f"thread{i % 3}", {"role": "user", "content": str(i)})
+               for i in range(30)]
+    futures[-1].result()
+    retrieved = manager.get_conversation("test_user", "thread0")
+    if [message["content"] for message in retrieved] == [str(i) for i in range(0, 30, 3)]:
+        print("Successfully appended messages in order!")
+    else:
+        print(f"Failed! Unexpected messages: {retrieved}")
+
+    manager._wipe_database()
+    manager.close()
+
+    print("\nTesting MongoDBManager bucketed storage")
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_test_db")
+    manager.save_conversation("test_user", "test_thread", [{"role": "user", "content": str(i)} for i in range(5)])
+    manager.close()
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_test_db",
+                             storage_mode="bucketed", bucket_size=2)
+    migrated = manager.migrate_to_buckets()
+    manager.append_message("test_user", "test_thread", {"role": "user", "content": "5"})
+    retrieved = manager.get_conversation("test_user", "test_thread")
+    buckets = manager.buckets.count_documents({"user_id": "test_user", "thread_name": "test_thread"})
+    if migrated == 1 and [message["content"] for message in retrieved] == [str(i) for i in range(6)] and buckets == 3:
+        print("Successfully migrated and appended to buckets!")
+    else:
+        print(f"Failed! Migrated {migrated}, {buckets} buckets, messages: {retrieved}")
+
+    manager._wipe_database()
+    manager.close()
     print("All tests passed!")
\ No newline at end of file
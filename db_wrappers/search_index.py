@@ -0,0 +1,277 @@
+import os
+import re
+import sqlite3
+import threading
+from typing import List, Dict, NamedTuple, Optional
+
+SCHEMA = """
+-- One row per indexed message; its rowid is the rowid of the message's text in message_text
+CREATE TABLE IF NOT EXISTS indexed_messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message_index INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS by_conversation ON indexed_messages (conversation_id, message_index);
+
+-- The inverted index: each term maps to the rowids of the messages containing it, with positions for phrases
+CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5(content, tokenize = 'unicode61 remove_diacritics 2');
+"""
+
+# A quoted phrase or a single unquoted term of a search query
+_QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+class SearchHit(NamedTuple):
+    conversation_id: str
+    message_index: int
+    score: float
+    snippet: str
+
+
+class SearchIndex:
+    """
+    Full-text index over the messages of a conversation store, kept in an
+    SQLite database using the FTS5 extension. FTS5 is an inverted index, so a
+    query only reads the entries of its own terms, and its cost depends on how
+    many messages match rather than on how many are stored.
+
+    Messages are identified by conversation ID and their position in the
+    conversation. Only the text under text_field is indexed; messages without
+    text there are counted, so positions stay right, but never match.
+    FlatFileManager(search=True) keeps an index up to date on every save,
+    append and delete.
+    """
+
+    def __init__(self, index_path: str, text_field: str = "content", busy_timeout: float = 30.0):
+        """
+        Opens the index, creating it if needed.
+
+        Args:
+            index_path (str): SQLite database file holding the index
+            text_field (str): Message key whose text is indexed
+            busy_timeout (float): Seconds a write waits for other writers
+        """
+        self.index_path = index_path
+        self.text_field = text_field
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        try:
+            self._connection().executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            if "fts5" in str(e):
+                raise RuntimeError("SearchIndex requires an SQLite build with the FTS5 extension") from e
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Returns the calling thread's connection, opening it on first use.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def replace_conversation(self, conversation_id: str, messages: List[Dict]) -> None:
+        """
+        Indexes a conversation's messages in place of whatever was indexed for it.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._remove(connection, conversation_id)
+            self._add(connection, conversation_id, 0, messages)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def append_messages(self, conversation_id: str, messages: List[Dict]) -> None:
+        """
+        Indexes messages appended to the end of a conversation.
+        """
+        if not messages:
+            return
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            last, = connection.execute("SELECT max(message_index) FROM indexed_messages WHERE conversation_id = ?",
+                                       (conversation_id,)).fetchone()
+            self._add(connection, conversation_id, 0 if last is None else last + 1, messages)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def remove_conversation(self, conversation_id: str) -> None:
+        """
+        Drops a conversation from the index.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._remove(connection, conversation_id)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _add(self, connection: sqlite3.Connection, conversation_id: str, start: int, messages: List[Dict]) -> None:
+        # Rowids are assigned here so that both tables can be filled with executemany
+        first_id, = connection.execute("SELECT coalesce(max(id), 0) + 1 FROM indexed_messages").fetchone()
+        rows = []
+        texts = []
+        for offset, message in enumerate(messages):
+            rows.append((first_id + offset, conversation_id, start + offset))
+            text = message.get(self.text_field) if isinstance(message, dict) else None
+            if isinstance(text, str) and text:
+                texts.append((first_id + offset, text))
+        connection.executemany("INSERT INTO indexed_messages VALUES (?, ?, ?)", rows)
+        connection.executemany("INSERT INTO message_text (rowid, content) VALUES (?, ?)", texts)
+
+    @staticmethod
+    def _remove(connection: sqlite3.Connection, conversation_id: str) -> None:
+        connection.execute("DELETE FROM message_text WHERE rowid IN "
+                           "(SELECT id FROM indexed_messages WHERE conversation_id = ?)", (conversation_id,))
+        connection.execute("DELETE FROM indexed_messages WHERE conversation_id = ?", (conversation_id,))
+
+    def search(self, query: str, limit: int = 20, conversation_prefix: Optional[str] = None) -> List[SearchHit]:
+        """
+        Finds the messages containing every term and "quoted phrase" of a query,
+        best matches first. Matching ignores case and diacritics; a term ending in
+        * matches any word starting with it.
+
+        Args:
+            query (str): Terms and phrases, e.g. 'refund "order number"'
+            limit (int): Maximum number of hits to return
+            conversation_prefix (str): Only search conversations whose ID starts
+                with this, such as "<user_id>_" for one user's threads
+
+        Returns:
+            List[SearchHit]: Matching messages, ranked by BM25 relevance
+        """
+        match = to_fts_query(query)
+        if match is None or limit <= 0:
+            return []
+        sql = ("SELECT m.conversation_id, m.message_index, bm25(message_text), "
+               "snippet(message_text, 0, '[', ']', '...', 12) "
+               "FROM message_text JOIN indexed_messages AS m ON m.id = message_text.rowid "
+               "WHERE message_text MATCH ?")
+        parameters = [match]
+        if conversation_prefix:
+            sql += " AND substr(m.conversation_id, 1, ?) = ?"
+            parameters += [len(conversation_prefix), conversation_prefix]
+        # bm25() is lower for better matches
+        sql += " ORDER BY bm25(message_text) LIMIT ?"
+        rows = self._connection().execute(sql, (*parameters, limit))
+        return [SearchHit(conversation_id, message_index, -score, snippet)
+                for conversation_id, message_index, score, snippet in rows]
+
+    def count(self) -> int:
+        """
+        Returns the number of indexed messages.
+        """
+        return self._connection().execute("SELECT count(*) FROM indexed_messages").fetchone()[0]
+
+    def rebuild(self, manager, workers: int = 8, batch_size: int = 100) -> int:
+        """
+        Re-creates the whole index from a FlatFileManager, reading conversations
+        on a pool of worker threads. The new index replaces the old one in a
+        single transaction, so searches see either one or the other. Run it while
+        the store is not being written to; writes made during the rebuild may be
+        indexed twice or not at all.
+
+        Args:
+            manager (FlatFileManager): The store to index
+            workers (int): Threads reading and parsing conversation files
+            batch_size (int): Conversations read before their messages are indexed
+
+        Returns:
+            int: Number of messages indexed
+        """
+        conversation_ids = manager.list_conversations()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM message_text")
+            connection.execute("DELETE FROM indexed_messages")
+            indexed = 0
+            for start in range(0, len(conversation_ids), batch_size):
+                batch = conversation_ids[start:start + batch_size]
+                for conversation_id, messages in manager.get_conversations(batch, max_workers=workers):
+                    self._add(connection, conversation_id, 0, messages)
+                    indexed += len(messages)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("INSERT INTO message_text (message_text) VALUES ('optimize')")
+        return indexed
+
+    def close(self) -> None:
+        """
+        Closes the connections of every thread that used the index.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+def to_fts_query(query: str) -> Optional[str]:
+    """
+    Converts a search box query into an FTS5 MATCH expression. Every term and
+    phrase is quoted, so FTS5 operators and punctuation in the query are
+    searched for as text instead of being interpreted.
+
+    Returns:
+        str: The MATCH expression, or None if the query has no terms
+    """
+    parts = []
+    for phrase, term in _QUERY_TOKEN.findall(query):
+        text = phrase if phrase else term
+        prefix = not phrase and text.endswith("*")
+        text = text.rstrip("*") if prefix else text
+        if not text.strip():
+            continue
+        quoted = '"' + text.replace('"', '""') + '"'
+        parts.append(quoted + "*" if prefix else quoted)
+    return " AND ".join(parts) if parts else None
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from db_wrappers.flat_file_manager import FlatFileManager
+
+    parser = argparse.ArgumentParser(description="Search or rebuild the full-text index of a flat-file store.")
+    parser.add_argument("--storage-dir", default="data", help="Flat-file storage directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="Re-index every conversation from scratch")
+    rebuild_parser.add_argument("--threads", type=int, default=8)
+    search_parser = commands.add_parser("search", help="Print the best matching messages")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--prefix", help="Only search conversation IDs starting with this")
+    args = parser.parse_args()
+
+    flat_manager = FlatFileManager(storage_dir=args.storage_dir)
+    index = SearchIndex(os.path.join(args.storage_dir, "search.db"))
+    start = time.perf_counter()
+    if args.command == "rebuild":
+        count = index.rebuild(flat_manager, workers=args.threads)
+        print(f"Indexed {count} messages in {time.perf_counter() - start:.2f}s")
+    else:
+        for hit in index.search(args.query, args.limit, args.prefix):
+            print(f"{hit.conversation_id}[{hit.message_index}] ({hit.score:.2f}): {hit.snippet}")
+    index.close()
+    flat_manager.close()
@@ -0,0 +1,183 @@
+import json
+from array import array
+from typing import List, Dict, Tuple, Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """
+    Converts a conversation's message list to and from the bytes of its file.
+
+    Files are laid out so that each message occupies its own byte range.
+    encode_messages() reports where each message starts, which lets readers
+    decode single messages straight out of the file. Message i spans
+    data[offsets[i]:offsets[i + 1] - item_gap], and the last offset lies
+    trailer_size bytes before the end of the file.
+    """
+
+    name = None
+    item_gap = 0
+    trailer_size = 0
+
+    def encode_messages(self, messages: List[Dict]) -> Tuple[bytes, array]:
+        raise NotImplementedError
+
+    def decode_messages(self, data: bytes) -> List[Dict]:
+        raise NotImplementedError
+
+    def decode_item(self, data: bytes) -> Dict:
+        raise NotImplementedError
+
+
+class JsonLinesCodec(Codec):
+    """
+    A JSON array with one message per line. Files stay valid JSON for any reader.
+    """
+
+    item_gap = len(b",\n")
+    trailer_size = len(b"\n")
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        raise NotImplementedError
+
+    def encode_messages(self, messages: List[Dict]) -> Tuple[bytes, array]:
+        items = [self.dumps(message) for message in messages]
+        offsets = array('Q')
+        position = len(b"[\n")
+        for item in items:
+            offsets.append(position)
+            position += len(item) + self.item_gap
+        if not items:
+            return b"[]\n", array('Q', [len(b"[]")])
+        offsets.append(position)
+        return b"[\n" + b",\n".join(items) + b"\n]\n", offsets
+
+    def decode_messages(self, data: bytes) -> List[Dict]:
+        return self.loads(data)
+
+    def decode_item(self, data: bytes) -> Dict:
+        return self.loads(data)
+
+
+class JsonCodec(JsonLinesCodec):
+    """
+    Compact JSON using the standard library.
+    """
+
+    name = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonLinesCodec):
+    """
+    Compact JSON using orjson, which is several times faster than the standard
+    library. Requires the optional orjson package.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("The orjson codec requires the orjson package: pip install orjson")
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Binary MessagePack: an array header followed by the packed messages. Smaller
+    and faster to parse than JSON, but not human-readable. Requires the optional
+    msgpack package.
+    """
+
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires the msgpack package: pip install msgpack")
+
+    def encode_messages(self, messages: List[Dict]) -> Tuple[bytes, array]:
+        packer = msgpack.Packer()
+        chunks = [packer.pack_array_header(len(messages))]
+        offsets = array('Q', [len(chunks[0])])
+        for message in messages:
+            chunks.append(packer.pack(message))
+            offsets.append(offsets[-1] + len(chunks[-1]))
+        return b"".join(chunks), offsets
+
+    def decode_messages(self, data: bytes) -> List[Dict]:
+        return msgpack.unpackb(data)
+
+    def decode_item(self, data: bytes) -> Dict:
+        return msgpack.unpackb(data)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "msgpack": MsgpackCodec,
+}
+
+
+def get_codec(codec: Union[str, Codec]) -> Codec:
+    """
+    Returns a codec instance given its name or an existing instance.
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {sorted(CODECS)}")
+    return CODECS[codec]()
+
+
+def json_codec() -> JsonLinesCodec:
+    """
+    Returns the fastest available JSON codec.
+    """
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+def detect_codec(data: bytes) -> Codec:
+    """
+    Returns the codec that can decode a conversation file, judging by its first
+    bytes. JSON files of every vintage, including indent=2 files, start with "[".
+    """
+    first = data[:1]
+    if first == b"[" or first.isspace():
+        return json_codec()
+    if first and (0x90 <= first[0] <= 0x9f or first[0] in (0xdc, 0xdd)):
+        return MsgpackCodec()
+    raise ValueError("Unrecognized conversation file format")
+
+
+def available_codecs() -> List[str]:
+    """
+    Returns the names of the codecs whose dependencies are installed.
+    """
+    names = ["json"]
+    if orjson is not None:
+        names.append("orjson")
+    if msgpack is not None:
+        names.append("msgpack")
+    return names
@@ -0,0 +1,397 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, UTC
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+
+from db_wrappers.serialization import json_codec
+from db_wrappers.tokens import estimate_tokens
+
+# Bump when SCHEMA changes
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    user_id TEXT NOT NULL,
+    thread_name TEXT NOT NULL,
+    message_count INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, thread_name)
+) WITHOUT ROWID;
+
+-- Thread catalog: answers list_user_threads and list_threads from the index alone, newest first
+CREATE INDEX IF NOT EXISTS user_catalog ON threads (user_id, updated_at DESC, thread_name, message_count);
+
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    thread_name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message BLOB NOT NULL,
+    PRIMARY KEY (user_id, thread_name, seq)
+) WITHOUT ROWID;
+"""
+
+# Values of PRAGMA synchronous accepted by SQLiteManager
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL")
+
+
+class SQLiteManager:
+    """
+    Manages storing and retrieving chat conversations in an embedded SQLite
+    database. Needs no server, like flat files, but appends only insert the new
+    rows and every lookup is served by an index, like MongoDB.
+
+    Each message is one row of the messages table, keyed by (user_id,
+    thread_name, seq) where seq counts from 0. The threads table holds one row
+    per conversation with its message_count, which appends advance to number
+    their messages. Messages are stored as compact JSON.
+
+    The database runs in WAL mode, so readers never wait for a writer and a
+    commit appends to the write-ahead log instead of rewriting pages in place.
+    Every thread using the manager gets its own connection; writers take turns
+    on SQLite's database lock, waiting up to busy_timeout for it.
+    """
+
+    def __init__(self, database_path: str = "chai.db", synchronous: str = "NORMAL", busy_timeout: float = 30.0):
+        """
+        Initializes the SQLiteManager, creating the database if needed.
+
+        Args:
+            database_path (str): Database file; its directory is created if missing
+            synchronous (str): "OFF" leaves flushing commits to disk to the OS,
+                "NORMAL" fsyncs the log at checkpoints only, so the latest commits
+                may be lost in a power cut but never corrupted, and "FULL" fsyncs
+                every commit
+            busy_timeout (float): Seconds a write waits for other writers
+        """
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode {synchronous!r}, expected one of {SYNCHRONOUS_MODES}")
+        self.database_path = database_path
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self._json = json_codec()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Returns the calling thread's connection, opening it on first use.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # isolation_level=None leaves transactions to the explicit BEGIN statements below
+            connection = sqlite3.connect(self.database_path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _write(self) -> "_Transaction":
+        """
+        Returns the calling thread's connection after starting a write
+        transaction on it. BEGIN IMMEDIATE takes the write lock up front, so a
+        transaction never fails halfway through waiting to upgrade a read lock.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        return _Transaction(connection)
+
+    def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Dict]:
+        """
+        Retrieves the messages of a conversation, or a window of them.
+
+        Args:
+            user_id (str): The user's ID
+            thread_name (str): The name of the conversation thread
+            offset (int): Index of the first message to return; negative values
+                count back from the end
+            limit (int): Maximum number of messages to return
+
+        Returns:
+            List[Dict]: List of message dictionaries, or empty list if not found
+        """
+        if limit is not None and limit <= 0:
+            return []
+        limit = -1 if limit is None else limit  # LIMIT -1 means no limit
+        offset = offset or 0
+        if offset >= 0:
+            rows = self._connection().execute(
+                "SELECT message FROM messages WHERE user_id = ? AND thread_name = ? AND seq >= ? "
+                "ORDER BY seq LIMIT ?", (user_id, thread_name, offset, limit))
+        else:
+            rows = self._connection().execute(
+                "SELECT message FROM messages WHERE user_id = ? AND thread_name = ? AND seq >= "
+                "(SELECT message_count FROM threads WHERE user_id = ? AND thread_name = ?) + ? "
+                "ORDER BY seq LIMIT ?", (user_id, thread_name, user_id, thread_name, offset, limit))
+        return [self._json.loads(message) for message, in rows]
+
+    def get_conversations(self, user_id: str, thread_names: Iterable[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        Fetches several of a user's conversations, yielding each (thread_name,
+        messages) pair in the order requested, with an empty list for threads that
+        do not exist.
+
+        There is no round trip to save, so each thread is read with its own
+        primary key lookup, which SQLite answers faster than one IN query
+        returning every thread's rows.
+
+        Args:
+            user_id (str): The user's ID
+            thread_names (Iterable[str]): The names of the conversation threads
+        """
+        for thread_name in dict.fromkeys(thread_names):
+            yield thread_name, self.get_conversation(user_id, thread_name)
+
+    def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]:
+        """
+        Returns the last n messages of a conversation, reading only those rows.
+        """
+        if n <= 0:
+            return []
+        rows = self._connection().execute(
+            "SELECT message FROM messages WHERE user_id = ? AND thread_name = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, thread_name, n)).fetchall()
+        return [self._json.loads(message) for message, in reversed(rows)]
+
+    def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        """
+        Returns the newest messages of a conversation whose estimated tokens add
+        up to at most max_tokens, oldest first; what an LLM is sent each turn.
+
+        Rows are read newest first along the primary key and the scan stops at
+        the first message that no longer fits, so the rows read are the ones
+        returned plus one; a stored running token count would save no reads.
+        """
+        if max_tokens <= 0:
+            return []
+        rows = self._connection().execute(
+            "SELECT message FROM messages WHERE user_id = ? AND thread_name = ? ORDER BY seq DESC",
+            (user_id, thread_name))
+        window = []
+        for message, in rows:
+            message = self._json.loads(message)
+            max_tokens -= estimate_tokens(message)
+            if max_tokens < 0:
+                break
+            window.append(message)
+        rows.close()
+        window.reverse()
+        return window
+
+    def message_count(self, user_id: str, thread_name: str) -> int:
+        """
+        Returns the number of messages in a conversation without reading them.
+        """
+        row = self._connection().execute(
+            "SELECT message_count FROM threads WHERE user_id = ? AND thread_name = ?",
+            (user_id, thread_name)).fetchone()
+        return row[0] if row else 0
+
+    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        Saves the entire conversation, replacing the existing one if it exists.
+
+        Args:
+            user_id (str): The user's ID
+            thread_name (str): The name of the conversation thread
+            messages (List[Dict]): List of message dictionaries
+        """
+        timestamp = datetime.now(UTC).isoformat()
+        rows = [(user_id, thread_name, seq, self._json.dumps(message)) for seq, message in enumerate(messages)]
+        with self._write() as connection:
+            connection.execute("DELETE FROM messages WHERE user_id = ? AND thread_name = ?", (user_id, thread_name))
+            connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?)", rows)
+            connection.execute(
+                "INSERT INTO threads VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id, thread_name) "
+                "DO UPDATE SET message_count = excluded.message_count, updated_at = excluded.updated_at",
+                (user_id, thread_name, len(rows), timestamp, timestamp))
+
+    def append_message(self, user_id: str, thread_name: str, message: Dict) -> None:
+        """
+        Appends a single message to a conversation. See append_messages().
+        """
+        self.append_messages(user_id, thread_name, [message])
+
+    def append_messages(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        Appends messages to a conversation in one transaction, inserting a row
+        per message with a single prepared statement. Existing messages are not
+        touched, so the cost does not grow with the length of the conversation.
+
+        Args:
+            user_id (str): The user's ID
+            thread_name (str): The name of the conversation thread
+            messages (List[Dict]): Message dictionaries to append, in order
+        """
+        encoded = [self._json.dumps(message) for message in messages]
+        if not encoded:
+            return
+        timestamp = datetime.now(UTC).isoformat()
+        with self._write() as connection:
+            row = connection.execute(
+                "SELECT message_count FROM threads WHERE user_id = ? AND thread_name = ?",
+                (user_id, thread_name)).fetchone()
+            start = 0
+            if row is None:
+                connection.execute("INSERT INTO threads VALUES (?, ?, ?, ?, ?)",
+                                   (user_id, thread_name, len(encoded), timestamp, timestamp))
+            else:
+                start = row[0]
+                connection.execute(
+                    "UPDATE threads SET message_count = ?, updated_at = ? WHERE user_id = ? AND thread_name = ?",
+                    (start + len(encoded), timestamp, user_id, thread_name))
+            connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?)",
+                                   [(user_id, thread_name, start + i, message) for i, message in enumerate(encoded)])
+
+    def list_user_threads(self, user_id: str) -> List[str]:
+        """
+        Returns the names of a user's threads, most recently updated first.
+        """
+        rows = self._connection().execute(
+            "SELECT thread_name FROM threads WHERE user_id = ? ORDER BY updated_at DESC, thread_name", (user_id,))
+        return [thread_name for thread_name, in rows]
+
+    def list_threads(self, user_id: str, limit: int = 50, before: Optional[Dict] = None) -> List[Dict]:
+        """
+        Returns one page of a user's thread catalog, most recently updated first.
+        Same as MongoDBManager.list_threads().
+
+        Args:
+            user_id (str): The user's ID
+            limit (int): Maximum number of threads to return
+            before (Dict): The last entry of the previous page, to continue after it
+
+        Returns:
+            List[Dict]: The thread_name, updated_at and message_count of each thread
+        """
+        query = "SELECT thread_name, updated_at, message_count FROM threads WHERE user_id = ?"
+        parameters = [user_id]
+        if before is not None:
+            query += " AND (updated_at < ? OR (updated_at = ? AND thread_name > ?))"
+            parameters += [before["updated_at"], before["updated_at"], before["thread_name"]]
+        query += " ORDER BY updated_at DESC, thread_name LIMIT ?"
+        rows = self._connection().execute(query, (*parameters, limit))
+        return [{"thread_name": thread_name, "updated_at": updated_at, "message_count": message_count}
+                for thread_name, updated_at, message_count in rows]
+
+    def delete_conversation(self, user_id: str, thread_name: str) -> bool:
+        """
+        Deletes a conversation.
+
+        Returns:
+            bool: True if a conversation was deleted, False otherwise
+        """
+        with self._write() as connection:
+            connection.execute("DELETE FROM messages WHERE user_id = ? AND thread_name = ?", (user_id, thread_name))
+            deleted = connection.execute("DELETE FROM threads WHERE user_id = ? AND thread_name = ?",
+                                         (user_id, thread_name)).rowcount
+        return deleted > 0
+
+    def close(self) -> None:
+        """
+        Closes the connections of every thread that used the manager.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def _wipe_database(self) -> None:
+        """
+        **DANGEROUS**: Deletes all conversations. Only for testing!
+        """
+        with self._write() as connection:
+            connection.execute("DELETE FROM messages")
+            connection.execute("DELETE FROM threads")
+
+
+class _Transaction:
+    """
+    Commits an open transaction when its block succeeds and rolls it back when
+    the block raises.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.connection.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+# Test code
+if __name__ == "__main__":
+    import shutil
+
+    print("Testing SQLiteManager")
+    manager = SQLiteManager(database_path="data_sqlite_test/chai_test.db")
+
+    print("\nTesting SQLiteManager.save_conversation()")
+    messages = [
+        {"role": "user", "content": "hello world"},
+        {"role": "assistant", "content": "Hi there!"}
+    ]
+    manager.save_conversation("test_user", "test_thread", messages)
+    retrieved = manager.get_conversation("test_user", "test_thread")
+    if retrieved == messages:
+        print("Successfully saved and retrieved conversation!")
+    else:
+        print(f"Failed! Unexpected messages: {retrieved}")
+
+    print("\nTesting SQLiteManager.append_messages()")
+    manager.append_messages("test_user", "test_thread", [{"role": "user", "content": str(i)} for i in range(5)])
+    retrieved = manager.get_conversation("test_user", "test_thread")
+    if len(retrieved) == 7 and manager.message_count("test_user", "test_thread") == 7:
+        print("Successfully appended messages!")
+    else:
+        print(f"Failed! Expected 7 messages, got {len(retrieved)}")
+
+    print("\nTesting SQLiteManager windows")
+    window = manager.get_conversation("test_user", "test_thread", offset=-3, limit=2)
+    tail = manager.tail("test_user", "test_thread", 2)
+    if [m["content"] for m in window] == ["2", "3"] and [m["content"] for m in tail] == ["3", "4"]:
+        print("Successfully read windows!")
+    else:
+        print(f"Failed! Window {window}, tail {tail}")
+
+    print("\nTesting SQLiteManager with concurrent threads")
+    workers = [threading.Thread(target=lambda n=n: [manager.append_message("test_user", "shared", {"n": n, "i": i})
+                                                    for i in range(50)]) for n in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if manager.message_count("test_user", "shared") == len(manager.get_conversation("test_user", "shared")) == 400:
+        print("Successfully appended from 8 threads!")
+    else:
+        print(f"Failed! Expected 400 messages, got {manager.message_count('test_user', 'shared')}")
+
+    print("\nTesting SQLiteManager.list_user_threads() and delete_conversation()")
+    threads = manager.list_user_threads("test_user")
+    deleted = manager.delete_conversation("test_user", "shared")
+    if threads == ["shared", "test_thread"] and deleted and manager.list_user_threads("test_user") == ["test_thread"]:
+        print("Successfully listed and deleted threads!")
+    else:
+        print(f"Failed! Listed {threads}, deleted {deleted}")
+
+    manager.close()
+    shutil.rmtree("data_sqlite_test")
+    print("All tests passed!")
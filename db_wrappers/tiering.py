@@ -0,0 +1,350 @@
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta, UTC
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pymongo.collection import Collection
+
+from db_wrappers.flat_file_manager import FlatFileManager
+from db_wrappers.mongodb_manager import ARCHIVED_FIELD, ArchivedConversationError, MongoDBManager
+
+
+class TieredStore:
+    """
+    Keeps recently used conversations in MongoDB and moves idle ones to an
+    archive of compressed flat files, so that threads nobody has touched in
+    months stop taking up the database's memory and indexes.
+
+    demote_idle() archives every conversation whose updated_at is more than
+    idle_days old. Its MongoDB document is stripped down to a tombstone that
+    records where the messages went; the thread keeps its place in
+    list_user_threads() and list_threads(), and message_count() still answers.
+    The first get_conversation(), tail() or append that reaches a tombstone
+    promotes the conversation back into MongoDB and then completes normally.
+    get_conversations() reads archived threads straight from the archive
+    without promoting them, so bulk exports leave the tiers as they are.
+
+    The archive should be created with compression (e.g. compression="zstd",
+    compress_min_bytes=0) and, to survive power loss as well as MongoDB does,
+    durable=True. Other MongoDBManagers may write to the same collections: their
+    appends to an archived conversation raise ArchivedConversationError (through
+    the future, with write_behind) rather than touch the tombstone.
+    """
+
+    def __init__(self, hot: MongoDBManager, archive: FlatFileManager, idle_days: float = 90,
+                 claim_timeout: float = 60.0, lock_stripes: int = 64):
+        """
+        Args:
+            hot (MongoDBManager): Where conversations live while in use
+            archive (FlatFileManager): Where idle conversations are moved to
+            idle_days (float): Default age of updated_at after which demote_idle()
+                archives a conversation
+            claim_timeout (float): Seconds after which a promotion that another
+                process started, and apparently never finished, is taken over
+            lock_stripes (int): Number of locks that moves of individual
+                conversations within this process are spread across
+        """
+        if hot.write_behind:
+            raise ValueError("TieredStore requires a MongoDBManager without write_behind")
+        self.hot = hot
+        self.archive = archive
+        self.idle_days = idle_days
+        self.claim_timeout = claim_timeout
+        self.demotions = 0
+        self.promotions = 0
+        self._promotion_times = deque(maxlen=1000)
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _lock(self, conversation_id: str) -> threading.Lock:
+        return self._locks[zlib.crc32(conversation_id.encode()) % len(self._locks)]
+
+    def _promoting(self, operation: Callable):
+        """
+        Runs a MongoDBManager operation, promoting the conversation and running it
+        again if it turns out to be archived.
+        """
+        try:
+            return operation()
+        except ArchivedConversationError as e:
+            self.promote(e.user_id, e.thread_name)
+            return operation()
+
+    def get_conversation(self, user_id: str, thread_name: str, offset: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Dict]:
+        """
+        MongoDBManager.get_conversation(), promoting archived conversations.
+        """
+        return self._promoting(lambda: self.hot.get_conversation(user_id, thread_name, offset, limit))
+
+    def get_conversations(self, user_id: str, thread_names: Iterable[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        MongoDBManager.get_conversations(), with archived threads read from the
+        archive instead and yielded last.
+        """
+        thread_names = list(dict.fromkeys(thread_names))
+        tombstones = self.hot.conversations.find(
+            {"user_id": user_id, "thread_name": {"$in": thread_names}, ARCHIVED_FIELD: {"$exists": True}},
+            {"thread_name": True, "_id": False})
+        archived = {f"{user_id}_{document['thread_name']}": document["thread_name"] for document in tombstones}
+        yield from self.hot.get_conversations(user_id, [thread_name for thread_name in thread_names
+                                                        if thread_name not in archived.values()])
+        for conversation_id, messages in self.archive.get_conversations(archived):
+            if conversation_id not in self.archive.conversations_index:
+                # Promoted since the tombstone was read, so the archive copy is gone.
+                # An archived conversation with no messages is still in the index.
+                messages = self.get_conversation(user_id, archived[conversation_id])
+            yield archived[conversation_id], messages
+
+    def tail(self, user_id: str, thread_name: str, n: int) -> List[Dict]:
+        """
+        MongoDBManager.tail(), promoting archived conversations.
+        """
+        return self._promoting(lambda: self.hot.tail(user_id, thread_name, n))
+
+    def get_context_window(self, user_id: str, thread_name: str, max_tokens: int) -> List[Dict]:
+        """
+        MongoDBManager.get_context_window(), promoting archived conversations.
+        """
+        return self._promoting(lambda: self.hot.get_context_window(user_id, thread_name, max_tokens))
+
+    def message_count(self, user_id: str, thread_name: str) -> int:
+        """
+        MongoDBManager.message_count(). Answered by tombstones too, without promoting.
+        """
+        return self.hot.message_count(user_id, thread_name)
+
+    def save_conversation(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        MongoDBManager.save_conversation(). Replaces an archived conversation
+        outright, discarding its archive copy.
+        """
+        conversation_id = f"{user_id}_{thread_name}"
+        with self._lock(conversation_id):
+            self.hot.save_conversation(user_id, thread_name, messages)
+            self.archive.delete_conversation(conversation_id)
+
+    def append_message(self, user_id: str, thread_name: str, message: Dict) -> None:
+        """
+        MongoDBManager.append_message(), promoting archived conversations.
+        """
+        self.append_messages(user_id, thread_name, [message])
+
+    def append_messages(self, user_id: str, thread_name: str, messages: List[Dict]) -> None:
+        """
+        MongoDBManager.append_messages(), promoting archived conversations.
+        """
+        self._promoting(lambda: self.hot.append_messages(user_id, thread_name, messages))
+
+    def list_user_threads(self, user_id: str) -> List[str]:
+        """
+        MongoDBManager.list_user_threads(), including archived threads.
+        """
+        return self.hot.list_user_threads(user_id)
+
+    def list_threads(self, user_id: str, limit: int = 50, before: Optional[Dict] = None) -> List[Dict]:
+        """
+        MongoDBManager.list_threads(), including archived threads.
+        """
+        return self.hot.list_threads(user_id, limit, before)
+
+    def delete_conversation(self, user_id: str, thread_name: str) -> bool:
+        """
+        Deletes a conversation from both tiers.
+
+        Returns:
+            bool: True if a conversation was deleted, False otherwise
+        """
+        conversation_id = f"{user_id}_{thread_name}"
+        with self._lock(conversation_id):
+            deleted = self.hot.delete_conversation(user_id, thread_name)
+            return self.archive.delete_conversation(conversation_id) or deleted
+
+    def demote_idle(self, idle_days: Optional[float] = None, limit: Optional[int] = None) -> int:
+        """
+        Archives conversations that have not been updated for idle_days. Meant to
+        run periodically; it scans the conversations collection, which is fine
+        for a background job and spares the hot tier an extra index.
+
+        Each conversation is written to the archive before its MongoDB document
+        becomes a tombstone, and the tombstone is only set if updated_at has not
+        changed in between, so a conversation written to during its demotion
+        stays in MongoDB.
+
+        Args:
+            idle_days (float): Archive conversations idle this long. Defaults to
+                the store's idle_days.
+            limit (int): Archive at most this many conversations
+
+        Returns:
+            int: Number of conversations archived
+        """
+        idle_days = self.idle_days if idle_days is None else idle_days
+        cutoff = (datetime.now(UTC) - timedelta(days=idle_days)).isoformat()
+        candidates = self.hot.conversations.find({"updated_at": {"$lt": cutoff}, ARCHIVED_FIELD: {"$exists": False}},
+                                                 {"user_id": True, "thread_name": True, "updated_at": True})
+        if limit is not None:
+            candidates = candidates.limit(limit)
+
+        demoted = 0
+        for document in candidates:
+            if self._demote(document):
+                demoted += 1
+        self.demotions += demoted
+        return demoted
+
+    def _demote(self, document: Dict) -> bool:
+        user_id = document["user_id"]
+        thread_name = document["thread_name"]
+        conversation_id = document["_id"]
+        with self._lock(conversation_id):
+            try:
+                messages = self.hot.get_conversation(user_id, thread_name)
+            except ArchivedConversationError:
+                return False
+            self.archive.save_conversation(conversation_id, f"{conversation_id}.json", messages)
+            tombstone = {
+                "store": "flat_file",
+                "path": self.archive.conversations_index[conversation_id],
+                "archived_at": datetime.now(UTC).isoformat(),
+            }
+            result = self.hot.conversations.update_one(
+                {"_id": conversation_id, "updated_at": document["updated_at"], ARCHIVED_FIELD: {"$exists": False}},
+                {"$set": {ARCHIVED_FIELD: tombstone, "message_count": len(messages)},
+                 "$unset": {"messages": "", "message_tokens": ""}})
+            if result.modified_count == 0:
+                # Written to since it was selected, so it is no longer idle
+                self.archive.delete_conversation(conversation_id)
+                return False
+            self.hot.buckets.delete_many({"user_id": user_id, "thread_name": thread_name})
+            return True
+
+    def promote(self, user_id: str, thread_name: str) -> bool:
+        """
+        Moves an archived conversation back into MongoDB. Concurrent promotions of
+        the same conversation, in this process or others, wait for the first one
+        instead of repeating it.
+
+        Returns:
+            bool: True if this call moved the conversation, False if it was not archived
+
+        Raises:
+            FileNotFoundError: If the archive has no copy of the conversation. The
+                tombstone is left in place.
+        """
+        conversation_id = f"{user_id}_{thread_name}"
+        start = time.perf_counter()
+        with self._lock(conversation_id):
+            while True:
+                tombstone = self.hot.conversations.find_one({"_id": conversation_id},
+                                                            {ARCHIVED_FIELD: True, "created_at": True})
+                if tombstone is None or ARCHIVED_FIELD not in tombstone:
+                    return False
+                # Claim the promotion so that other processes wait instead of
+                # restoring the archive copy over appends made after this one
+                claimed = self.hot.conversations.update_one(
+                    {"_id": conversation_id, ARCHIVED_FIELD: {"$exists": True},
+                     "$or": [{f"{ARCHIVED_FIELD}.promoting": {"$exists": False}},
+                             {f"{ARCHIVED_FIELD}.promoting": {"$lt": time.time() - self.claim_timeout}}]},
+                    {"$set": {f"{ARCHIVED_FIELD}.promoting": time.time()}})
+                if claimed.modified_count:
+                    break
+                time.sleep(0.01)
+
+            if self.archive.last_modified(conversation_id) is None:
+                # Release the claim so the tombstone stays as it was
+                self.hot.conversations.update_one({"_id": conversation_id},
+                                                  {"$unset": {f"{ARCHIVED_FIELD}.promoting": ""}})
+                raise FileNotFoundError(f"Archived conversation {conversation_id} is missing from the archive "
+                                        f"at {self.archive.storage_dir}")
+            # Saving removes the tombstone, after which appends go through again
+            self.hot.save_conversation(user_id, thread_name, self.archive.get_conversation(conversation_id))
+            if "created_at" in tombstone:
+                self.hot.conversations.update_one({"_id": conversation_id},
+                                                  {"$set": {"created_at": tombstone["created_at"]}})
+            self.archive.delete_conversation(conversation_id)
+
+        self.promotions += 1
+        self._promotion_times.append(time.perf_counter() - start)
+        return True
+
+    def stats(self) -> Dict:
+        """
+        Reports the size of each tier and how long recent promotions took.
+
+        Returns:
+            Dict: hot_threads and cold_threads, the number of conversations in each
+                tier; hot_bytes and hot_index_bytes, the data and index size of the
+                MongoDB collections; cold_bytes, the disk usage of the archive;
+                demotions and promotions made by this store; and the p50, p99 and
+                max promotion latency in seconds over the last 1000 promotions
+        """
+        conversations = self.hot.conversations
+        hot_bytes = 0
+        hot_index_bytes = 0
+        for collection in (conversations, self.hot.buckets):
+            storage = _storage_stats(collection)
+            hot_bytes += storage.get("size", 0)
+            hot_index_bytes += storage.get("totalIndexSize", 0)
+
+        cold_bytes = 0
+        for directory, _, filenames in os.walk(self.archive.storage_dir):
+            for filename in filenames:
+                try:
+                    cold_bytes += os.path.getsize(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    continue
+
+        times = sorted(self._promotion_times)
+        return {
+            "hot_threads": conversations.count_documents({ARCHIVED_FIELD: {"$exists": False}}),
+            "cold_threads": conversations.count_documents({ARCHIVED_FIELD: {"$exists": True}}),
+            "hot_bytes": hot_bytes,
+            "hot_index_bytes": hot_index_bytes,
+            "cold_bytes": cold_bytes,
+            "demotions": self.demotions,
+            "promotions": self.promotions,
+            "promotion_p50": times[len(times) // 2] if times else None,
+            "promotion_p99": times[int(len(times) * 0.99)] if times else None,
+            "promotion_max": times[-1] if times else None,
+        }
+
+    def close(self) -> None:
+        """
+        Closes both tiers.
+        """
+        self.hot.close()
+        self.archive.close()
+
+
+def _storage_stats(collection: Collection) -> Dict:
+    # A collection that does not exist yet has no storage statistics
+    for result in collection.aggregate([{"$collStats": {"storageStats": {}}}]):
+        return result.get("storageStats", {})
+    return {}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Archive idle MongoDB conversations to compressed flat files.")
+    parser.add_argument("--connection-string", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="chai_db")
+    parser.add_argument("--storage-mode", default="document", choices=["document", "bucketed"])
+    parser.add_argument("--archive-dir", default="archive", help="Flat-file storage directory for the archive")
+    parser.add_argument("--idle-days", type=float, default=90)
+    parser.add_argument("--limit", type=int, help="Archive at most this many conversations")
+    args = parser.parse_args()
+
+    store = TieredStore(MongoDBManager(connection_string=args.connection_string, database_name=args.database,
+                                       storage_mode=args.storage_mode),
+                        FlatFileManager(storage_dir=args.archive_dir, compression="zlib", compress_min_bytes=0,
+                                        durable=True, shard_levels=1),
+                        idle_days=args.idle_days)
+    start = time.perf_counter()
+    count = store.demote_idle(limit=args.limit)
+    print(f"Archived {count} conversations in {time.perf_counter() - start:.2f}s")
+    print(store.stats())
+    store.close()
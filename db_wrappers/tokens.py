@@ -0,0 +1,65 @@
+import json
+from typing import Dict, List, Sequence, Tuple
+
+# Rough number of characters per token in English text, for common LLM tokenizers
+CHARS_PER_TOKEN = 4
+# Tokens a message costs on top of its content, for its role and separators
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(message: Dict) -> int:
+    """
+    Estimates how many tokens a message takes up in an LLM's context window,
+    from the length of its content. Deliberately cheap, so it can be computed on
+    every write; it is not exact for any particular tokenizer.
+    """
+    content = message.get("content") if isinstance(message, dict) else message
+    if content is None:
+        length = 0
+    elif isinstance(content, str):
+        length = len(content)
+    else:
+        length = len(json.dumps(content, ensure_ascii=False))
+    return MESSAGE_OVERHEAD + (length + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def token_offsets(messages: Sequence[Dict], start: int = 0) -> List[int]:
+    """
+    Returns the running token count of a list of messages: entry i is the
+    number of tokens before message i, and the extra last entry is the total.
+    Like byte offsets, they let a reader find where the newest max_tokens
+    begin without looking at the messages.
+
+    Args:
+        messages (Sequence[Dict]): The messages, oldest first
+        start (int): Tokens already preceding the first message
+    """
+    offsets = [start]
+    for message in messages:
+        offsets.append(offsets[-1] + estimate_tokens(message))
+    return offsets
+
+
+def newest_fitting(messages: Sequence[Dict], max_tokens: int) -> Tuple[int, int]:
+    """
+    Counts how many of the newest messages fit in max_tokens together.
+
+    Returns:
+        Tuple[int, int]: The number of messages that fit and the tokens they use
+    """
+    used = 0
+    for count, message in enumerate(reversed(messages)):
+        tokens = estimate_tokens(message)
+        if used + tokens > max_tokens:
+            return count, used
+        used += tokens
+    return len(messages), used
+
+
+def context_window(messages: List[Dict], max_tokens: int) -> List[Dict]:
+    """
+    Returns the newest messages whose estimated tokens add up to at most
+    max_tokens, oldest first.
+    """
+    count, _ = newest_fitting(messages, max_tokens)
+    return messages[len(messages) - count:]
@@ -0,0 +1,125 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+class WriteBehindBuffer:
+    """
+    Collects writes from many callers and hands them to a flush function in
+    batches, off the callers' threads.
+
+    submit() queues an item and returns at once with a Future. A background
+    thread waits until either max_delay seconds have passed since the oldest
+    queued item arrived or max_batch items are waiting, then passes the batch to
+    flush_fn in submission order. Futures resolve when their batch is written, or
+    carry the exception flush_fn raised. A flush_fn that can fail some items and
+    still write the rest returns a list instead, holding each item's exception or
+    None. flush() is a barrier that writes everything queued so far without
+    waiting for the deadline.
+    """
+
+    def __init__(self, flush_fn: Callable[[List[Any]], None], max_delay: float = 0.005, max_batch: int = 500):
+        """
+        Args:
+            flush_fn (Callable): Writes a list of queued items, raising on failure or
+                returning a list of per-item exceptions
+            max_delay (float): Longest time in seconds an item waits for its batch
+            max_batch (int): Number of queued items that triggers an early flush
+        """
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._flush_fn = flush_fn
+        self._pending = []
+        self._oldest = 0.0
+        self._submitted = 0
+        self._completed = 0
+        self._barrier = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """
+        Queues an item to be written in a later batch.
+
+        Returns:
+            Future: Resolves to None once the item is written
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindBuffer is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((item, future))
+            self._submitted += 1
+            self._cond.notify_all()
+        return future
+
+    def pending(self) -> int:
+        """
+        Returns the number of items queued or being written.
+        """
+        with self._cond:
+            return self._submitted - self._completed
+
+    def flush(self) -> None:
+        """
+        Blocks until every item submitted before the call has been written or has
+        failed. Failures are reported through the items' futures, not raised here.
+        """
+        with self._cond:
+            target = self._submitted
+            self._barrier = max(self._barrier, target)
+            self._cond.notify_all()
+            while self._completed < target:
+                self._cond.wait()
+
+    def close(self) -> None:
+        """
+        Writes any queued items and stops the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                while (len(self._pending) < self.max_batch and not self._closed
+                       and self._barrier <= self._completed):
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                if self._pending:
+                    self._oldest = time.monotonic()
+            self._write(batch)
+
+    def _write(self, batch) -> None:
+        try:
+            errors = self._flush_fn([item for item, _ in batch]) or [None] * len(batch)
+        except Exception as e:
+            errors = [e] * len(batch)
+
+        for (_, future), error in zip(batch, errors):
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        with self._cond:
+            self.batches += 1
+            self.writes += len(batch)
+            self._completed += len(batch)
+            self._cond.notify_all()
@@ -1,87 +1,80 @@
 import time
 import random
 import string
+import asyncio
+import multiprocessing
+import os
+import sys
+from db_wrappers.async_flat_file_manager import AsyncFlatFileManager
+from db_wrappers.async_mongodb_manager import AsyncMongoDBManager
+from db_wrappers.backends import open_backend
 from db_wrappers.flat_file_manager import FlatFileManager
-from db_wrappers.mongodb_manager import MongoDBManager
+from db_wrappers.mongodb_manager import MongoDBManager, _verified_schemas
+from db_wrappers.serialization import available_codecs
+from db_wrappers.sqlite_manager import SQLiteManager
+from db_wrappers.tiering import TieredStore
+from db_wrappers.tokens import context_window
 
 PASSWORD = ""
-CONNECTION_STRING = f""
+# MongoDB server for the MongoDB tests, e.g. mongodb://localhost:27017/; they are skipped if it is not set
+CONNECTION_STRING = os.getenv("CHAI_PERF_MONGODB_URL", "")
+MONGODB_SKIPPED = "MongoDB: skipped, set CHAI_PERF_MONGODB_URL to include it"
+
+# Backends the generic tests run against: key => (label, URL, options for open_backend)
+# More can be given on the command line, e.g. python performance.py file:///mnt/ssd/chai
+PERF_BACKENDS = {
+    'flat_file': ("Flat File", "file://data_perf_test", {}),
+    'mongodb': ("MongoDB", CONNECTION_STRING, {"database_name": "chai_perf_test"}),
+    'sqlite': ("SQLite", "sqlite://data_perf_test/perf_test.db", {}),
+}
+if not CONNECTION_STRING:
+    del PERF_BACKENDS['mongodb']
 
 def random_string(length=20):
     """Generate a random string for test data."""
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 
 
-def test_flat_file_append_performance(num_messages=100):
-    """Test FlatFileManager append performance."""
-    manager = FlatFileManager(storage_dir="data_perf_test")
-    conversation_id = "perf_test"
-    messages = []
-
-    # Test append performance
-    append_times = []
-    for i in range(num_messages):
-        start = time.perf_counter()
-
-        # Simulate the read-modify-write cycle
-        messages = manager.get_conversation(conversation_id)
-        messages.append({"role": "user", "content": random_string()})
-        messages.append({"role": "assistant", "content": random_string()})
-        manager.save_conversation(conversation_id, f"{conversation_id}.json", messages)
-
-        end = time.perf_counter()
-        append_times.append(end - start)
-
-    # Test read performance
-    start = time.perf_counter()
-    final_messages = manager.get_conversation(conversation_id)
-    read_time = time.perf_counter() - start
-
-    # Cleanup
-    import shutil
-    shutil.rmtree("data_perf_test")
-
-    return append_times, read_time, len(final_messages)
-
-
-def test_mongodb_append_performance(num_messages=100):
-    """Test MongoDBManager append performance."""
-    connection_string = CONNECTION_STRING
-    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test")
-
+def test_append_performance(backend, num_messages=100):
+    """Test append performance of any StorageBackend."""
     user_id = "perf_test_user"
     thread_name = "perf_test_thread"
 
     # Clean slate
-    manager.delete_conversation(user_id, thread_name)
+    backend.delete_conversation(user_id, thread_name)
 
     # Test append performance
     append_times = []
     for i in range(num_messages):
         start = time.perf_counter()
 
-        manager.append_message(user_id, thread_name, {"role": "user", "content": random_string()})
-        manager.append_message(user_id, thread_name, {"role": "assistant", "content": random_string()})
+        # Persist one chat turn in a single append
+        backend.append_messages(user_id, thread_name, [
+            {"role": "user", "content": random_string()},
+            {"role": "assistant", "content": random_string()},
+        ])
 
         end = time.perf_counter()
         append_times.append(end - start)
 
     # Test read performance
     start = time.perf_counter()
-    final_messages = manager.get_conversation(user_id, thread_name)
+    final_messages = backend.get_conversation(user_id, thread_name)
     read_time = time.perf_counter() - start
 
     # Cleanup
-    manager.delete_conversation(user_id, thread_name)
-    manager.close()
+    backend.delete_conversation(user_id, thread_name)
 
     return append_times, read_time, len(final_messages)
 
 
-def test_flat_file_bulk_write(num_messages=1000):
-    """Test FlatFileManager bulk write performance (write once scenario)."""
-    manager = FlatFileManager(storage_dir="data_perf_test")
-    conversation_id = "bulk_test"
+def test_bulk_write(backend, num_messages=1000):
+    """Test bulk write performance of any StorageBackend (write once scenario)."""
+    user_id = "bulk_test_user"
+    thread_name = "bulk_test_thread"
+
+    # Clean slate
+    backend.delete_conversation(user_id, thread_name)
 
     # Generate all messages upfront
     messages = []
@@ -91,134 +84,676 @@ def test_flat_file_bulk_write(num_messages=1000):
 
     # Single bulk write
     start = time.perf_counter()
-    manager.save_conversation(conversation_id, f"{conversation_id}.json", messages)
+    backend.save_conversation(user_id, thread_name, messages)
     write_time = time.perf_counter() - start
 
     # Test read performance
     start = time.perf_counter()
-    read_messages = manager.get_conversation(conversation_id)
+    read_messages = backend.get_conversation(user_id, thread_name)
     read_time = time.perf_counter() - start
 
     # Cleanup
-    import shutil
-    shutil.rmtree("data_perf_test")
+    backend.delete_conversation(user_id, thread_name)
 
     return write_time, read_time, len(read_messages)
 
 
-def test_mongodb_bulk_write(num_messages=1000):
-    """Test MongoDBManager bulk write performance (write once scenario)."""
-    connection_string = CONNECTION_STRING
-    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test")
-
-    user_id = "bulk_test_user"
-    thread_name = "bulk_test_thread"
+def test_multiple_threads(backend, num_threads=10, messages_per_thread=50):
+    """Test any StorageBackend with multiple conversation threads."""
+    user_id = "multi_thread_user"
+    thread_names = [f"thread_{i}" for i in range(num_threads)]
 
     # Clean slate
-    manager.delete_conversation(user_id, thread_name)
+    for thread_name in backend.list_user_threads(user_id):
+        backend.delete_conversation(user_id, thread_name)
+
+    create_times = []
+
+    # Create multiple threads
+    for thread_name in thread_names:
+        messages = []
+
+        start = time.perf_counter()
+        for j in range(messages_per_thread):
+            messages.append({"role": "user", "content": random_string()})
+            messages.append({"role": "assistant", "content": random_string()})
+        backend.save_conversation(user_id, thread_name, messages)
+        create_times.append(time.perf_counter() - start)
+
+    # Test random access to different threads
+    random_access_times = []
+    for i in range(20):
+        thread_name = random.choice(thread_names)
+
+        start = time.perf_counter()
+        messages = backend.get_conversation(user_id, thread_name)
+        random_access_times.append(time.perf_counter() - start)
+
+    # Test listing all threads
+    start = time.perf_counter()
+    threads = backend.list_user_threads(user_id)
+    list_time = time.perf_counter() - start
+
+    # Cleanup
+    for thread_name in thread_names:
+        backend.delete_conversation(user_id, thread_name)
+
+    return create_times, random_access_times, list_time
+
+
+def test_flat_file_codecs(num_messages=1000, repeats=5):
+    """Compare FlatFileManager serialization codecs on write time, read time and file size."""
+    import os
+    import shutil
 
-    # Generate all messages upfront
     messages = []
     for i in range(num_messages):
         messages.append({"role": "user", "content": random_string()})
         messages.append({"role": "assistant", "content": random_string()})
 
-    # Single bulk write
-    start = time.perf_counter()
-    manager.save_conversation(user_id, thread_name, messages)
-    write_time = time.perf_counter() - start
+    results = {}
+    for codec in available_codecs():
+        manager = FlatFileManager(storage_dir="data_perf_test", codec=codec)
+        conversation_id = f"codec_{codec}"
 
-    # Test read performance
+        write_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            manager.save_conversation(conversation_id, f"{conversation_id}.json", messages)
+            write_times.append(time.perf_counter() - start)
+
+        read_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            manager.get_conversation(conversation_id)
+            read_times.append(time.perf_counter() - start)
+
+        size = os.path.getsize(os.path.join("data_perf_test", manager.conversations_index[conversation_id]))
+        results[codec] = (min(write_times), min(read_times), size)
+
+    shutil.rmtree("data_perf_test")
+    return results
+
+
+def _flat_file_append_worker(args):
+    """Append messages from one worker process; used by test_flat_file_multiprocess."""
+    storage_dir, worker_id, num_appends, shared = args
+    manager = FlatFileManager(storage_dir=storage_dir)
+    conversation_id = "shared" if shared else f"worker_{worker_id}"
+    for i in range(num_appends):
+        manager.append_message(conversation_id, {"role": "user", "content": random_string()})
+    return num_appends
+
+
+def test_flat_file_multiprocess(num_processes=4, appends_per_process=500, shared=False):
+    """Test FlatFileManager append throughput with several writer processes.
+
+    With shared=False every process writes its own conversation, which only
+    contend on the index lock when a conversation is created. With shared=True
+    all processes append to one conversation and serialize on its lock.
+    """
+    import shutil
+    storage_dir = "data_perf_test"
+    FlatFileManager(storage_dir=storage_dir)
+
+    jobs = [(storage_dir, worker_id, appends_per_process, shared) for worker_id in range(num_processes)]
+    with multiprocessing.Pool(num_processes) as pool:
+        start = time.perf_counter()
+        total = sum(pool.map(_flat_file_append_worker, jobs))
+        elapsed = time.perf_counter() - start
+
+    manager = FlatFileManager(storage_dir=storage_dir)
+    stored = sum(len(manager.get_conversation(conversation_id)) for conversation_id in manager.conversations_index)
+    shutil.rmtree(storage_dir)
+
+    return total / elapsed, stored == total
+
+
+def _sqlite_append_worker(args):
+    """Append messages from one worker process; used by test_sqlite_multiprocess."""
+    database_path, worker_id, num_appends, shared = args
+    manager = SQLiteManager(database_path=database_path)
+    thread_name = "shared" if shared else f"worker_{worker_id}"
+    for i in range(num_appends):
+        manager.append_message("multiprocess_user", thread_name, {"role": "user", "content": random_string()})
+    manager.close()
+    return num_appends
+
+
+def test_sqlite_multiprocess(num_processes=4, appends_per_process=500, shared=False):
+    """Test SQLiteManager append throughput with several writer processes.
+
+    Every append is a short write transaction, so processes take turns on the
+    database lock whether or not they write to the same conversation.
+    """
+    import shutil
+    database_path = "data_perf_test/perf_test.db"
+    SQLiteManager(database_path=database_path).close()
+
+    jobs = [(database_path, worker_id, appends_per_process, shared) for worker_id in range(num_processes)]
+    with multiprocessing.Pool(num_processes) as pool:
+        start = time.perf_counter()
+        total = sum(pool.map(_sqlite_append_worker, jobs))
+        elapsed = time.perf_counter() - start
+
+    manager = SQLiteManager(database_path=database_path)
+    stored = sum(len(messages) for _, messages in
+                 manager.get_conversations("multiprocess_user", manager.list_user_threads("multiprocess_user")))
+    manager.close()
+    shutil.rmtree("data_perf_test")
+
+    return total / elapsed, stored == total
+
+
+def test_flat_file_async_latency(num_coroutines=300, num_threads=10, messages_per_thread=200):
+    """Test AsyncFlatFileManager latency with many concurrent coroutines.
+
+    Each coroutine reads one of a few hot threads and then appends to it, the way
+    a chat gateway handles a turn. Returns per-operation latencies along with the
+    worst event loop stall seen by a heartbeat task and how many reads were
+    served by another coroutine's disk read.
+    """
+    import shutil
+
+    async def run():
+        manager = AsyncFlatFileManager(storage_dir="data_perf_test", max_workers=8)
+        for i in range(num_threads):
+            messages = [{"role": "user", "content": random_string()} for _ in range(messages_per_thread)]
+            await manager.save_conversation(f"thread_{i}", f"thread_{i}.json", messages)
+
+        stalls = []
+        done = asyncio.Event()
+
+        async def heartbeat():
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stalls.append(time.perf_counter() - start - 0.001)
+
+        async def turn(n):
+            conversation_id = f"thread_{n % num_threads}"
+            start = time.perf_counter()
+            await manager.get_conversation(conversation_id)
+            await manager.append_message(conversation_id, {"role": "user", "content": random_string()})
+            return time.perf_counter() - start
+
+        beat = asyncio.ensure_future(heartbeat())
+        latencies = await asyncio.gather(*(turn(n) for n in range(num_coroutines)))
+        done.set()
+        await beat
+        coalesced = manager.coalesced_reads
+        await manager.close()
+        return sorted(latencies), max(stalls, default=0.0), coalesced
+
+    result = asyncio.run(run())
+    shutil.rmtree("data_perf_test")
+    return result
+
+
+def test_mongodb_write_behind(num_workers=10, turns_per_worker=100, write_behind=False):
+    """Test MongoDBManager append throughput with and without write-behind batching.
+
+    Each worker thread chats in its own conversation, appending a user and an
+    assistant message per turn. With write_behind=True the appends of all workers
+    are flushed together as bulk writes; the final flush is included in the time.
+    """
+    import threading
+    connection_string = CONNECTION_STRING
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test",
+                             write_behind=write_behind)
+    user_id = "write_behind_user"
+
+    # Clean slate
+    manager._wipe_database()
+
+    def worker(n):
+        thread_name = f"thread_{n}"
+        for i in range(turns_per_worker):
+            manager.append_messages(user_id, thread_name, [
+                {"role": "user", "content": random_string()},
+                {"role": "assistant", "content": random_string()},
+            ])
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(num_workers)]
     start = time.perf_counter()
-    read_messages = manager.get_conversation(user_id, thread_name)
-    read_time = time.perf_counter() - start
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    manager.flush()
+    elapsed = time.perf_counter() - start
+
+    stored = sum(len(manager.get_conversation(user_id, f"thread_{n}")) for n in range(num_workers))
 
     # Cleanup
-    manager.delete_conversation(user_id, thread_name)
+    manager._wipe_database()
     manager.close()
 
-    return write_time, read_time, len(read_messages)
+    total = num_workers * turns_per_worker * 2
+    return total / elapsed, stored == total
 
 
-def test_flat_file_multiple_threads(num_threads=10, messages_per_thread=50):
-    """Test FlatFileManager with multiple conversation threads."""
-    manager = FlatFileManager(storage_dir="data_perf_test")
+def test_sqlite_concurrent_appends(num_workers=10, turns_per_worker=100):
+    """Test SQLiteManager append throughput with worker threads sharing one manager.
 
-    create_times = []
+    Mirrors test_mongodb_write_behind: each worker thread chats in its own
+    conversation over its own connection.
+    """
+    import shutil
+    import threading
+    manager = SQLiteManager(database_path="data_perf_test/perf_test.db")
+    user_id = "concurrent_user"
+
+    def worker(n):
+        thread_name = f"thread_{n}"
+        for i in range(turns_per_worker):
+            manager.append_messages(user_id, thread_name, [
+                {"role": "user", "content": random_string()},
+                {"role": "assistant", "content": random_string()},
+            ])
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(num_workers)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
 
-    # Create multiple threads
-    for i in range(num_threads):
-        conversation_id = f"thread_{i}"
-        messages = []
+    stored = sum(manager.message_count(user_id, f"thread_{n}") for n in range(num_workers))
 
+    # Cleanup
+    manager.close()
+    shutil.rmtree("data_perf_test")
+
+    total = num_workers * turns_per_worker * 2
+    return total / elapsed, stored == total
+
+
+def time_tail_reads(manager, num_messages=10000, tail_size=20, repeats=20):
+    """Time full reads, tail reads and message counts of one long thread, best of repeats."""
+    user_id = "tail_test_user"
+    thread_name = "tail_test_thread"
+    manager.save_conversation(user_id, thread_name,
+                              [{"role": "user", "content": random_string()} for _ in range(num_messages)])
+
+    full_times = []
+    tail_times = []
+    count_times = []
+    for _ in range(repeats):
         start = time.perf_counter()
-        for j in range(messages_per_thread):
-            messages.append({"role": "user", "content": random_string()})
-            messages.append({"role": "assistant", "content": random_string()})
-        manager.save_conversation(conversation_id, f"{conversation_id}.json", messages)
-        create_times.append(time.perf_counter() - start)
+        manager.get_conversation(user_id, thread_name)
+        full_times.append(time.perf_counter() - start)
 
-    # Test random access to different threads
-    random_access_times = []
-    for i in range(20):
-        thread_num = random.randint(0, num_threads - 1)
-        conversation_id = f"thread_{thread_num}"
+        start = time.perf_counter()
+        manager.tail(user_id, thread_name, tail_size)
+        tail_times.append(time.perf_counter() - start)
 
         start = time.perf_counter()
-        messages = manager.get_conversation(conversation_id)
-        random_access_times.append(time.perf_counter() - start)
+        manager.message_count(user_id, thread_name)
+        count_times.append(time.perf_counter() - start)
+
+    return min(full_times), min(tail_times), min(count_times)
+
+
+def test_mongodb_tail_reads(num_messages=10000, tail_size=20, repeats=20, storage_mode="document"):
+    """Compare fetching the last few messages of a long thread with fetching all of it."""
+    connection_string = CONNECTION_STRING
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test",
+                             storage_mode=storage_mode)
+
+    # Clean slate
+    manager._wipe_database()
+    result = time_tail_reads(manager, num_messages, tail_size, repeats)
 
     # Cleanup
+    manager._wipe_database()
+    manager.close()
+
+    return result
+
+
+def test_sqlite_tail_reads(num_messages=10000, tail_size=20, repeats=20):
+    """Compare fetching the last few messages of a long SQLite thread with fetching all of it."""
     import shutil
+    manager = SQLiteManager(database_path="data_perf_test/perf_test.db")
+    result = time_tail_reads(manager, num_messages, tail_size, repeats)
+    manager.close()
     shutil.rmtree("data_perf_test")
+    return result
+
+
+def test_mongodb_async_concurrency(in_flight=10, total_ops=2000, num_threads=20, max_pool_size=100):
+    """Test AsyncMongoDBManager throughput with a fixed number of operations in flight.
+
+    Alternates appends and 20-message tail reads across a few threads. Returns
+    operations per second and the sorted per-operation latencies.
+    """
+    async def run():
+        manager = AsyncMongoDBManager(connection_string=CONNECTION_STRING, database_name="chai_perf_test",
+                                      max_pool_size=max_pool_size)
+        await manager._wipe_database()
+        for i in range(num_threads):
+            await manager.save_conversation("async_user", f"thread_{i}",
+                                            [{"role": "user", "content": random_string()} for _ in range(100)])
+
+        latencies = []
+        ops = iter(range(total_ops))
+
+        async def client():
+            for n in ops:
+                thread_name = f"thread_{n % num_threads}"
+                start = time.perf_counter()
+                if n % 2:
+                    await manager.tail("async_user", thread_name, 20)
+                else:
+                    await manager.append_message("async_user", thread_name,
+                                                 {"role": "user", "content": random_string()})
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(in_flight)))
+        elapsed = time.perf_counter() - start
+
+        await manager._wipe_database()
+        await manager.close()
+        return total_ops / elapsed, sorted(latencies)
+
+    return asyncio.run(run())
+
+
+def time_thread_catalog(manager, num_threads=2000, messages_per_thread=50, page_size=50, repeats=10):
+    """Time listing every thread of a heavy user and listing one page, best of repeats."""
+    user_id = "catalog_user"
+    messages = [{"role": "user", "content": random_string()} for _ in range(messages_per_thread)]
+    for i in range(num_threads):
+        manager.save_conversation(user_id, f"thread_{i}", messages)
+
+    list_times = []
+    page_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        manager.list_user_threads(user_id)
+        list_times.append(time.perf_counter() - start)
 
-    return create_times, random_access_times
+        start = time.perf_counter()
+        manager.list_threads(user_id, limit=page_size)
+        page_times.append(time.perf_counter() - start)
+
+    return min(list_times), min(page_times)
 
 
-def test_mongodb_multiple_threads(num_threads=10, messages_per_thread=50):
-    """Test MongoDBManager with multiple conversation threads."""
+def test_mongodb_thread_catalog(num_threads=2000, messages_per_thread=50, page_size=50, repeats=10):
+    """Test listing a heavy user's threads: every thread name, and one page of the catalog."""
     connection_string = CONNECTION_STRING
     manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test")
 
-    user_id = "multi_thread_user"
+    # Clean slate
+    manager._wipe_database()
+    result = time_thread_catalog(manager, num_threads, messages_per_thread, page_size, repeats)
+
+    # Cleanup
+    manager._wipe_database()
+    manager.close()
+
+    return result
+
+
+def test_sqlite_thread_catalog(num_threads=2000, messages_per_thread=50, page_size=50, repeats=10):
+    """Test listing a heavy user's SQLite threads: every thread name, and one page of the catalog."""
+    import shutil
+    manager = SQLiteManager(database_path="data_perf_test/perf_test.db")
+    result = time_thread_catalog(manager, num_threads, messages_per_thread, page_size, repeats)
+    manager.close()
+    shutil.rmtree("data_perf_test")
+    return result
+
+
+def test_mongodb_durability(num_appends=200):
+    """Test MongoDBManager append and save latency at each durability level."""
+    connection_string = CONNECTION_STRING
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test")
+    user_id = "durability_user"
+    messages = [{"role": "user", "content": random_string()} for _ in range(100)]
 
     # Clean slate
     manager._wipe_database()
 
-    create_times = []
+    results = {}
+    for level in [None, "fast", "safe", "replicated"]:
+        thread_name = f"thread_{level}"
+        append_times = []
+        for i in range(num_appends):
+            start = time.perf_counter()
+            manager.append_message(user_id, thread_name, {"role": "user", "content": random_string()},
+                                   durability=level)
+            append_times.append(time.perf_counter() - start)
+
+        save_times = []
+        for i in range(num_appends // 10):
+            start = time.perf_counter()
+            manager.save_conversation(user_id, thread_name, messages, durability=level)
+            save_times.append(time.perf_counter() - start)
+
+        append_times.sort()
+        results[level or "default"] = (append_times[len(append_times) // 2],
+                                       append_times[int(len(append_times) * 0.99)],
+                                       sum(save_times) / len(save_times))
 
-    # Create multiple threads
-    for i in range(num_threads):
-        thread_name = f"thread_{i}"
-        messages = []
+    # Cleanup
+    manager._wipe_database()
+    manager.close()
+
+    return results
+
+
+def test_sqlite_durability(num_appends=200):
+    """Test SQLiteManager append and save latency at each synchronous mode."""
+    import shutil
+    messages = [{"role": "user", "content": random_string()} for _ in range(100)]
+
+    results = {}
+    for synchronous in ["OFF", "NORMAL", "FULL"]:
+        manager = SQLiteManager(database_path="data_perf_test/perf_test.db", synchronous=synchronous)
+        append_times = []
+        for i in range(num_appends):
+            start = time.perf_counter()
+            manager.append_message("durability_user", "thread", {"role": "user", "content": random_string()})
+            append_times.append(time.perf_counter() - start)
+
+        save_times = []
+        for i in range(num_appends // 10):
+            start = time.perf_counter()
+            manager.save_conversation("durability_user", "thread", messages)
+            save_times.append(time.perf_counter() - start)
+
+        append_times.sort()
+        results[f"synchronous={synchronous}"] = (append_times[len(append_times) // 2],
+                                                  append_times[int(len(append_times) * 0.99)],
+                                                  sum(save_times) / len(save_times))
+        manager.close()
+        shutil.rmtree("data_perf_test")
+
+    return results
+
+
+def test_batch_fetch(backend, num_threads=50, messages_per_thread=100):
+    """Compare loading many threads with get_conversations() against a get_conversation() loop."""
+    user_id = "batch_user"
+    messages = [{"role": "user", "content": random_string()} for _ in range(messages_per_thread)]
+    thread_names = [f"thread_{i}" for i in range(num_threads)]
+
+    for thread_name in thread_names:
+        backend.save_conversation(user_id, thread_name, messages)
+    start = time.perf_counter()
+    for thread_name in thread_names:
+        backend.get_conversation(user_id, thread_name)
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    for thread_name, _ in backend.get_conversations(user_id, thread_names):
+        pass
+    batched = time.perf_counter() - start
+
+    for thread_name in thread_names:
+        backend.delete_conversation(user_id, thread_name)
+
+    return sequential, batched
+
+
+def test_context_window(backend, num_messages=1000, max_tokens=4000, repeats=20):
+    """Compare get_context_window() with loading the whole thread and trimming it to the token budget.
+
+    Messages are 50 to 500 characters, so a 4,000 token window holds a few dozen
+    of them. Each turn appends a message before the window is read, as in the
+    chat loop. Returns the average time of each approach per turn.
+    """
+    user_id = "context_user"
+    thread_name = "long_thread"
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": random_string(random.randint(50, 500))}
+                for i in range(num_messages)]
+    backend.save_conversation(user_id, thread_name, messages)
+
+    full_times = []
+    window_times = []
+    for _ in range(repeats):
+        backend.append_message(user_id, thread_name, {"role": "user", "content": random_string(100)})
 
         start = time.perf_counter()
-        for j in range(messages_per_thread):
-            messages.append({"role": "user", "content": random_string()})
-            messages.append({"role": "assistant", "content": random_string()})
-        manager.save_conversation(user_id, thread_name, messages)
-        create_times.append(time.perf_counter() - start)
+        context_window(backend.get_conversation(user_id, thread_name), max_tokens)
+        full_times.append(time.perf_counter() - start)
 
-    # Test random access to different threads
-    random_access_times = []
-    for i in range(20):
-        thread_num = random.randint(0, num_threads - 1)
-        thread_name = f"thread_{thread_num}"
+        start = time.perf_counter()
+        backend.get_context_window(user_id, thread_name, max_tokens)
+        window_times.append(time.perf_counter() - start)
+
+    backend.delete_conversation(user_id, thread_name)
+
+    return sum(full_times) / repeats, sum(window_times) / repeats
+
+
+def run_benchmark(key, test, *args):
+    """Run test(backend, *args) against a freshly opened PERF_BACKENDS entry."""
+    _, url, options = PERF_BACKENDS[key]
+    backend = open_backend(url, **options)
+    try:
+        return test(backend, *args)
+    finally:
+        backend.close()
+        import shutil
+        shutil.rmtree("data_perf_test", ignore_errors=True)
+
+
+def print_fastest(timings, activity):
+    """Print which backend took the least time, and by how much it beat the runner-up."""
+    ranked = sorted(timings.items(), key=lambda item: item[1])
+    if len(ranked) < 2:
+        return
+    (winner, best), (_, runner_up) = ranked[:2]
+    print(f"\n✓ {winner} is {runner_up / best:.2f}x faster {activity}")
 
+
+def test_flat_file_search(num_conversations=100, messages_per_conversation=100, repeats=10):
+    """Compare searching flat files through the full-text index with scanning every conversation.
+
+    Messages are drawn from a 5,000 word vocabulary, and one in a thousand
+    contains the phrase being searched for. Returns the time to write the
+    conversations with indexing on and off, the best phrase query and scan
+    times, and the time to rebuild the index from scratch.
+    """
+    import shutil
+    vocabulary = [random_string(random.randint(3, 10)).lower() for _ in range(5000)]
+    conversations = {}
+    for i in range(num_conversations):
+        messages = []
+        for j in range(messages_per_conversation):
+            words = random.choices(vocabulary, k=12)
+            if random.random() < 0.001:
+                words[5:5] = ["refund", "order", "number"]
+            messages.append({"role": "user", "content": " ".join(words)})
+        conversations[f"search_{i}"] = messages
+
+    write_times = {}
+    for search in [False, True]:
+        manager = FlatFileManager(storage_dir="data_perf_test", search=search)
         start = time.perf_counter()
-        messages = manager.get_conversation(user_id, thread_name)
-        random_access_times.append(time.perf_counter() - start)
+        for conversation_id, messages in conversations.items():
+            manager.save_conversation(conversation_id, f"{conversation_id}.json", messages)
+        write_times[search] = time.perf_counter() - start
+        if not search:
+            manager.close()
+            shutil.rmtree("data_perf_test")
+
+    query_times = []
+    scan_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        hits = manager.search('"order number"', limit=20)
+        query_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        matches = [(conversation_id, index) for conversation_id, messages in manager.get_conversations(conversations)
+                   for index, message in enumerate(messages) if "order number" in message["content"]]
+        scan_times.append(time.perf_counter() - start)
 
-    # Test listing all threads
     start = time.perf_counter()
-    threads = manager.list_user_threads(user_id)
-    list_time = time.perf_counter() - start
+    manager.rebuild_search_index()
+    rebuild_time = time.perf_counter() - start
+
+    manager.close()
+    shutil.rmtree("data_perf_test")
+
+    return write_times[False], write_times[True], min(query_times), min(scan_times), rebuild_time
+
+
+def test_mongodb_tiering(num_threads=500, messages_per_thread=50, idle_fraction=0.9, storage_mode="document"):
+    """Test archiving idle MongoDB threads to compressed flat files and promoting them back on use.
+
+    Backdates idle_fraction of the threads, demotes them, and reads a sample of
+    hot and archived threads. Returns the demotion time, the tier stats before
+    and after, and the average hot read and promoting read times.
+    """
+    import shutil
+    connection_string = CONNECTION_STRING
+    manager = MongoDBManager(connection_string=connection_string, database_name="chai_perf_test",
+                             storage_mode=storage_mode)
+    archive = FlatFileManager(storage_dir="data_perf_test", compression="zlib", compress_min_bytes=0,
+                              shard_levels=1)
+    store = TieredStore(manager, archive)
+    user_id = "tiering_user"
+
+    # Clean slate
+    manager._wipe_database()
+    for i in range(num_threads):
+        messages = [{"role": "user" if j % 2 == 0 else "assistant", "content": random_string(200)}
+                    for j in range(messages_per_thread)]
+        manager.save_conversation(user_id, f"thread_{i}", messages)
+    idle = [f"thread_{i}" for i in range(int(num_threads * idle_fraction))]
+    manager.conversations.update_many({"user_id": user_id, "thread_name": {"$in": idle}},
+                                      {"$set": {"updated_at": "2000-01-01T00:00:00+00:00"}})
+    before = store.stats()
+
+    start = time.perf_counter()
+    store.demote_idle()
+    demote_time = time.perf_counter() - start
+    after = store.stats()
+
+    hot = [f"thread_{i}" for i in range(len(idle), num_threads)][:20]
+    start = time.perf_counter()
+    for thread_name in hot:
+        store.get_conversation(user_id, thread_name)
+    hot_read = (time.perf_counter() - start) / len(hot)
+
+    start = time.perf_counter()
+    for thread_name in idle[:20]:
+        store.get_conversation(user_id, thread_name)
+    promoting_read = (time.perf_counter() - start) / len(idle[:20])
 
     # Cleanup
     manager._wipe_database()
-    manager.close()
+    store.close()
+    shutil.rmtree("data_perf_test")
 
-    return create_times, random_access_times, list_time
+    return demote_time, before, after, hot_read, promoting_read
 
 
 def test_cold_start_performance():
@@ -236,6 +771,20 @@ def test_cold_start_performance():
     import shutil
     shutil.rmtree("data_cold_test")
 
+    # SQLite - Cold Start
+    start = time.perf_counter()
+    manager_sqlite = SQLiteManager(database_path="data_cold_test/cold_test.db")
+    manager_sqlite.save_conversation("cold_user", "cold_thread", [{"role": "user", "content": "first"}])
+    sqlite_cold = time.perf_counter() - start
+    manager_sqlite.close()
+    shutil.rmtree("data_cold_test")
+
+    print(f"Flat File cold start: {flat_file_cold:.4f} seconds")
+    print(f"SQLite cold start:    {sqlite_cold:.4f} seconds")
+    if not CONNECTION_STRING:
+        print(MONGODB_SKIPPED)
+        return flat_file_cold, None, sqlite_cold
+
     # MongoDB - Cold Start
     connection_string = CONNECTION_STRING
     start = time.perf_counter()
@@ -243,29 +792,37 @@ def test_cold_start_performance():
     manager_mongo.save_conversation("cold_user", "cold_thread", [{"role": "user", "content": "first"}])
     mongo_cold = time.perf_counter() - start
 
+    # MongoDB - Restart against a database whose indexes are already in place
+    _verified_schemas.clear()
+    start = time.perf_counter()
+    manager_restart = MongoDBManager(connection_string=connection_string, database_name="chai_cold_test")
+    manager_restart.save_conversation("cold_user", "cold_thread", [{"role": "user", "content": "first"}])
+    mongo_restart = time.perf_counter() - start
+    manager_restart.close()
+
     manager_mongo._wipe_database()
     manager_mongo.close()
 
-    print(f"Flat File cold start: {flat_file_cold:.4f} seconds")
     print(f"MongoDB cold start:   {mongo_cold:.4f} seconds")
+    print(f"MongoDB restart:      {mongo_restart:.4f} seconds (indexes already verified)")
 
     if flat_file_cold < mongo_cold:
         print(f"✓ Flat File is {mongo_cold / flat_file_cold:.2f}x faster for cold starts")
     else:
         print(f"✓ MongoDB is {flat_file_cold / mongo_cold:.2f}x faster for cold starts")
 
-    return flat_file_cold, mongo_cold
+    return flat_file_cold, mongo_cold, sqlite_cold
 
 
 if __name__ == "__main__":
+    for url in sys.argv[1:]:
+        PERF_BACKENDS[url] = (url, url, {})
+
     print("=" * 80)
-    print("PERFORMANCE COMPARISON: Flat Files vs MongoDB")
+    print("PERFORMANCE COMPARISON: Flat Files vs MongoDB vs SQLite")
     print("=" * 80)
 
-    results = {
-        'flat_file': {},
-        'mongodb': {}
-    }
+    results = {key: {} for key in PERF_BACKENDS}
 
     # TEST 1: Incremental Append Performance
     print("\n" + "=" * 80)
@@ -276,37 +833,22 @@ if __name__ == "__main__":
     for count in [10, 50, 100]:
         print(f"\n--- Testing with {count} message pairs ---")
 
-        flat_append, flat_read, flat_msg_count = test_flat_file_append_performance(count)
-        mongo_append, mongo_read, mongo_msg_count = test_mongodb_append_performance(count)
-
-        flat_avg = sum(flat_append) / len(flat_append)
-        mongo_avg = sum(mongo_append) / len(mongo_append)
-
-        print(f"Flat File:")
-        print(f"  - Avg append: {flat_avg:.4f}s")
-        print(f"  - Min append: {min(flat_append):.4f}s")
-        print(f"  - Max append: {max(flat_append):.4f}s")
-        print(f"  - Full read:  {flat_read:.4f}s")
-        print(f"  - Final msgs: {flat_msg_count}")
-
-        print(f"MongoDB:")
-        print(f"  - Avg append: {mongo_avg:.4f}s")
-        print(f"  - Min append: {min(mongo_append):.4f}s")
-        print(f"  - Max append: {max(mongo_append):.4f}s")
-        print(f"  - Full read:  {mongo_read:.4f}s")
-        print(f"  - Final msgs: {mongo_msg_count}")
-
-        if flat_avg < mongo_avg:
-            speedup = mongo_avg / flat_avg
-            print(f"\n✓ Flat File is {speedup:.2f}x faster for incremental appends at {count} messages")
-        else:
-            speedup = flat_avg / mongo_avg
-            print(f"\n✓ MongoDB is {speedup:.2f}x faster for incremental appends at {count} messages")
+        averages = {}
+        for key, (label, _, _) in PERF_BACKENDS.items():
+            append_times, read_time, msg_count = run_benchmark(key, test_append_performance, count)
+            averages[label] = sum(append_times) / len(append_times)
+
+            print(f"{label}:")
+            print(f"  - Avg append: {averages[label]:.4f}s")
+            print(f"  - Min append: {min(append_times):.4f}s")
+            print(f"  - Max append: {max(append_times):.4f}s")
+            print(f"  - Full read:  {read_time:.4f}s")
+            print(f"  - Final msgs: {msg_count}")
+
+            results.setdefault(key, {})[f'append_{count}'] = averages[label]
+            results[key][f'read_{count}'] = read_time
 
-        results['flat_file'][f'append_{count}'] = flat_avg
-        results['mongodb'][f'append_{count}'] = mongo_avg
-        results['flat_file'][f'read_{count}'] = flat_read
-        results['mongodb'][f'read_{count}'] = mongo_read
+        print_fastest(averages, f"for incremental appends at {count} messages")
 
     # TEST 2: Bulk Write Performance
     print("\n" + "=" * 80)
@@ -317,28 +859,19 @@ if __name__ == "__main__":
     for count in [100, 500, 1000]:
         print(f"\n--- Testing with {count} message pairs ---")
 
-        flat_write, flat_read, flat_count = test_flat_file_bulk_write(count)
-        mongo_write, mongo_read, mongo_count = test_mongodb_bulk_write(count)
+        write_times = {}
+        for key, (label, _, _) in PERF_BACKENDS.items():
+            write_time, read_time, msg_count = run_benchmark(key, test_bulk_write, count)
+            write_times[label] = write_time
 
-        print(f"Flat File:")
-        print(f"  - Bulk write: {flat_write:.4f}s")
-        print(f"  - Full read:  {flat_read:.4f}s")
-        print(f"  - Messages:   {flat_count}")
+            print(f"{label}:")
+            print(f"  - Bulk write: {write_time:.4f}s")
+            print(f"  - Full read:  {read_time:.4f}s")
+            print(f"  - Messages:   {msg_count}")
 
-        print(f"MongoDB:")
-        print(f"  - Bulk write: {mongo_write:.4f}s")
-        print(f"  - Full read:  {mongo_read:.4f}s")
-        print(f"  - Messages:   {mongo_count}")
-
-        if flat_write < mongo_write:
-            speedup = mongo_write / flat_write
-            print(f"\n✓ Flat File is {speedup:.2f}x faster for bulk writes")
-        else:
-            speedup = flat_write / mongo_write
-            print(f"\n✓ MongoDB is {speedup:.2f}x faster for bulk writes")
+            results.setdefault(key, {})[f'bulk_write_{count}'] = write_time
 
-        results['flat_file'][f'bulk_write_{count}'] = flat_write
-        results['mongodb'][f'bulk_write_{count}'] = mongo_write
+        print_fastest(write_times, "for bulk writes")
 
     # TEST 3: Multiple Thread Management
     print("\n" + "=" * 80)
@@ -349,34 +882,230 @@ if __name__ == "__main__":
     for num_threads in [5, 10, 20]:
         print(f"\n--- Testing with {num_threads} threads, 50 messages each ---")
 
-        flat_create, flat_access = test_flat_file_multiple_threads(num_threads, 50)
-        mongo_create, mongo_access, mongo_list = test_mongodb_multiple_threads(num_threads, 50)
+        access_averages = {}
+        for key, (label, _, _) in PERF_BACKENDS.items():
+            create_times, access_times, list_time = run_benchmark(key, test_multiple_threads, num_threads, 50)
+            access_averages[label] = sum(access_times) / len(access_times)
 
-        flat_create_avg = sum(flat_create) / len(flat_create)
-        mongo_create_avg = sum(mongo_create) / len(mongo_create)
-        flat_access_avg = sum(flat_access) / len(flat_access)
-        mongo_access_avg = sum(mongo_access) / len(mongo_access)
+            print(f"{label}:")
+            print(f"  - Avg thread creation: {sum(create_times) / len(create_times):.4f}s")
+            print(f"  - Avg random access:   {access_averages[label]:.4f}s")
+            print(f"  - List all threads:    {list_time:.4f}s")
 
-        print(f"Flat File:")
-        print(f"  - Avg thread creation: {flat_create_avg:.4f}s")
-        print(f"  - Avg random access:   {flat_access_avg:.4f}s")
+        print_fastest(access_averages, "for random thread access")
 
-        print(f"MongoDB:")
-        print(f"  - Avg thread creation: {mongo_create_avg:.4f}s")
-        print(f"  - Avg random access:   {mongo_access_avg:.4f}s")
-        print(f"  - List all threads:    {mongo_list:.4f}s")
+    # TEST 4: Cold Start
+    flat_cold, mongo_cold, sqlite_cold = test_cold_start_performance()
+    results['flat_file']['cold_start'] = flat_cold
+    results['sqlite']['cold_start'] = sqlite_cold
+    if mongo_cold is not None:
+        results['mongodb']['cold_start'] = mongo_cold
+
+    # TEST 6: Flat File Codecs
+    print("\n" + "=" * 80)
+    print("TEST 6: Flat File Serialization Codecs")
+    print("=" * 80)
+    print("This compares the file formats FlatFileManager can write (best of 5 runs).\n")
 
-        if flat_access_avg < mongo_access_avg:
-            speedup = mongo_access_avg / flat_access_avg
-            print(f"\n✓ Flat File is {speedup:.2f}x faster for random thread access")
+    for count in [100, 1000]:
+        print(f"\n--- Testing with {count} message pairs ---")
+        codec_results = test_flat_file_codecs(count)
+        baseline_size = codec_results['json'][2]
+        for codec, (write_time, read_time, size) in codec_results.items():
+            print(f"{codec}:")
+            print(f"  - Write:     {write_time * 1000:.2f}ms")
+            print(f"  - Full read: {read_time * 1000:.2f}ms")
+            print(f"  - File size: {size} bytes ({size / baseline_size:.0%} of json)")
+
+    # TEST 7: Multi-Process Writers
+    print("\n" + "=" * 80)
+    print("TEST 7: Flat File and SQLite Multi-Process Append Throughput")
+    print("=" * 80)
+    print("This simulates several worker processes writing to the same storage directory.\n")
+
+    for num_processes in [1, 2, 4, 8]:
+        independent, independent_ok = test_flat_file_multiprocess(num_processes, 500, shared=False)
+        shared, shared_ok = test_flat_file_multiprocess(num_processes, 500, shared=True)
+        print(f"{num_processes} process(es):")
+        print(f"  - Separate conversations: {independent:,.0f} appends/s"
+              f"{'' if independent_ok else ' (LOST WRITES!)'}")
+        print(f"  - One shared conversation: {shared:,.0f} appends/s"
+              f"{'' if shared_ok else ' (LOST WRITES!)'}")
+        independent, independent_ok = test_sqlite_multiprocess(num_processes, 500, shared=False)
+        shared, shared_ok = test_sqlite_multiprocess(num_processes, 500, shared=True)
+        print(f"  - SQLite, separate conversations: {independent:,.0f} appends/s"
+              f"{'' if independent_ok else ' (LOST WRITES!)'}")
+        print(f"  - SQLite, one shared conversation: {shared:,.0f} appends/s"
+              f"{'' if shared_ok else ' (LOST WRITES!)'}")
+
+    # TEST 8: Async Flat File Latency
+    print("\n" + "=" * 80)
+    print("TEST 8: Async Flat File Latency Under Concurrency")
+    print("=" * 80)
+    print("This simulates an asyncio chat gateway serving many turns at once.\n")
+
+    for num_coroutines in [10, 100, 300]:
+        latencies, max_stall, coalesced = test_flat_file_async_latency(num_coroutines)
+        print(f"{num_coroutines} concurrent coroutines:")
+        print(f"  - p50 turn latency: {latencies[len(latencies) // 2] * 1000:.2f}ms")
+        print(f"  - p99 turn latency: {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms")
+        print(f"  - Worst event loop stall: {max_stall * 1000:.2f}ms")
+        print(f"  - Reads coalesced: {coalesced}")
+
+    # TEST 9: Concurrent Appends
+    print("\n" + "=" * 80)
+    print("TEST 9: Concurrent Appends: MongoDB Write-Behind and SQLite")
+    print("=" * 80)
+    print("This compares one round trip per append with buffered bulk writes.\n")
+
+    for num_workers in [1, 10, 50]:
+        print(f"{num_workers} concurrent conversation(s):")
+        if CONNECTION_STRING:
+            direct, direct_ok = test_mongodb_write_behind(num_workers, 50, write_behind=False)
+            buffered, buffered_ok = test_mongodb_write_behind(num_workers, 50, write_behind=True)
+            print(f"  - update_one per append: {direct:,.0f} appends/s"
+                  f"{'' if direct_ok else ' (LOST WRITES!)'}")
+            print(f"  - Write-behind batches:  {buffered:,.0f} appends/s"
+                  f"{'' if buffered_ok else ' (LOST WRITES!)'}")
         else:
-            speedup = flat_access_avg / mongo_access_avg
-            print(f"\n✓ MongoDB is {speedup:.2f}x faster for random thread access")
+            print(f"  - {MONGODB_SKIPPED}")
+        sqlite, sqlite_ok = test_sqlite_concurrent_appends(num_workers, 50)
+        print(f"  - SQLite, connection per thread: {sqlite:,.0f} appends/s"
+              f"{'' if sqlite_ok else ' (LOST WRITES!)'}")
 
-    # TEST 4: Cold Start
-    flat_cold, mongo_cold = test_cold_start_performance()
-    results['flat_file']['cold_start'] = flat_cold
-    results['mongodb']['cold_start'] = mongo_cold
+    # TEST 10: Tail Reads
+    print("\n" + "=" * 80)
+    print("TEST 10: MongoDB and SQLite Tail Reads of a Long Thread")
+    print("=" * 80)
+    print("This compares showing recent history of a 10,000 message thread with loading all of it.\n")
+
+    if not CONNECTION_STRING:
+        print(MONGODB_SKIPPED)
+    for storage_mode in ["document", "bucketed", "sqlite"] if CONNECTION_STRING else ["sqlite"]:
+        if storage_mode == "sqlite":
+            full_time, tail_time, count_time = test_sqlite_tail_reads(10000, 20)
+        else:
+            full_time, tail_time, count_time = test_mongodb_tail_reads(10000, 20, storage_mode=storage_mode)
+        print(f"{storage_mode} storage:")
+        print(f"  - Full read:          {full_time * 1000:.2f}ms")
+        print(f"  - Last 20 messages:   {tail_time * 1000:.2f}ms ({full_time / tail_time:.1f}x faster)")
+        print(f"  - Message count only: {count_time * 1000:.2f}ms")
+
+    # TEST 11: Async MongoDB Concurrency
+    print("\n" + "=" * 80)
+    print("TEST 11: Async MongoDB Throughput by Operations In Flight")
+    print("=" * 80)
+    print("This simulates an asyncio gateway issuing appends and tail reads concurrently.\n")
+
+    if not CONNECTION_STRING:
+        print(MONGODB_SKIPPED)
+    for in_flight in [1, 10, 100, 1000] if CONNECTION_STRING else []:
+        throughput, latencies = test_mongodb_async_concurrency(in_flight, max(2000, in_flight * 4))
+        print(f"{in_flight} in flight:")
+        print(f"  - Throughput: {throughput:,.0f} ops/s")
+        print(f"  - p50 latency: {latencies[len(latencies) // 2] * 1000:.2f}ms")
+        print(f"  - p99 latency: {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms")
+
+    # TEST 12: Thread Catalog
+    print("\n" + "=" * 80)
+    print("TEST 12: MongoDB and SQLite Thread Listing for a Heavy User")
+    print("=" * 80)
+    print("This simulates the thread list shown at login for a user with thousands of threads.\n")
+
+    catalog_tests = [("MongoDB", test_mongodb_thread_catalog), ("SQLite", test_sqlite_thread_catalog)]
+    if not CONNECTION_STRING:
+        print(MONGODB_SKIPPED)
+        catalog_tests = catalog_tests[1:]
+    for num_threads in [100, 2000]:
+        print(f"{num_threads} threads:")
+        for label, test in catalog_tests:
+            list_time, page_time = test(num_threads)
+            print(f"  - {label}, all thread names:       {list_time * 1000:.2f}ms")
+            print(f"  - {label}, first page of 50 (newest, with counts): {page_time * 1000:.2f}ms")
+
+    # TEST 13: Durability Levels
+    print("\n" + "=" * 80)
+    print("TEST 13: MongoDB and SQLite Write Latency by Durability Level")
+    print("=" * 80)
+    print("This compares write concerns: fast (w=1), safe (journaled) and replicated (majority),")
+    print("and SQLite's synchronous modes.\n")
+
+    if CONNECTION_STRING:
+        durability_results = test_mongodb_durability()
+    else:
+        print(MONGODB_SKIPPED)
+        durability_results = {}
+    durability_results.update(("SQLite " + mode, times) for mode, times in test_sqlite_durability().items())
+    for level, (append_p50, append_p99, save_avg) in durability_results.items():
+        print(f"{level}:")
+        print(f"  - Append p50: {append_p50 * 1000:.2f}ms")
+        print(f"  - Append p99: {append_p99 * 1000:.2f}ms")
+        print(f"  - Save (100 messages) average: {save_avg * 1000:.2f}ms")
+
+    # TEST 14: Batch Fetch
+    print("\n" + "=" * 80)
+    print("TEST 14: Loading Many Threads at Once")
+    print("=" * 80)
+    print("This simulates a dashboard or export job loading a user's threads in bulk.\n")
+
+    for num_threads in [10, 50]:
+        print(f"\n--- Loading {num_threads} threads of 100 messages ---")
+        for key, (label, _, _) in PERF_BACKENDS.items():
+            sequential, batched = run_benchmark(key, test_batch_fetch, num_threads)
+            print(f"{label}:")
+            print(f"  - get_conversation loop: {sequential * 1000:.2f}ms")
+            print(f"  - get_conversations:     {batched * 1000:.2f}ms ({sequential / batched:.2f}x faster)")
+
+    # TEST 15: Full-Text Search
+    print("\n" + "=" * 80)
+    print("TEST 15: Flat File Full-Text Search")
+    print("=" * 80)
+    print("This simulates the support team searching everyone's chat history for a phrase.\n")
+
+    for messages_per_conversation in [10, 100, 1000]:
+        total = 100 * messages_per_conversation
+        plain_write, indexed_write, query_time, scan_time, rebuild_time = test_flat_file_search(
+            100, messages_per_conversation)
+        print(f"{total:,} messages in 100 conversations:")
+        print(f"  - Write without index: {plain_write:.4f}s")
+        print(f"  - Write with index:    {indexed_write:.4f}s")
+        print(f"  - Indexed phrase query: {query_time * 1000:.2f}ms")
+        print(f"  - Scanning every conversation: {scan_time * 1000:.2f}ms ({scan_time / query_time:.0f}x slower)")
+        print(f"  - Rebuild index from scratch: {rebuild_time:.4f}s")
+
+    # TEST 16: Hot/Cold Tiering
+    print("\n" + "=" * 80)
+    print("TEST 16: Archiving Idle MongoDB Threads")
+    print("=" * 80)
+    print("This simulates a nightly job moving threads idle for 90 days to compressed flat files.\n")
+
+    if not CONNECTION_STRING:
+        print(MONGODB_SKIPPED)
+    for storage_mode in ["document", "bucketed"] if CONNECTION_STRING else []:
+        demote_time, before, after, hot_read, promoting_read = test_mongodb_tiering(storage_mode=storage_mode)
+        print(f"MongoDB ({storage_mode}), 500 threads of 50 messages, 90% idle:")
+        print(f"  - Demoted {after['demotions']} threads in {demote_time:.4f}s")
+        print(f"  - Before: {before['hot_bytes'] / 1024:.0f} KB data, {before['hot_index_bytes'] / 1024:.0f} KB indexes "
+              f"in MongoDB")
+        print(f"  - After:  {after['hot_bytes'] / 1024:.0f} KB data, {after['hot_index_bytes'] / 1024:.0f} KB indexes "
+              f"in MongoDB, {after['cold_bytes'] / 1024:.0f} KB archived")
+        print(f"  - Hot read: {hot_read * 1000:.2f}ms")
+        print(f"  - Read promoting an archived thread: {promoting_read * 1000:.2f}ms "
+              f"({promoting_read / hot_read:.2f}x a hot read)")
+
+    # TEST 17: Context Window
+    print("\n" + "=" * 80)
+    print("TEST 17: Building the Model's Context Each Turn")
+    print("=" * 80)
+    print("This simulates the chat loop sending the newest 4,000 tokens of a long thread to the model.\n")
+
+    for num_messages in [100, 1000, 10000]:
+        print(f"\n--- Thread of {num_messages:,} messages ---")
+        for key, (label, _, _) in PERF_BACKENDS.items():
+            full, window = run_benchmark(key, test_context_window, num_messages)
+            print(f"{label}:")
+            print(f"  - Load everything and trim: {full * 1000:.2f}ms")
+            print(f"  - get_context_window:       {window * 1000:.2f}ms ({full / window:.2f}x faster)")
 
     # COMPREHENSIVE SUMMARY
     print("\n\n")
@@ -386,105 +1115,126 @@ if __name__ == "__main__":
 
     print("\n📊 KEY FINDINGS:\n")
 
-    print("1. INCREMENTAL APPENDS (Real-time Chat):")
-    print("   " + "-" * 76)
     flat_10 = results['flat_file']['append_10']
-    mongo_10 = results['mongodb']['append_10']
     flat_100 = results['flat_file']['append_100']
-    mongo_100 = results['mongodb']['append_100']
-
-    if flat_10 < mongo_10:
-        speedup_10 = mongo_10 / flat_10
-        winner_10 = "Flat File"
-    else:
-        speedup_10 = flat_10 / mongo_10
-        winner_10 = "MongoDB"
-
-    if flat_100 < mongo_100:
-        speedup_100 = mongo_100 / flat_100
-        winner_100 = "Flat File"
-    else:
-        speedup_100 = flat_100 / mongo_100
-        winner_100 = "MongoDB"
-
-    print(f"   At 10 messages:  {winner_10} is {speedup_10:.2f}x faster")
-    print(f"   At 100 messages: {winner_100} is {speedup_100:.2f}x faster")
-    print(f"   • Flat File @ 10 msgs:  {flat_10 * 1000:.2f}ms per append")
-    print(f"   • MongoDB @ 10 msgs:    {mongo_10 * 1000:.2f}ms per append")
-    print(f"   • Flat File @ 100 msgs: {flat_100 * 1000:.2f}ms per append")
-    print(f"   • MongoDB @ 100 msgs:   {mongo_100 * 1000:.2f}ms per append")
-    print()
-    print("   Analysis:")
-    print(f"   • Flat files are surprisingly fast for small conversations")
-    print(f"   • MongoDB has network/TCP overhead even when running locally")
-    print(f"   • JSON parsing and file I/O are highly optimized in modern systems")
-    print(f"   • At {100} messages, flat file performance degrades ({flat_100 / flat_10:.2f}x slower)")
-    print(f"   • MongoDB stays more consistent ({mongo_100 / mongo_10:.2f}x slower)")
-    print()
-
-    # Calculate scaling characteristics
     flat_scaling = flat_100 / flat_10
-    mongo_scaling = mongo_100 / mongo_10
-
-    print("2. SCALING CHARACTERISTICS:")
-    print("   " + "-" * 76)
-    print(f"   When conversation grows 10x (from 10 to 100 messages):")
-    print(f"   • Flat File slows down by: {flat_scaling:.2f}x")
-    print(f"   • MongoDB slows down by:   {mongo_scaling:.2f}x")
-    print()
-    if flat_scaling > mongo_scaling:
-        print(f"   ✓ MongoDB scales {flat_scaling / mongo_scaling:.2f}x better as conversations grow")
-        print(f"     This gap will widen further at 1000+ messages")
-    else:
-        print(f"   ✓ Both systems scale similarly at this size")
-    print()
-
-    print("3. BULK WRITES (Import/Migration):")
-    print("   " + "-" * 76)
-    flat_bulk_1000 = results['flat_file']['bulk_write_1000']
-    mongo_bulk_1000 = results['mongodb']['bulk_write_1000']
-    if flat_bulk_1000 < mongo_bulk_1000:
-        speedup = mongo_bulk_1000 / flat_bulk_1000
-        winner = "Flat File"
-    else:
-        speedup = flat_bulk_1000 / mongo_bulk_1000
-        winner = "MongoDB"
-    print(f"   {winner} is {speedup:.2f}x FASTER for bulk operations")
-    print(f"   • Flat File @ 1000 msgs: {flat_bulk_1000:.4f}s")
-    print(f"   • MongoDB @ 1000 msgs:   {mongo_bulk_1000:.4f}s")
-    print(f"   • Why: Single large write favors flat files' simple write model")
-    print(f"           Network overhead and document parsing add cost to MongoDB")
-    print()
 
-    print("4. COLD START (Initial Setup):")
-    print("   " + "-" * 76)
-    if flat_cold < mongo_cold:
-        speedup = mongo_cold / flat_cold
-        winner = "Flat File"
+    if not CONNECTION_STRING:
+        print("1-5. FLAT FILE vs MONGODB:")
+        print("   " + "-" * 76)
+        print(f"   {MONGODB_SKIPPED}")
+        print()
     else:
-        speedup = flat_cold / mongo_cold
-        winner = "MongoDB"
-    print(f"   {winner} is {speedup:.2f}x FASTER for cold starts")
-    print(f"   • Flat File: {flat_cold:.4f}s")
-    print(f"   • MongoDB:   {mongo_cold:.4f}s")
-    print(f"   • Why: Flat files have zero setup; MongoDB requires connection")
-    print(f"           and index creation")
-    print()
+        print("1. INCREMENTAL APPENDS (Real-time Chat):")
+        print("   " + "-" * 76)
+        mongo_10 = results['mongodb']['append_10']
+        mongo_100 = results['mongodb']['append_100']
+
+        if flat_10 < mongo_10:
+            speedup_10 = mongo_10 / flat_10
+            winner_10 = "Flat File"
+        else:
+            speedup_10 = flat_10 / mongo_10
+            winner_10 = "MongoDB"
 
-    print("5. READ PERFORMANCE (Loading Conversation):")
+        if flat_100 < mongo_100:
+            speedup_100 = mongo_100 / flat_100
+            winner_100 = "Flat File"
+        else:
+            speedup_100 = flat_100 / mongo_100
+            winner_100 = "MongoDB"
+
+        print(f"   At 10 messages:  {winner_10} is {speedup_10:.2f}x faster")
+        print(f"   At 100 messages: {winner_100} is {speedup_100:.2f}x faster")
+        print(f"   • Flat File @ 10 msgs:  {flat_10 * 1000:.2f}ms per append")
+        print(f"   • MongoDB @ 10 msgs:    {mongo_10 * 1000:.2f}ms per append")
+        print(f"   • Flat File @ 100 msgs: {flat_100 * 1000:.2f}ms per append")
+        print(f"   • MongoDB @ 100 msgs:   {mongo_100 * 1000:.2f}ms per append")
+        print()
+        print("   Analysis:")
+        print(f"   • Flat files are surprisingly fast for small conversations")
+        print(f"   • MongoDB has network/TCP overhead even when running locally")
+        print(f"   • JSON parsing and file I/O are highly optimized in modern systems")
+        print(f"   • At {100} messages, flat file performance degrades ({flat_100 / flat_10:.2f}x slower)")
+        print(f"   • MongoDB stays more consistent ({mongo_100 / mongo_10:.2f}x slower)")
+        print()
+
+        # Calculate scaling characteristics
+        mongo_scaling = mongo_100 / mongo_10
+
+        print("2. SCALING CHARACTERISTICS:")
+        print("   " + "-" * 76)
+        print(f"   When conversation grows 10x (from 10 to 100 messages):")
+        print(f"   • Flat File slows down by: {flat_scaling:.2f}x")
+        print(f"   • MongoDB slows down by:   {mongo_scaling:.2f}x")
+        print()
+        if flat_scaling > mongo_scaling:
+            print(f"   ✓ MongoDB scales {flat_scaling / mongo_scaling:.2f}x better as conversations grow")
+            print(f"     This gap will widen further at 1000+ messages")
+        else:
+            print(f"   ✓ Both systems scale similarly at this size")
+        print()
+
+        print("3. BULK WRITES (Import/Migration):")
+        print("   " + "-" * 76)
+        flat_bulk_1000 = results['flat_file']['bulk_write_1000']
+        mongo_bulk_1000 = results['mongodb']['bulk_write_1000']
+        if flat_bulk_1000 < mongo_bulk_1000:
+            speedup = mongo_bulk_1000 / flat_bulk_1000
+            winner = "Flat File"
+        else:
+            speedup = flat_bulk_1000 / mongo_bulk_1000
+            winner = "MongoDB"
+        print(f"   {winner} is {speedup:.2f}x FASTER for bulk operations")
+        print(f"   • Flat File @ 1000 msgs: {flat_bulk_1000:.4f}s")
+        print(f"   • MongoDB @ 1000 msgs:   {mongo_bulk_1000:.4f}s")
+        print(f"   • Why: Single large write favors flat files' simple write model")
+        print(f"           Network overhead and document parsing add cost to MongoDB")
+        print()
+
+        print("4. COLD START (Initial Setup):")
+        print("   " + "-" * 76)
+        if flat_cold < mongo_cold:
+            speedup = mongo_cold / flat_cold
+            winner = "Flat File"
+        else:
+            speedup = flat_cold / mongo_cold
+            winner = "MongoDB"
+        print(f"   {winner} is {speedup:.2f}x FASTER for cold starts")
+        print(f"   • Flat File: {flat_cold:.4f}s")
+        print(f"   • MongoDB:   {mongo_cold:.4f}s")
+        print(f"   • Why: Flat files have zero setup; MongoDB requires connection")
+        print(f"           and index creation")
+        print()
+
+        print("5. READ PERFORMANCE (Loading Conversation):")
+        print("   " + "-" * 76)
+        flat_read_100 = results['flat_file']['read_100']
+        mongo_read_100 = results['mongodb']['read_100']
+        if flat_read_100 < mongo_read_100:
+            speedup = mongo_read_100 / flat_read_100
+            winner = "Flat File"
+        else:
+            speedup = flat_read_100 / mongo_read_100
+            winner = "MongoDB"
+        print(f"   {winner} is {speedup:.2f}x FASTER for reading full conversations")
+        print(f"   • Flat File @ 100 msgs: {flat_read_100 * 1000:.2f}ms")
+        print(f"   • MongoDB @ 100 msgs:   {mongo_read_100 * 1000:.2f}ms")
+        print(f"   • Note: Both are fast; difference is network vs disk I/O")
+        print()
+
+    print("6. SQLITE (Embedded, One Row per Message):")
     print("   " + "-" * 76)
-    flat_read_100 = results['flat_file']['read_100']
-    mongo_read_100 = results['mongodb']['read_100']
-    if flat_read_100 < mongo_read_100:
-        speedup = mongo_read_100 / flat_read_100
-        winner = "Flat File"
-    else:
-        speedup = flat_read_100 / mongo_read_100
-        winner = "MongoDB"
-    print(f"   {winner} is {speedup:.2f}x FASTER for reading full conversations")
-    print(f"   • Flat File @ 100 msgs: {flat_read_100 * 1000:.2f}ms")
-    print(f"   • MongoDB @ 100 msgs:   {mongo_read_100 * 1000:.2f}ms")
-    print(f"   • Note: Both are fast; difference is network vs disk I/O")
+    sqlite_10 = results['sqlite']['append_10']
+    sqlite_100 = results['sqlite']['append_100']
+    mongo_10_note = f", MongoDB {mongo_10 * 1000:.2f}ms" if CONNECTION_STRING else ""
+    mongo_100_note = f", MongoDB {mongo_100 * 1000:.2f}ms" if CONNECTION_STRING else ""
+    print(f"   • Append @ 10 msgs:    {sqlite_10 * 1000:.2f}ms (Flat File {flat_10 * 1000:.2f}ms{mongo_10_note})")
+    print(f"   • Append @ 100 msgs:   {sqlite_100 * 1000:.2f}ms (Flat File {flat_100 * 1000:.2f}ms{mongo_100_note})")
+    print(f"   • Slows down by {sqlite_100 / sqlite_10:.2f}x as conversations grow 10x")
+    print(f"   • Bulk write @ 1000 msgs: {results['sqlite']['bulk_write_1000']:.4f}s")
+    print(f"   • Cold start: {results['sqlite']['cold_start']:.4f}s")
+    print(f"   • Why: Appends insert new rows only, with no server round trip")
     print()
 
     print("\n" + "=" * 80)
@@ -494,6 +1244,10 @@ if __name__ == "__main__":
     print("✓ Cold Starts: Instant initialization, no connection overhead")
     print("✓ Small Scale: Faster than MongoDB for <50 message conversations")
     print("✓ Bulk Writes: Single large writes are efficient")
+    print("✓ Appends: Written to a JSON Lines log, without rewriting the conversation file")
+    print("✓ Crash Safety: Files are replaced atomically; durable=True fsyncs in group commits")
+    print("✓ Large Stores: shard_levels spreads files across hashed subdirectories")
+    print("✓ Concurrency: Per-conversation file locks let several processes write safely")
     print("✓ Portability: Plain JSON files work everywhere")
     print("✓ Debugging: Easy to inspect and edit files manually")
     print("✓ Cost: Completely free, no hosting or service costs")
@@ -501,32 +1255,32 @@ if __name__ == "__main__":
     print("✓ No Network: Pure disk I/O avoids TCP/connection overhead")
     print()
     print("❌ Disadvantages:")
-    print("  • Incremental updates require full file rewrite (O(n) operation)")
+    print("  • Append logs are folded back in by compaction, which rewrites the whole file")
     print(f"  • Performance degrades as conversations grow ({flat_scaling:.2f}x slower at 100 msgs)")
-    print("  • No atomic operations (risk of corruption on crashes)")
-    print("  • No indexing or query capabilities")
-    print("  • File system limits (~10,000 files per directory)")
-    print("  • Concurrent access is problematic")
-    print("  • Will become significantly slower at 500+ messages")
+    print("  • No query capabilities beyond full-text search (FlatFileManager(search=True))")
+    print("  • File locks coordinate processes on one machine, not across servers")
+    print("  • Full reads still parse the whole conversation")
     print()
 
     print("=" * 80)
     print("MONGODB ADVANTAGES:")
     print("=" * 80)
     print("✓ Scalability: Performance stays more consistent as data grows")
-    print(f"✓ Better Scaling: Only {mongo_scaling:.2f}x slower at 10x data (vs {flat_scaling:.2f}x for files)")
+    if CONNECTION_STRING:
+        print(f"✓ Better Scaling: Only {mongo_scaling:.2f}x slower at 10x data (vs {flat_scaling:.2f}x for files)")
     print("✓ Indexing: Fast lookups across millions of documents")
     print("✓ Queries: Flexible search and aggregation capabilities")
     print("✓ Concurrency: Built-in handling of simultaneous access")
-    print("✓ Atomic Operations: Guaranteed consistency with $push")
+    print("✓ Atomic Operations: Every single-document update is atomic")
     print("✓ Replication: Built-in backup and high availability")
     print("✓ Advanced Features: Transactions, change streams, aggregations")
     print("✓ Production Ready: Handles millions of users")
     print()
     print("❌ Disadvantages:")
     print("  • Setup Complexity: Requires server installation or cloud account")
-    print(f"  • Network Overhead: {mongo_10 * 1000:.1f}ms even for simple operations locally")
-    print(f"  • Slower for Small Data: {speedup_10:.2f}x slower than files for tiny conversations")
+    if CONNECTION_STRING:
+        print(f"  • Network Overhead: {mongo_10 * 1000:.1f}ms even for simple operations locally")
+        print(f"  • Slower for Small Data: {speedup_10:.2f}x slower than files for tiny conversations")
     print("  • Resource Usage: Requires memory and CPU for database server")
     print("  • Cost: Cloud hosting costs for production (~$57/month for M10)")
     print("  • Learning Curve: More complex than simple file I/O")